@@ -0,0 +1,125 @@
+"""Compare full and delta encoded storage of GSI events.
+
+Usage: python benchmarks/bench_gsi_delta.py [--ticks N] [--keyframe-interval N]
+       [replay.ndjson]
+
+Events are read from an NDJSON dump (such as the output of a GSI replay
+with ?format=ndjson) or synthesized if no file is given.
+"""
+import argparse
+import json
+import random
+import sys
+import time
+
+from cheeseshop import jsondelta
+
+
+def synthesize(ticks, seed=0):
+    rand = random.Random(seed)
+    players = {}
+    for i in range(10):
+        players['7656119%010d' % i] = {
+            'name': 'player-%d' % i,
+            'team': 'CT' if i < 5 else 'T',
+            'state': {'health': 100, 'armor': 100, 'helmet': True,
+                      'money': 800, 'round_kills': 0, 'equip_value': 200},
+            'match_stats': {'kills': 0, 'assists': 0, 'deaths': 0,
+                            'mvps': 0, 'score': 0},
+            'position': '0.00, 0.00, 0.00',
+            'forward': '1.00, 0.00, 0.00',
+            'weapons': {
+                'weapon_0': {'name': 'weapon_knife', 'type': 'Knife',
+                             'state': 'holstered'},
+                'weapon_1': {'name': 'weapon_usp_silencer', 'type': 'Pistol',
+                             'ammo_clip': 12, 'ammo_clip_max': 12,
+                             'ammo_reserve': 24, 'state': 'active'}
+            }
+        }
+    doc = {
+        'provider': {'name': 'Counter-Strike: Global Offensive',
+                     'appid': 730, 'version': 13694,
+                     'steamid': '76561190000000000', 'timestamp': 0},
+        'map': {'mode': 'competitive', 'name': 'de_dust2', 'phase': 'live',
+                'round': 0, 'team_ct': {'score': 0},
+                'team_t': {'score': 0}},
+        'round': {'phase': 'live'},
+        'allplayers': players,
+    }
+    for tick in range(ticks):
+        doc = json.loads(json.dumps(doc))
+        doc['provider']['timestamp'] = 1500000000 + tick
+        for player in doc['allplayers'].values():
+            player['position'] = '%.2f, %.2f, %.2f' % (
+                rand.uniform(-2000, 2000), rand.uniform(-2000, 2000),
+                rand.uniform(0, 200)
+            )
+            player['forward'] = '%.2f, %.2f, 0.00' % (rand.uniform(-1, 1),
+                                                      rand.uniform(-1, 1))
+            if rand.random() < 0.05:
+                player['state']['health'] = rand.randint(0, 100)
+        if tick % 100 == 99:
+            doc['map']['round'] += 1
+        yield doc
+
+
+def read_ndjson(path):
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                event = json.loads(line)
+                yield event.get('event', event)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('replay', nargs='?')
+    parser.add_argument('--ticks', type=int, default=2000)
+    parser.add_argument('--keyframe-interval', type=int, default=50)
+    args = parser.parse_args()
+
+    if args.replay:
+        docs = list(read_ndjson(args.replay))
+    else:
+        docs = list(synthesize(args.ticks))
+    texts = [json.dumps(doc) for doc in docs]
+
+    encoder = jsondelta.KeyframeEncoder(args.keyframe_interval)
+    start = time.perf_counter()
+    stored = [encoder.encode(i, doc, text)
+              for i, (doc, text) in enumerate(zip(docs, texts))]
+    encode_time = time.perf_counter() - start
+
+    # Rebuild every event the way dbapi does, with the keyframe cached
+    start = time.perf_counter()
+    keyframes = {}
+    for i, (text, keyframe_id) in enumerate(stored):
+        if keyframe_id is None:
+            keyframes[i] = json.loads(text)
+        else:
+            jsondelta.dumps(jsondelta.apply(keyframes[keyframe_id],
+                                            json.loads(text)))
+    rebuild_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for text in texts:
+        json.loads(text)
+    parse_time = time.perf_counter() - start
+
+    full_bytes = sum(len(text) for text in texts)
+    delta_bytes = sum(len(text) for text, _ in stored)
+    keyframe_count = sum(1 for _, keyframe_id in stored
+                         if keyframe_id is None)
+    count = len(docs)
+    print('events:           %d (%d keyframes)' % (count, keyframe_count))
+    print('full bytes/tick:  %.0f' % (full_bytes / count))
+    print('delta bytes/tick: %.0f (%.1f%% of full)'
+          % (delta_bytes / count, 100.0 * delta_bytes / full_bytes))
+    print('encode:           %.1f us/tick' % (1e6 * encode_time / count))
+    print('rebuild:          %.1f us/tick' % (1e6 * rebuild_time / count))
+    print('parse full:       %.1f us/tick' % (1e6 * parse_time / count))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
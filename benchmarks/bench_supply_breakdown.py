@@ -0,0 +1,124 @@
+"""Compare the army supply interval sweep against the per sample scan.
+
+Usage: python benchmarks/bench_supply_breakdown.py [--repeat N]
+       [replay.SC2Replay ...]
+
+Replays are parsed once up front so only the supply computation is timed.
+With no replays a long game is synthesized instead.
+"""
+import argparse
+import json
+import random
+import time
+
+import sc2reader
+from sc2reader.engine.plugins import ContextLoader, GameHeartNormalizer
+
+from cheeseshop.workers import supply_breakdown
+
+
+class FakeUnit(object):
+    def __init__(self, name, supply, finished_at, died_at):
+        self.name = name
+        self.supply = supply
+        self.finished_at = finished_at
+        self.died_at = died_at
+
+
+def synthesize(frames, units_per_player, seed=0):
+    rand = random.Random(seed)
+    names = list(supply_breakdown.ARMY_UNITS) + ['SCV', 'Probe', 'Drone']
+    supplies = dict((name, rand.choice([0.5, 1, 2, 3, 4, 6]))
+                    for name in names)
+    players = []
+    for _ in range(2):
+        units = []
+        for _ in range(units_per_player):
+            name = rand.choice(names)
+            finished_at = rand.randrange(frames)
+            died_at = rand.choice([None, finished_at + rand.randrange(20000)])
+            units.append(FakeUnit(name, supplies[name], finished_at,
+                                  died_at))
+        players.append(units)
+    return [(frames, players)]
+
+
+def load(paths):
+    games = []
+    for path in paths:
+        replay = sc2reader.load_replay(
+            path,
+            engine=sc2reader.engine.GameEngine(plugins=[
+                ContextLoader(),
+                GameHeartNormalizer(),
+            ])
+        )
+        players = [list(player.units) for player in replay.players
+                   if player.is_human and not player.is_observer]
+        games.append((replay.frames, players))
+    return games
+
+
+def sampled_scan(units, frames):
+    """The supply computation as it was before the interval sweep."""
+    times = []
+    unit_supplies = {}
+    for unit_type in supply_breakdown.ARMY_UNITS:
+        unit_supplies[unit_type] = []
+    for current_frame in range(0, frames, 160):
+        times.append(current_frame)
+        supply_per_unit = {}
+        for unit_type in supply_breakdown.ARMY_UNITS:
+            supply_per_unit[unit_type] = 0
+        for unit in units:
+            if unit.name not in supply_breakdown.ARMY_UNITS:
+                continue
+            died_at = frames if unit.died_at is None else unit.died_at
+            if unit.finished_at <= current_frame <= died_at:
+                supply_per_unit[unit.name] += unit.supply
+        for unit_name, supply in supply_per_unit.items():
+            unit_supplies[unit_name].append(supply)
+    return times, dict((key, value) for key, value in unit_supplies.items()
+                       if sum(value) != 0)
+
+
+def run(games, series, repeat):
+    results = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        results = [series(units, frames)
+                   for frames, players in games for units in players]
+    return (time.perf_counter() - start) / repeat, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('replays', nargs='*')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--frames', type=int, default=40000,
+                        help='Length of the synthesized game')
+    parser.add_argument('--units', type=int, default=1500,
+                        help='Units per player in the synthesized game')
+    args = parser.parse_args()
+
+    if args.replays:
+        games = load(args.replays)
+    else:
+        games = synthesize(args.frames, args.units)
+    units = sum(len(units) for _, players in games for units in players)
+    print('%d games, %d units' % (len(games), units))
+
+    scan_time, scan_results = run(games, sampled_scan, args.repeat)
+    sweep_time, sweep_results = run(games,
+                                    supply_breakdown.army_supply_series,
+                                    args.repeat)
+    if json.dumps(scan_results, sort_keys=True) != \
+            json.dumps(sweep_results, sort_keys=True):
+        raise SystemExit('Interval sweep output differs from the scan')
+    print('per sample scan:  %8.1f ms' % (scan_time * 1000))
+    print('interval sweep:   %8.1f ms' % (sweep_time * 1000))
+    print('speedup:          %8.1fx' % (scan_time / sweep_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Measure segmented upload throughput against a local fake Swift server.
+
+Usage: python benchmarks/bench_swift_segmented.py [--size MB]
+       [--segment-size MB] [--stream-bandwidth MB/s]
+
+The fake server reads each request no faster than --stream-bandwidth,
+standing in for the per-connection throughput cap of a remote Swift.
+Compares one serial PUT with parallel segment uploads at increasing
+concurrency.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+from cheeseshop import config
+from cheeseshop import swift
+from cheeseshop.tests import fakes
+
+MB = 1024 * 1024
+
+
+async def timed(coro):
+    start = time.perf_counter()
+    await coro
+    return time.perf_counter() - start
+
+
+async def main_async(args):
+    data = os.urandom(int(args.size * MB))
+    segment_size = int(args.segment_size * MB)
+    bandwidth = args.stream_bandwidth * MB if args.stream_bandwidth else None
+    fake = fakes.FakeKeystoneSwift(stream_bandwidth=bandwidth)
+    await fake.start()
+    swift_config = config.SwiftConfig('', '', '', '', 'region', 'bench', '')
+    http_session = swift.create_http_session(swift_config)
+    keystone = swift.KeystoneSession(fake.url, 'project', 'user', 'password',
+                                     http_session=http_session)
+    try:
+        async with swift.SwiftClient(keystone, 'region',
+                                     http_session=http_session) as client:
+            elapsed = await timed(client.create_object('serial', data,
+                                                       'bench'))
+            print('serial PUT:      %7.1f MB/s' % (args.size / elapsed))
+            for concurrency in args.concurrency:
+                elapsed = await timed(client.create_large_object(
+                    'segmented-%d' % concurrency, data, 'bench',
+                    segment_size=segment_size, concurrency=concurrency
+                ))
+                print('concurrency %3d: %7.1f MB/s'
+                      % (concurrency, args.size / elapsed))
+    finally:
+        await keystone.close()
+        await http_session.close()
+        await fake.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=float, default=32)
+    parser.add_argument('--segment-size', type=float, default=2)
+    parser.add_argument('--stream-bandwidth', type=float, default=8,
+                        help='Per connection MB/s, 0 for unlimited')
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=[1, 2, 4, 8])
+    args = parser.parse_args()
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main_async(args))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,74 @@
+"""Measure Swift upload throughput against a local fake Swift server.
+
+Usage: python benchmarks/bench_swift_upload.py [--uploads N]
+       [--concurrency N] [--size BYTES]
+
+Compares a new ClientSession per upload with the shared, pooled session
+the webapp uses. The fake server speaks plain HTTP, so the gap against a
+real TLS endpoint is larger than shown here.
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+from cheeseshop import config
+from cheeseshop import swift
+from cheeseshop.tests import fakes
+
+
+async def run(fake, uploads, concurrency, data, http_session):
+    keystone = swift.KeystoneSession(fake.url, 'project', 'user', 'password',
+                                     http_session=http_session)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def upload(client, i):
+        async with semaphore:
+            await client.create_object('object-%d' % i, data, 'bench')
+
+    async with swift.SwiftClient(keystone, 'region',
+                                 http_session=http_session) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*[upload(client, i) for i in range(uploads)])
+        elapsed = time.perf_counter() - start
+    await keystone.close()
+    return elapsed
+
+
+async def main_async(args):
+    swift_config = config.SwiftConfig('', '', '', '', 'region', 'bench', '',
+                                      pool_limit_per_host=args.concurrency)
+    data = b'x' * args.size
+    fake = fakes.FakeKeystoneSwift()
+    await fake.start()
+    try:
+        fake.peers.clear()
+        elapsed = await run(fake, args.uploads, args.concurrency, data, None)
+        print('session per upload: %7.0f uploads/s, %d connections'
+              % (args.uploads / elapsed, len(fake.peers)))
+
+        fake.peers.clear()
+        http_session = swift.create_http_session(swift_config)
+        try:
+            elapsed = await run(fake, args.uploads, args.concurrency, data,
+                                http_session)
+        finally:
+            await http_session.close()
+        print('shared session:     %7.0f uploads/s, %d connections'
+              % (args.uploads / elapsed, len(fake.peers)))
+    finally:
+        await fake.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--uploads', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--size', type=int, default=16 * 1024)
+    args = parser.parse_args()
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main_async(args))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,70 @@
+import collections
+import hashlib
+import math
+
+
+class LruCache(object):
+    """A size bounded mapping which evicts the least recently used key."""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class BloomFilter(object):
+    """A set which may report false positives but never false negatives.
+
+    Sized for capacity keys with a false positive rate of error_rate;
+    adding more keys than that raises the rate. Keys are strings.
+    """
+    def __init__(self, capacity, error_rate=0.01):
+        self.num_bits = max(8, int(-capacity * math.log(error_rate) /
+                                   math.log(2) ** 2))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity *
+                                           math.log(2))))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, key):
+        # Double hashing: position i is h1 + i * h2
+        digest = hashlib.sha1(key.encode()).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:16], 'big') | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(self._bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(key))
@@ -1,77 +1,194 @@
-from lxml import html
-import requests
+import aiohttp
 import argparse
+import asyncio
+from lxml import html
 import os
 import rarfile
 import datetime
 
 
-results_url = "https://www.hltv.org/results?team="
 base_url = "https://www.hltv.org"
+results_path = "/results?team="
+
+# Connections to hltv and its demo mirrors, per host
+DEFAULT_LIMIT_PER_HOST = 4
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Downloads are written here until complete, and resumed from it
+PARTIAL_SUFFIX = '.part'
+
+
+class ScraperError(Exception):
+    pass
+
+
+class Match(object):
+    def __init__(self, path, date, demo_path):
+        self.path = path
+        self.date = date
+        self.demo_path = demo_path
+
+    @property
+    def name(self):
+        return self.path.split('/')[-1]
+
+
+def parse_match_links(content):
+    """ Get the match paths from a results page. """
+    tree = html.fromstring(content)
+    return tree.xpath('//a[contains(@href, "/matches/")]/@href')
+
+
+def parse_match_page(content):
+    """ Get the date and demo download path, or None if there is no demo
+        yet, from a match page.
+    """
+    tree = html.fromstring(content)
+    match_date = tree.xpath('//div[@class="date"]/@data-unix')
+    date = datetime.datetime.fromtimestamp(
+        int(match_date[0]) / 1000.0).strftime('%Y-%m-%d')
+    demo_links = tree.xpath('//a[contains(@href, "/download/demo")]/@href')
+    return date, demo_links[0] if demo_links else None
 
 
 class Scraper:
     def __init__(self, output_dir, team, replays,
-                 _list=False, _download=False, extract=False):
+                 _list=False, _download=False, extract=False,
+                 base_url=base_url, limit_per_host=DEFAULT_LIMIT_PER_HOST):
         self.directory = output_dir
         self.team = team
         self.replay_count = replays
         self.replay_list = _list
         self.download = _download
         self.extract = extract
+        self.base_url = base_url
+        self.limit_per_host = limit_per_host
         self.matches = []
-        if self.download or self.replay_list:
-            self.matches = self.get_match(self.team)[:self.replay_count]
-
-    def run(self):
-        for match in self.matches:
-            if self.replay_list:
-                self._list(match)
+        self._session = None
 
-            if self.download:
-                self._download(match)
+    async def run(self):
+        if self.download or self.replay_list:
+            # One pooled session, so pages and demos reuse connections
+            connector = aiohttp.TCPConnector(
+                limit_per_host=self.limit_per_host
+            )
+            async with aiohttp.ClientSession(connector=connector) as session:
+                self._session = session
+                try:
+                    await self._scrape()
+                finally:
+                    self._session = None
 
         if self.extract:
             self.extract_replays()
 
-    def _download(self, match):
-        match_filename = match.split('/')[-1]
-        if self.dupe_check_replays(match_filename):
+    async def _scrape(self):
+        match_paths = await self.get_match_paths(self.team)
+        # Each match page is fetched once, concurrently
+        self.matches = await asyncio.gather(*[
+            self.get_match(path) for path in match_paths[:self.replay_count]
+        ])
+        if self.replay_list:
+            for match in self.matches:
+                self._list(match)
+        if self.download:
+            await asyncio.gather(*[self._download(match)
+                                   for match in self.matches])
+
+    async def _download(self, match):
+        if self.dupe_check_replays(match.name):
             print("{} has already been downloaded,"
-                  "skipping.".format(match_filename))
+                  "skipping.".format(match.name))
+        elif match.demo_path:
+            print("Downloading {}...".format(match.name))
+            await self.download_replay(
+                "{}{}".format(self.base_url, match.demo_path), match.name
+            )
         else:
-            demo_url = self.get_demo_link(self.format_url(match))
-            if demo_url:
-                print("Downloading {}...".format(match_filename,))
-                self.download_replay(("{}{}".format(base_url, demo_url)),
-                                     self.format_url(match))
-            else:
-                print("Skipping Download for", match.split('/')[-1],
-                      ". Demo file not available yet.")
+            print("Skipping Download for", match.name,
+                  ". Demo file not available yet.")
 
     def _list(self, match):
-        demo_url = self.get_demo_link(self.format_url(match))
-        if demo_url:
-            match_meta = [self.get_match_date(self.format_url(match)),
-                          "{}{}".format(base_url, demo_url),
-                          match.split('/')[-1]]
+        if match.demo_path:
+            match_meta = [match.date,
+                          "{}{}".format(self.base_url, match.demo_path),
+                          match.name]
         else:
-            match_meta = [self.get_match_date(self.format_url(match)),
-                          "No Demo File Yet", match.split('/')[-1]]
+            match_meta = [match.date, "No Demo File Yet", match.name]
         print(match_meta)
 
-    def download_replay(self, demo_url, match_url):
-        """ Download replays to ../replays so that we can stage for extracting
+    async def _get_page(self, url):
+        async with self._session.get(url) as resp:
+            if resp.status != 200:
+                raise ScraperError('GET of %s failed with status %d'
+                                   % (url, resp.status))
+            return await resp.read()
+
+    async def download_replay(self, demo_url, name):
+        """ Stream a replay to the output directory so that we can stage it
+            for extracting.
+
+            A partial download left by an earlier run is resumed with a
+            Range request.
         """
-        if not os.path.exists(self.directory):
-            os.makedirs(self.directory)
-        local_filename = "{}.rar".format(match_url.split('/')[-1])
+        os.makedirs(self.directory, exist_ok=True)
+        local_filename = "{}.rar".format(name)
         local_filename_location = os.path.join(self.directory, local_filename)
-        r = requests.get(demo_url)
-        with open(local_filename_location, "wb") as replay:
-            replay.write(r.content)
+        partial_location = local_filename_location + PARTIAL_SUFFIX
+        offset = 0
+        if os.path.isfile(partial_location):
+            offset = os.path.getsize(partial_location)
+
+        while not await self._download_from(demo_url, partial_location,
+                                            offset):
+            # The partial file cannot be resumed, so start again
+            offset = 0
+        os.rename(partial_location, local_filename_location)
         print("{} has finished download.".format(local_filename))
 
+    async def _download_from(self, demo_url, partial_location, offset):
+        """ Download a demo to partial_location, which already has its
+            first offset bytes.
+
+            Returns False if the download must start again from the first
+            byte.
+        """
+        headers = {}
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+        async with self._session.get(demo_url, headers=headers) as resp:
+            if resp.status == 416 and offset:
+                # Every byte was downloaded if the demo is that long
+                return self._range_length(resp) == offset
+            if resp.status == 206 and not self._resumes_at(resp, offset):
+                if not offset:
+                    raise ScraperError('GET of %s returned part of the demo'
+                                       % demo_url)
+                return False
+            if resp.status not in (200, 206):
+                raise ScraperError('GET of %s failed with status %d'
+                                   % (demo_url, resp.status))
+            # A 200 ignored the Range and has the whole demo
+            mode = 'ab' if resp.status == 206 and offset else 'wb'
+            with open(partial_location, mode) as replay:
+                async for chunk in resp.content.iter_chunked(
+                        DOWNLOAD_CHUNK_SIZE):
+                    replay.write(chunk)
+        return True
+
+    @staticmethod
+    def _resumes_at(resp, offset):
+        content_range = resp.headers.get('Content-Range', '')
+        return content_range.startswith('bytes %d-' % offset)
+
+    @staticmethod
+    def _range_length(resp):
+        """ The complete length from a Content-Range, or None. """
+        content_range = resp.headers.get('Content-Range', '')
+        try:
+            return int(content_range.rsplit('/', 1)[1])
+        except (IndexError, ValueError):
+            return None
+
     def dupe_check_replays(self, filename):
         """ Check if file exists so that we can skip download if needed. """
         replay_file = "{}.rar".format(filename)
@@ -96,40 +213,24 @@ class Scraper:
                     opened_rar.extract(member=replay_file,
                                        path=self.directory)
 
-    def format_url(self, match, base_url="https://www.hltv.org"):
+    def format_url(self, match):
         """ Formats the URL based on the base_url and match path. """
-        formatted_url = '{}/{}'.format(base_url, match)
+        formatted_url = '{}/{}'.format(self.base_url, match.lstrip('/'))
         return formatted_url
 
-    def get_demo_link(self, url):
-        """ Get demo links to download the replays. This returns the download
-            link for the demo files.
-        """
-        page = requests.get(url)
-        tree = html.fromstring(page.content)
-        demo_links = tree.xpath('//a[contains(@href, "/download/demo")]/@href')
-        return demo_links[0] if demo_links else None
-
-    def get_match(self, team_id):
+    async def get_match_paths(self, team_id):
         """ Get matches based on the URL and Team ID. This returns the match
             results link.
         """
-        fixed_team_url = "{}{}".format(results_url, team_id)
-        page = requests.get(fixed_team_url)
-        tree = html.fromstring(page.content)
-        match_links = tree.xpath('//a[contains(@href, "/matches/")]/@href')
-        return match_links
-
-    def get_match_date(self, url):
-        """ Get Unix timestamp from a specific match and convert it to readable
-            date.
-        """
-        match_page = requests.get(url)
-        match_tree = html.fromstring(match_page.content)
-        match_date = match_tree.xpath('//div[@class="date"]/@data-unix')
-        match_timestamp = datetime.datetime.fromtimestamp(
-            int(match_date[0]) / 1000.0).strftime('%Y-%m-%d')
-        return match_timestamp
+        fixed_team_url = "{}{}{}".format(self.base_url, results_path, team_id)
+        return parse_match_links(await self._get_page(fixed_team_url))
+
+    async def get_match(self, path):
+        """ Get the date and demo link of a match from its page. """
+        date, demo_path = parse_match_page(
+            await self._get_page(self.format_url(path))
+        )
+        return Match(path, date, demo_path)
 
 
 def main():
@@ -148,6 +249,9 @@ def main():
                         help='Number of replays to download.')
     parser.add_argument('--team',
                         help='Team UUID for hltv.org.')
+    parser.add_argument('--connections', type=int,
+                        default=DEFAULT_LIMIT_PER_HOST,
+                        help='Connections per host.')
     args = parser.parse_args()
     if not (args.team or args.extract):
         parser.error('Please use --team to specify the team, or --extract if '
@@ -156,5 +260,7 @@ def main():
     team = args.team
 
     scraper = Scraper(args.directory, team, args.replays, args.list,
-                      args.download, args.extract)
-    scraper.run()
+                      args.download, args.extract,
+                      limit_per_host=args.connections)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(scraper.run())
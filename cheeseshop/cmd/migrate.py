@@ -0,0 +1,62 @@
+import argparse
+import asyncio
+import sys
+
+from cheeseshop import config as cs_config
+from cheeseshop import db
+from cheeseshop import migrations
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description='Manage the cheeseshop db schema.'
+    )
+    parser.add_argument('config_file', type=str,
+                        help='Path to config file')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    upgrade_parser = subparsers.add_parser(
+        'upgrade', help='Apply pending migrations'
+    )
+    upgrade_parser.add_argument('--to', type=int, default=None,
+                                help='Version to upgrade to (default latest)')
+    subparsers.add_parser('status', help='Show current and pending versions')
+    return parser.parse_args(args)
+
+
+async def show_status(pool):
+    async with pool.acquire() as conn:
+        version, pending = await migrations.status(conn)
+    if version is None:
+        print('Database is empty')
+    else:
+        print('Current version: %d' % version)
+    for migration in pending:
+        print('Pending %d: %s%s' % (
+            migration.version, migration.description,
+            '' if migration.transactional else ' (non-transactional)'
+        ))
+    if not pending:
+        print('Up to date')
+
+
+async def upgrade(pool, target):
+    async with pool.acquire() as conn:
+        version = await migrations.upgrade(conn, target)
+    print('Schema at version %d' % version)
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    config = cs_config.Config.from_yaml_file(args.config_file)
+
+    loop = asyncio.get_event_loop()
+    pool = loop.run_until_complete(db.create_pool(config.sql))
+    if args.command == 'status':
+        loop.run_until_complete(show_status(pool))
+    else:
+        try:
+            loop.run_until_complete(upgrade(pool, args.to))
+        except migrations.MigrationError as e:
+            print('Error: %s' % e)
+            sys.exit(1)
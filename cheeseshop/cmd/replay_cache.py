@@ -0,0 +1,37 @@
+import argparse
+import sys
+
+from cheeseshop import config as cs_config
+from cheeseshop import util
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description='Inspect the worker replay cache.'
+    )
+    parser.add_argument('config_file', type=str,
+                        help='Path to config file')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    subparsers.add_parser('stats', help='Show hits, misses and size')
+    return parser.parse_args(args)
+
+
+def show_stats(replay_cache):
+    stats = replay_cache.stats()
+    lookups = stats['hits'] + stats['misses']
+    print('Directory: %s' % replay_cache.directory)
+    print('Entries: %d' % stats['entries'])
+    print('Size: %d of %d bytes' % (stats['size'], stats['max_size']))
+    print('Hits: %d' % stats['hits'])
+    print('Misses: %d' % stats['misses'])
+    if lookups:
+        print('Hit rate: %.1f%%' % (100.0 * stats['hits'] / lookups))
+    print('Evictions: %d' % stats['evictions'])
+    print('Bytes fetched: %d' % stats['bytes_fetched'])
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    config = cs_config.Config.from_yaml_file(args.config_file)
+    show_stats(util.get_replay_cache(config))
@@ -3,7 +3,11 @@ import yaml
 
 class SwiftConfig(object):
     def __init__(self, auth_url, project_id, user_id, password, region,
-                 replays_container, temp_url_key):
+                 replays_container, temp_url_key, pool_limit=100,
+                 pool_limit_per_host=20, keepalive_timeout=30,
+                 dns_cache_ttl=300, large_object_threshold=1073741824,
+                 segment_size=104857600, upload_concurrency=4,
+                 segment_retries=3):
         self.auth_url = auth_url
         self.project_id = project_id
         self.user_id = user_id
@@ -11,6 +15,14 @@ class SwiftConfig(object):
         self.region = region
         self.replays_container = replays_container
         self.temp_url_key = temp_url_key.encode()
+        self.pool_limit = int(pool_limit)
+        self.pool_limit_per_host = int(pool_limit_per_host)
+        self.keepalive_timeout = float(keepalive_timeout)
+        self.dns_cache_ttl = int(dns_cache_ttl)
+        self.large_object_threshold = int(large_object_threshold)
+        self.segment_size = int(segment_size)
+        self.upload_concurrency = int(upload_concurrency)
+        self.segment_retries = int(segment_retries)
 
 
 class SqlConfig(object):
@@ -25,6 +37,46 @@ class SqlConfig(object):
         self.minsize = minsize
 
 
+class GsiConfig(object):
+    def __init__(self, ingest_queue_size=10000, ingest_batch_size=500,
+                 ingest_flush_interval=0.5, streamer_cache_size=1024,
+                 streamer_negative_ttl=30, event_retention_days=None,
+                 partition_months_ahead=2, maintenance_interval=3600,
+                 event_storage='full', delta_keyframe_interval=50,
+                 heatmap_cache_size=128, extract_events=True,
+                 steam_id_cache_size=65536, viewer_keyframe_interval=50,
+                 ingest_retries=5, ingest_retry_interval=0.5,
+                 forward_timeout=2):
+        self.ingest_queue_size = int(ingest_queue_size)
+        self.ingest_batch_size = int(ingest_batch_size)
+        self.ingest_flush_interval = float(ingest_flush_interval)
+        self.ingest_retries = int(ingest_retries)
+        self.ingest_retry_interval = float(ingest_retry_interval)
+        self.forward_timeout = float(forward_timeout)
+        self.streamer_cache_size = int(streamer_cache_size)
+        self.streamer_negative_ttl = float(streamer_negative_ttl)
+        if event_retention_days is not None:
+            event_retention_days = int(event_retention_days)
+        self.event_retention_days = event_retention_days
+        self.partition_months_ahead = int(partition_months_ahead)
+        self.maintenance_interval = float(maintenance_interval)
+        if event_storage not in ('full', 'delta'):
+            raise ValueError('gsi event_storage must be full or delta')
+        self.event_storage = event_storage
+        self.delta_keyframe_interval = int(delta_keyframe_interval)
+        self.heatmap_cache_size = int(heatmap_cache_size)
+        self.extract_events = bool(extract_events)
+        self.steam_id_cache_size = int(steam_id_cache_size)
+        self.viewer_keyframe_interval = int(viewer_keyframe_interval)
+
+
+class ReplayCacheConfig(object):
+    def __init__(self, directory='~/.cache/cheeseshop/replays',
+                 max_size=10737418240):
+        self.directory = directory
+        self.max_size = int(max_size)
+
+
 class Config(object):
     @staticmethod
     def from_yaml_file(path):
@@ -32,12 +84,22 @@ class Config(object):
             raw_config = yaml.load(fh)
         swift_config = SwiftConfig(**raw_config['swift'])
         sql_config = SqlConfig(**raw_config['sql'])
+        gsi_config = GsiConfig(**raw_config.get('gsi', {}))
+        replay_cache_config = ReplayCacheConfig(
+            **raw_config.get('replay_cache', {})
+        )
         return Config(raw_config['host'], raw_config['port'],
-                      raw_config['base_uri'], swift_config, sql_config)
+                      raw_config['base_uri'], swift_config, sql_config,
+                      gsi_config, replay_cache_config,
+                      raw_config.get('workers', 1))
 
-    def __init__(self, host, port, base_uri, swift, sql):
+    def __init__(self, host, port, base_uri, swift, sql, gsi=None,
+                 replay_cache=None, workers=1):
         self.host = host
         self.port = int(port)
+        self.workers = int(workers)
         self.base_uri = base_uri
         self.swift = swift
         self.sql = sql
+        self.gsi = gsi or GsiConfig()
+        self.replay_cache = replay_cache or ReplayCacheConfig()
@@ -1,6 +1,16 @@
 import asyncpg
 
 
+async def connect(config):
+    return await asyncpg.connect(
+        database=config.database,
+        user=config.user,
+        password=config.password,
+        host=config.host,
+        port=config.port
+    )
+
+
 async def create_pool(config):
     return await asyncpg.create_pool(
         database=config.database,
@@ -1,12 +1,72 @@
+import datetime
 from enum import Enum
+import json
+import re
 
-# import asyncpg
+import asyncpg
+
+from cheeseshop import cache
+from cheeseshop import jsondelta
+
+
+# Arbitrary key for the advisory lock held during event maintenance
+GSI_EVENT_MAINTENANCE_LOCK_ID = 0x6373676f6d6e74
+
+# Maps are created when their first event is flushed, so allow for events
+# received shortly before a map's start_time when pruning by time.
+MAP_START_SLACK = datetime.timedelta(minutes=1)
+# Events are stored in batches, so one can have a slightly earlier time than
+# an event with a lower id. Allow for that when pruning by time after an id.
+EVENT_ORDER_SLACK = datetime.timedelta(minutes=1)
 
 
 class NotFoundError(Exception):
     pass
 
 
+class ConflictError(Exception):
+    pass
+
+
+def partitioning_supported(conn):
+    """Primary keys on partitioned tables need postgres 11 or newer."""
+    return conn.get_server_version() >= (11, 0)
+
+
+def start_of_month(time):
+    return datetime.datetime(time.year, time.month, 1)
+
+
+def start_of_next_month(month_start):
+    if month_start.month == 12:
+        return datetime.datetime(month_start.year + 1, 1, 1)
+    return datetime.datetime(month_start.year, month_start.month + 1, 1)
+
+
+def _event_range_filter(params, after_id=None, since=None, until=None,
+                        table=None):
+    """Build AND clauses for keyset and time range filtering of events.
+
+    Values are appended to params and referenced as positional args.
+    """
+    prefix = table + '.' if table else ''
+    clauses = []
+    for column, op, value in (('id', '>', after_id),
+                              ('time', '>=', since),
+                              ('time', '<', until)):
+        if value is not None:
+            params.append(value)
+            clauses.append('%s%s %s $%d' % (prefix, column, op, len(params)))
+    return ''.join('\n            AND ' + clause for clause in clauses)
+
+
+def _limit_clause(params, limit):
+    if limit is None:
+        return ''
+    params.append(limit)
+    return '\n            LIMIT $%d' % len(params)
+
+
 class Game(object):
     @staticmethod
     async def create_schema(conn):
@@ -89,11 +149,16 @@ class Replay(object):
 
     @staticmethod
     async def create(conn, uuid, game_id, upload_state, sha1sum):
-        row = await conn.fetchrow('''
-            INSERT INTO replays(uuid, game_id, upload_state, sha1sum)
-            VALUES($1, $2, $3, $4)
-            RETURNING id
-        ''', uuid, game_id, upload_state.value, sha1sum)
+        """Create a replay, raising ConflictError if sha1sum is taken."""
+        try:
+            async with conn.transaction():
+                row = await conn.fetchrow('''
+                    INSERT INTO replays(uuid, game_id, upload_state, sha1sum)
+                    VALUES($1, $2, $3, $4)
+                    RETURNING id
+                ''', uuid, game_id, upload_state.value, sha1sum)
+        except asyncpg.UniqueViolationError:
+            raise ConflictError()
         return Replay(row['id'], uuid, game_id, upload_state, sha1sum)
 
     @staticmethod
@@ -110,6 +175,8 @@ class Replay(object):
         row = await conn.fetchrow('''
             SELECT * FROM replays WHERE uuid = $1
         ''', uuid)
+        if row is None:
+            raise NotFoundError()
         return Replay.from_db_row(row)
 
     @staticmethod
@@ -121,6 +188,16 @@ class Replay(object):
             raise NotFoundError()
         return Replay.from_db_row(row)
 
+    @staticmethod
+    def cursor_sha1sums(conn):
+        """Cursor over the sha1sum of every replay which has one.
+
+        Must be iterated inside a transaction.
+        """
+        return conn.cursor('''
+            SELECT sha1sum FROM replays WHERE sha1sum IS NOT NULL
+        ''')
+
     @staticmethod
     def from_db_row(row):
         return Replay(row['id'], row['uuid'], row['game_id'],
@@ -142,6 +219,203 @@ class Replay(object):
             WHERE id = $2
         ''', upload_state.value, self.id)
 
+    async def set_sha1sum(self, conn, sha1sum):
+        """Set sha1sum, raising ConflictError if another replay has it."""
+        try:
+            async with conn.transaction():
+                await conn.execute('''
+                    UPDATE replays SET sha1sum = $1
+                    WHERE id = $2
+                ''', sha1sum, self.id)
+        except asyncpg.UniqueViolationError:
+            raise ConflictError()
+        self.sha1sum = sha1sum
+
+    async def delete(self, conn):
+        await conn.execute('''
+            DELETE FROM replays WHERE id = $1
+        ''', self.id)
+
+
+class ReplayAnalysis(object):
+    """The output of a worker analysis of a replay.
+
+    version is bumped by the worker when its output changes, so results
+    from older versions can be told apart and recomputed. result is kept
+    as the json text stored.
+    """
+    @staticmethod
+    async def create_schema(conn):
+        await conn.execute('''
+            CREATE TABLE replay_analyses(
+                replay_id integer REFERENCES replays (id) ON DELETE CASCADE,
+                analysis text NOT NULL,
+                version integer NOT NULL,
+                result json,
+                created_at timestamp,
+                PRIMARY KEY (replay_id, analysis, version)
+            )
+        ''')
+
+    @staticmethod
+    async def upsert_many(conn, analysis, version, results):
+        """Insert or replace the results of (sha1sum, result) pairs.
+
+        Results for sha1sums without a replay are ignored.
+        """
+        now = datetime.datetime.now()
+        records = [(sha1sum, analysis, version, json.dumps(result), now)
+                   for sha1sum, result in results]
+        await conn.executemany('''
+            INSERT INTO replay_analyses(replay_id, analysis, version, result,
+                                        created_at)
+            SELECT id, $2::text, $3::integer, $4::json, $5::timestamp
+            FROM replays WHERE sha1sum = $1
+            ON CONFLICT (replay_id, analysis, version) DO UPDATE
+            SET result = EXCLUDED.result, created_at = EXCLUDED.created_at
+        ''', records)
+
+    @staticmethod
+    async def get_sha1sums(conn, analysis, version):
+        """Return the set of sha1sums of replays with a result."""
+        rows = await conn.fetch('''
+            SELECT replays.sha1sum FROM replay_analyses
+            INNER JOIN replays ON replays.id = replay_analyses.replay_id
+            WHERE replay_analyses.analysis = $1
+                AND replay_analyses.version = $2
+        ''', analysis, version)
+        return set(row['sha1sum'] for row in rows)
+
+    @staticmethod
+    async def get(conn, replay_id, analysis, version=None):
+        """Get the result of analysis, by default of its latest version."""
+        if version is None:
+            row = await conn.fetchrow('''
+                SELECT * FROM replay_analyses
+                WHERE replay_id = $1 AND analysis = $2
+                ORDER BY version DESC
+                LIMIT 1
+            ''', replay_id, analysis)
+        else:
+            row = await conn.fetchrow('''
+                SELECT * FROM replay_analyses
+                WHERE replay_id = $1 AND analysis = $2 AND version = $3
+            ''', replay_id, analysis, version)
+        if row is None:
+            raise NotFoundError()
+        return ReplayAnalysis.from_row(row)
+
+    @staticmethod
+    def from_row(row):
+        return ReplayAnalysis(row['replay_id'], row['analysis'],
+                              row['version'], row['result'],
+                              row['created_at'])
+
+    def __init__(self, replay_id, analysis, version, result, created_at):
+        self.replay_id = replay_id
+        self.analysis = analysis
+        self.version = version
+        self.result = result
+        self.created_at = created_at
+
+
+class ReplayPlayer(object):
+    """A player of a replay, as found by version of player_names."""
+    @staticmethod
+    async def create_schema(conn):
+        await conn.execute('''
+            CREATE TABLE replay_players(
+                replay_id integer REFERENCES replays (id) ON DELETE CASCADE,
+                version integer NOT NULL,
+                pid integer NOT NULL,
+                name text,
+                race text,
+                pick_race text,
+                team integer,
+                result text,
+                is_human boolean,
+                PRIMARY KEY (replay_id, version, pid)
+            )
+        ''')
+        await conn.execute('''
+            CREATE INDEX ON replay_players (name)
+        ''')
+
+    @staticmethod
+    async def upsert_many(conn, version, results):
+        """Insert or replace the players of (sha1sum, players) pairs, where
+        players are dicts as output by player_names.
+
+        Players of sha1sums without a replay are ignored.
+        """
+        records = []
+        for sha1sum, players in results:
+            for player in players:
+                records.append((sha1sum, version, player['pid'],
+                                player['name'], player['race'],
+                                player['pick_race'], player['team'],
+                                player['result'], player['is_human']))
+        await conn.executemany('''
+            INSERT INTO replay_players(replay_id, version, pid, name, race,
+                                       pick_race, team, result, is_human)
+            SELECT id, $2::integer, $3::integer, $4::text, $5::text,
+                   $6::text, $7::integer, $8::text, $9::boolean
+            FROM replays WHERE sha1sum = $1
+            ON CONFLICT (replay_id, version, pid) DO UPDATE
+            SET name = EXCLUDED.name, race = EXCLUDED.race,
+                pick_race = EXCLUDED.pick_race, team = EXCLUDED.team,
+                result = EXCLUDED.result, is_human = EXCLUDED.is_human
+        ''', records)
+
+    @staticmethod
+    async def get_by_replay_ids(conn, replay_ids):
+        """Return a dict of replay id to its players, by pid, from the
+        latest version of player_names for each replay.
+        """
+        players = dict((replay_id, []) for replay_id in replay_ids)
+        rows = await conn.fetch('''
+            SELECT * FROM replay_players
+            WHERE replay_id = ANY($1::integer[])
+                AND (replay_id, version) IN (
+                    SELECT replay_id, max(version) FROM replay_players
+                    WHERE replay_id = ANY($1::integer[])
+                    GROUP BY replay_id
+                )
+            ORDER BY replay_id, pid
+        ''', list(replay_ids))
+        for row in rows:
+            players[row['replay_id']].append(ReplayPlayer.from_row(row))
+        return players
+
+    @staticmethod
+    def from_row(row):
+        return ReplayPlayer(row['replay_id'], row['version'], row['pid'],
+                            row['name'], row['race'], row['pick_race'],
+                            row['team'], row['result'], row['is_human'])
+
+    def __init__(self, replay_id, version, pid, name, race, pick_race, team,
+                 result, is_human):
+        self.replay_id = replay_id
+        self.version = version
+        self.pid = pid
+        self.name = name
+        self.race = race
+        self.pick_race = pick_race
+        self.team = team
+        self.result = result
+        self.is_human = is_human
+
+    def to_dict(self):
+        return {
+            'pid': self.pid,
+            'name': self.name,
+            'race': self.race,
+            'pick_race': self.pick_race,
+            'team': self.team,
+            'result': self.result,
+            'is_human': self.is_human,
+        }
+
 
 class CsGoStreamer(object):
     @staticmethod
@@ -184,6 +458,8 @@ class CsGoStreamer(object):
             SELECT * FROM cs_go_streamer
             WHERE name = $1
         ''', name)
+        if row is None:
+            raise NotFoundError()
         return CsGoStreamer.from_row(row)
 
     @staticmethod
@@ -192,6 +468,18 @@ class CsGoStreamer(object):
             SELECT * FROM cs_go_streamer
             WHERE uuid = $1
         ''', uuid)
+        if row is None:
+            raise NotFoundError()
+        return CsGoStreamer.from_row(row)
+
+    @staticmethod
+    async def get_by_id(conn, id_):
+        row = await conn.fetchrow('''
+            SELECT * FROM cs_go_streamer
+            WHERE id = $1
+        ''', id_)
+        if row is None:
+            raise NotFoundError()
         return CsGoStreamer.from_row(row)
 
     @staticmethod
@@ -207,15 +495,82 @@ class CsGoStreamer(object):
 class CsGoGsiEvent(object):
     @staticmethod
     async def create_schema(conn):
+        if partitioning_supported(conn):
+            await conn.execute('''
+                CREATE TABLE cs_go_gsi_events(
+                    id serial,
+                    time timestamp NOT NULL,
+                    streamer_id integer REFERENCES cs_go_streamer (id),
+                    event json,
+                    keyframe_id integer,
+                    PRIMARY KEY (id, time)
+                ) PARTITION BY RANGE (time)
+            ''')
+            await CsGoGsiEventPartition.create_default(conn)
+            await CsGoGsiEventPartition.ensure(conn, datetime.datetime.now())
+        else:
+            await conn.execute('''
+                CREATE TABLE cs_go_gsi_events(
+                    id serial PRIMARY KEY,
+                    time timestamp,
+                    streamer_id integer REFERENCES cs_go_streamer (id),
+                    event json,
+                    keyframe_id integer
+                )
+            ''')
         await conn.execute('''
-            CREATE TABLE cs_go_gsi_events(
-                id serial PRIMARY KEY,
-                time timestamp,
-                streamer_id integer REFERENCES cs_go_streamer (id),
-                event json
-            )
+            CREATE INDEX ON cs_go_gsi_events (streamer_id, id)
         ''')
 
+    @staticmethod
+    async def is_partitioned(conn):
+        relkind = await conn.fetchval('''
+            SELECT relkind FROM pg_class WHERE relname = 'cs_go_gsi_events'
+        ''')
+        return relkind == 'p'
+
+    @staticmethod
+    async def maintain(conn, now, months_ahead=2, retention=None):
+        """Create upcoming partitions and apply retention.
+
+        retention is a timedelta, or None to keep events forever. Returns
+        the partitions dropped. Does nothing if another connection is
+        already maintaining the table.
+        """
+        async with conn.transaction():
+            locked = await conn.fetchval(
+                'SELECT pg_try_advisory_xact_lock($1)',
+                GSI_EVENT_MAINTENANCE_LOCK_ID
+            )
+            if not locked:
+                return []
+            if await CsGoGsiEvent.is_partitioned(conn):
+                await CsGoGsiEventPartition.ensure(conn, now, months_ahead)
+            if retention is None:
+                return []
+            return await CsGoGsiEvent.delete_older_than(conn, now - retention)
+
+    @staticmethod
+    async def delete_older_than(conn, cutoff):
+        """Remove events older than cutoff along with their map relations.
+
+        Partitioned tables have whole partitions dropped, which only
+        removes partitions entirely before cutoff. Otherwise rows are
+        deleted.
+        """
+        if await CsGoGsiEvent.is_partitioned(conn):
+            return await CsGoGsiEventPartition.drop_older_than(conn, cutoff)
+        await conn.execute('''
+            DELETE FROM cs_go_event_map_releation
+            WHERE event_id IN (
+                SELECT id FROM cs_go_gsi_events WHERE time < $1
+            )
+        ''', cutoff)
+        await conn.execute('''
+            DELETE FROM cs_go_gsi_events WHERE time < $1
+        ''', cutoff)
+        return []
+
     @staticmethod
     async def create(conn, time, streamer_id, event):
         row = await conn.fetchrow('''
@@ -225,48 +580,151 @@ class CsGoGsiEvent(object):
         ''', time, streamer_id, event)
         return CsGoGsiEvent(row['id'], row['time'], streamer_id, event)
 
+    @staticmethod
+    async def reserve_ids(conn, count):
+        """Reserve count ids from the table sequence, in ascending order."""
+        rows = await conn.fetch('''
+            SELECT nextval('cs_go_gsi_events_id_seq') AS id
+            FROM generate_series(1, $1)
+        ''', count)
+        return sorted(row['id'] for row in rows)
+
+    @staticmethod
+    async def create_many(conn, events, ids=None):
+        """Bulk insert (time, streamer_id, event) tuples with COPY.
+
+        Tuples may have a fourth keyframe_id item, in which case event is
+        a jsondelta patch against that keyframe. ids are reserved first if
+        not given so the returned events are in the same order as the
+        input. Returned events hold the text as stored.
+        """
+        if not events:
+            return []
+        if ids is None:
+            ids = await CsGoGsiEvent.reserve_ids(conn, len(events))
+        records = []
+        for id_, event in zip(ids, events):
+            keyframe_id = event[3] if len(event) > 3 else None
+            records.append((id_, event[0], event[1], event[2], keyframe_id))
+        await conn.copy_records_to_table(
+            'cs_go_gsi_events',
+            records=records,
+            columns=('id', 'time', 'streamer_id', 'event', 'keyframe_id')
+        )
+        return [CsGoGsiEvent(*record[:4]) for record in records]
+
     @staticmethod
     async def get_oldest_by_streamer_id(conn, streamer_id,
                                         limit=100, offset=0):
         evs = []
-        async for record in conn.cursor('''
+        async for record in _DeltaDecodingCursor(conn, conn.cursor('''
             SELECT * FROM cs_go_gsi_events
             WHERE streamer_id = $1
             ORDER BY id ASC
             LIMIT $2
             OFFSET $3
-        ''', streamer_id, limit, offset):
+        ''', streamer_id, limit, offset)):
             evs.append(CsGoGsiEvent.from_row(record))
         return evs
 
+    @staticmethod
+    async def get_next_by_streamer_id(conn, streamer_id, after_id=0,
+                                      limit=100, since=None):
+        """Get up to limit events with an id greater than after_id.
+
+        Pass the id of the last event returned to get the next page, and
+        its time as since so only partitions from then on are scanned.
+        """
+        if since is not None:
+            since -= EVENT_ORDER_SLACK
+        evs = []
+        async for record in CsGoGsiEvent.cursor_by_streamer_id(
+                conn, streamer_id, after_id=after_id, limit=limit,
+                since=since):
+            evs.append(CsGoGsiEvent(record['id'], record['time'],
+                                    streamer_id, record['event']))
+        return evs
+
     @staticmethod
     async def get_by_streamer_id(conn, streamer_id):
         events = []
-        async for record in conn.cursor('''
-            SELECT * FROM cs_go_gsi_events
-            WHERE streamer_id = $1
-        ''', streamer_id):
-            events.append(CsGoGsiEvent.from_row(record))
+        async for record in CsGoGsiEvent.cursor_by_streamer_id(conn,
+                                                               streamer_id):
+            events.append(CsGoGsiEvent(record['id'], record['time'],
+                                       streamer_id, record['event']))
         return events
 
     @staticmethod
     async def get_by_map_uuid(conn, map_uuid):
         events = []
-        async for record in conn.cursor('''
-            SELECT * FROM cs_go_gsi_events
+        async for record in await CsGoGsiEvent.cursor_by_map_uuid(conn,
+                                                                  map_uuid):
+            events.append(CsGoGsiEvent(record['id'], record['time'],
+                                       record['streamer_id'],
+                                       record['event']))
+        return events
+
+    @staticmethod
+    def cursor_by_streamer_id(conn, streamer_id, after_id=None, limit=None,
+                              since=None, until=None):
+        """Cursor over a streamer's events in id order.
+
+        Rows have id, time, streamer_id and event where event is the json
+        text of the full event. Must be iterated inside a transaction.
+        """
+        params = [streamer_id]
+        filters = _event_range_filter(params, after_id, since, until)
+        return _DeltaDecodingCursor(conn, conn.cursor('''
+            SELECT id, time, streamer_id, event, keyframe_id
+            FROM cs_go_gsi_events
+            WHERE streamer_id = $1%s
+            ORDER BY id ASC%s
+        ''' % (filters, _limit_clause(params, limit)), *params))
+
+    @staticmethod
+    async def cursor_by_map_uuid(conn, map_uuid, after_id=None, limit=None,
+                                 since=None, until=None):
+        """Cursor over a map's events in id order.
+
+        Rows have id, time, streamer_id and event where event is the json
+        text of the full event. Events are bounded by the map's start time
+        and the start of the streamer's next map, or now while the map is
+        being played, so only partitions from when the map was played are
+        scanned. Must be iterated inside a transaction.
+        """
+        map_ = await CsGoMap.get_by_uuid(conn, map_uuid)
+        end_time = await CsGoMap.get_end_time(conn, map_)
+        return CsGoGsiEvent.cursor_by_map(conn, map_, after_id, limit, since,
+                                          until, end_time)
+
+    @staticmethod
+    def cursor_by_map(conn, map_, after_id=None, limit=None, since=None,
+                      until=None, end_time=None):
+        """Like cursor_by_map_uuid() for an already loaded CsGoMap, with
+        end_time from CsGoMap.get_end_time().
+        """
+        if map_.start_time is not None:
+            map_since = map_.start_time - MAP_START_SLACK
+            if since is None or since < map_since:
+                since = map_since
+        if end_time is None:
+            end_time = datetime.datetime.now()
+        map_until = end_time + MAP_START_SLACK
+        if until is None or until > map_until:
+            until = map_until
+        params = [map_.id]
+        filters = _event_range_filter(params, after_id, since, until,
+                                      table='cs_go_gsi_events')
+        return _DeltaDecodingCursor(conn, conn.cursor('''
+            SELECT cs_go_gsi_events.id, cs_go_gsi_events.time,
+                   cs_go_gsi_events.streamer_id, cs_go_gsi_events.event,
+                   cs_go_gsi_events.keyframe_id
+            FROM cs_go_gsi_events
             INNER JOIN cs_go_event_map_releation
                 ON cs_go_event_map_releation.event_id = cs_go_gsi_events.id
-            INNER JOIN cs_go_map
-                ON cs_go_event_map_releation.map_id = cs_go_map.id
-            WHERE cs_go_map.uuid = $1
-        ''', map_uuid):
-            events.append(CsGoGsiEvent(
-                record['event_id'],
-                record['time'],
-                record['streamer_id'],
-                record['event']
-            ))
-        return events
+            WHERE cs_go_event_map_releation.map_id = $1%s
+            ORDER BY cs_go_gsi_events.id ASC%s
+        ''' % (filters, _limit_clause(params, limit)), *params))
 
     @staticmethod
     def from_row(row):
@@ -280,7 +738,202 @@ class CsGoGsiEvent(object):
         self.event = event
 
 
+class _DeltaDecodingCursor(object):
+    """Iterates over event rows, rebuilding delta encoded events.
+
+    Rows stored in full are passed through untouched. Rows with a
+    keyframe_id are returned as dicts with event replaced by the text of
+    the full event.
+    """
+    def __init__(self, conn, cursor):
+        self._conn = conn
+        self._cursor = cursor
+        self._iter = None
+        # Maps keyframe id to its text, or its document once parsed
+        self._keyframes = cache.LruCache(8)
+
+    def __aiter__(self):
+        self._iter = self._cursor.__aiter__()
+        return self
+
+    async def __anext__(self):
+        record = await self._iter.__anext__()
+        keyframe_id = record['keyframe_id']
+        if keyframe_id is None:
+            self._keyframes.put(record['id'], record['event'])
+            return record
+
+        row = dict(record.items())
+        keyframe = await self._get_keyframe(keyframe_id, record['time'])
+        if keyframe is None:
+            # The keyframe was removed by retention
+            row['event'] = None
+        else:
+            row['event'] = jsondelta.dumps(
+                jsondelta.apply(keyframe, json.loads(record['event']))
+            )
+        return row
+
+    async def _get_keyframe(self, keyframe_id, time):
+        keyframe = self._keyframes.get(keyframe_id)
+        if keyframe is None and time is not None:
+            # Keyframes are in the month of their patches, so only that
+            # month's partition is read
+            month_start = start_of_month(time)
+            keyframe = await self._conn.fetchval('''
+                SELECT event FROM cs_go_gsi_events
+                WHERE id = $1 AND time >= $2 AND time < $3
+            ''', keyframe_id, month_start, start_of_next_month(month_start))
+            if keyframe is None:
+                # Patches stored before keyframes were started monthly
+                keyframe = await self._conn.fetchval('''
+                    SELECT event FROM cs_go_gsi_events
+                    WHERE id = $1 AND time < $2
+                ''', keyframe_id, month_start)
+        elif keyframe is None:
+            keyframe = await self._conn.fetchval('''
+                SELECT event FROM cs_go_gsi_events WHERE id = $1
+            ''', keyframe_id)
+        if isinstance(keyframe, str):
+            keyframe = json.loads(keyframe)
+            self._keyframes.put(keyframe_id, keyframe)
+        return keyframe
+
+
+class CsGoGsiEventPartition(object):
+    """A monthly partition of cs_go_gsi_events.
+
+    start and end are None for a MINVALUE / MAXVALUE bound and for the
+    default partition.
+    """
+    DEFAULT_NAME = 'cs_go_gsi_events_default'
+
+    @staticmethod
+    def name_for(month_start):
+        return 'cs_go_gsi_events_y%04dm%02d' % (month_start.year,
+                                                month_start.month)
+
+    @staticmethod
+    async def create(conn, month_start):
+        end = start_of_next_month(month_start)
+        name = CsGoGsiEventPartition.name_for(month_start)
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS %s PARTITION OF cs_go_gsi_events
+            FOR VALUES FROM ('%s') TO ('%s')
+        ''' % (name, month_start, end))
+        return CsGoGsiEventPartition(name, month_start, end)
+
+    @staticmethod
+    async def create_default(conn):
+        """Catch events outside every monthly partition so inserts never
+        fail if maintenance falls behind.
+        """
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS %s PARTITION OF cs_go_gsi_events
+            DEFAULT
+        ''' % CsGoGsiEventPartition.DEFAULT_NAME)
+
+    @staticmethod
+    async def ensure(conn, now, months_ahead=2):
+        """Create partitions for the month of now and months_ahead after.
+
+        Months already covered by a partition, such as the one holding a
+        table's pre-partitioning data, are skipped.
+        """
+        existing = [partition
+                    for partition in await CsGoGsiEventPartition.get_all(conn)
+                    if not partition.is_default]
+        created = []
+        start = start_of_month(now)
+        for _ in range(months_ahead + 1):
+            end = start_of_next_month(start)
+            if not any(partition.overlaps(start, end)
+                       for partition in existing):
+                created.append(
+                    await CsGoGsiEventPartition.create(conn, start)
+                )
+            start = end
+        return created
+
+    @staticmethod
+    async def get_all(conn):
+        partitions = []
+        for record in await conn.fetch('''
+            SELECT child.relname AS name,
+                   pg_get_expr(child.relpartbound, child.oid) AS bound
+            FROM pg_inherits
+            INNER JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+            INNER JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+            WHERE parent.relname = 'cs_go_gsi_events'
+        '''):
+            partitions.append(CsGoGsiEventPartition.from_row(record))
+        return partitions
+
+    @staticmethod
+    async def drop_older_than(conn, cutoff):
+        """Drop every partition which only holds events before cutoff.
+
+        Old events which ended up in the default partition are deleted.
+        """
+        dropped = []
+        for partition in await CsGoGsiEventPartition.get_all(conn):
+            if partition.is_default:
+                await conn.execute('''
+                    DELETE FROM cs_go_event_map_releation
+                    WHERE event_id IN (
+                        SELECT id FROM %s WHERE time < $1
+                    )
+                ''' % partition.name, cutoff)
+                await conn.execute('''
+                    DELETE FROM %s WHERE time < $1
+                ''' % partition.name, cutoff)
+                continue
+            if partition.end is None or partition.end > cutoff:
+                continue
+            await conn.execute('''
+                DELETE FROM cs_go_event_map_releation
+                WHERE event_id IN (SELECT id FROM %s)
+            ''' % partition.name)
+            await conn.execute('DROP TABLE %s' % partition.name)
+            dropped.append(partition)
+        return dropped
+
+    @staticmethod
+    def from_row(row):
+        match = re.match(r"FOR VALUES FROM \((.*)\) TO \((.*)\)",
+                         row['bound'])
+        if match is None:
+            return CsGoGsiEventPartition(row['name'], None, None,
+                                         is_default=True)
+
+        def parse_bound(bound):
+            if bound == 'MINVALUE' or bound == 'MAXVALUE':
+                return None
+            return datetime.datetime.strptime(bound.strip("'")[:19],
+                                              '%Y-%m-%d %H:%M:%S')
+
+        return CsGoGsiEventPartition(row['name'],
+                                     parse_bound(match.group(1)),
+                                     parse_bound(match.group(2)))
+
+    def __init__(self, name, start, end, is_default=False):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.is_default = is_default
+
+    def overlaps(self, start, end):
+        return ((self.start is None or self.start < end) and
+                (self.end is None or self.end > start))
+
+
 class CsGoHltvEventType(object):
+    # Types of the events extracted from GSI
+    DEATH = 'death'
+    MONEY = 'money'
+    ROUND = 'round'
+    GSI_TYPES = (DEATH, MONEY, ROUND)
+
     @staticmethod
     async def create_schema(conn):
         await conn.execute('''
@@ -290,8 +943,28 @@ class CsGoHltvEventType(object):
             )
         ''')
 
+    @staticmethod
+    async def get_or_create_many(conn, names):
+        """Return a dict of the ids of names, creating missing types."""
+        await conn.execute('''
+            INSERT INTO cs_go_hltv_event_types (name)
+            SELECT unnest($1::text[])
+            ON CONFLICT (name) DO NOTHING
+        ''', sorted(names))
+        rows = await conn.fetch('''
+            SELECT id, name FROM cs_go_hltv_event_types
+            WHERE name = ANY($1::text[])
+        ''', list(names))
+        return dict((row['name'], row['id']) for row in rows)
+
 
 class CsGoHltvEvent(object):
+    """An event of a match, from an HLTV demo or extracted from GSI events.
+
+    Events extracted from GSI have the streamer, map and GSI event they
+    came from, the round they happened in and the player they are about,
+    if any. event holds the rest as json text.
+    """
     @staticmethod
     async def create_schema(conn):
         await conn.execute('''
@@ -300,9 +973,125 @@ class CsGoHltvEvent(object):
                 time timestamp,
                 replay_id integer REFERENCES replays (id),
                 type integer REFERENCES cs_go_hltv_event_types,
-                event json
+                event json,
+                streamer_id integer REFERENCES cs_go_streamer (id),
+                map_id integer REFERENCES cs_go_map (id),
+                gsi_event_id integer,
+                round integer,
+                steam_id integer REFERENCES cs_go_steam_ids (id)
             )
         ''')
+        await CsGoHltvEvent.create_indexes(conn)
+
+    @staticmethod
+    async def create_indexes(conn):
+        for name, columns in (
+                ('cs_go_hltv_events_streamer_id_type_id_idx',
+                 'streamer_id, type, id'),
+                ('cs_go_hltv_events_map_id_type_round_id_idx',
+                 'map_id, type, round, id'),
+                ('cs_go_hltv_events_steam_id_type_id_idx',
+                 'steam_id, type, id')):
+            await conn.execute('''
+                CREATE INDEX IF NOT EXISTS %s ON cs_go_hltv_events (%s)
+            ''' % (name, columns))
+
+    @staticmethod
+    async def reserve_ids(conn, count):
+        """Reserve count ids from the table sequence, in ascending order."""
+        rows = await conn.fetch('''
+            SELECT nextval('cs_go_hltv_events_id_seq') AS id
+            FROM generate_series(1, $1)
+        ''', count)
+        return sorted(row['id'] for row in rows)
+
+    @staticmethod
+    async def create_many(conn, events):
+        """Bulk insert (time, type, streamer_id, map_id, gsi_event_id,
+        round, steam_id, event) tuples with COPY.
+
+        Returns the ids of the events in the same order as the input.
+        """
+        if not events:
+            return []
+        ids = await CsGoHltvEvent.reserve_ids(conn, len(events))
+        await conn.copy_records_to_table(
+            'cs_go_hltv_events',
+            records=[(id_,) + tuple(event)
+                     for id_, event in zip(ids, events)],
+            columns=('id', 'time', 'type', 'streamer_id', 'map_id',
+                     'gsi_event_id', 'round', 'steam_id', 'event')
+        )
+        return ids
+
+    @staticmethod
+    async def get_log_version(conn, map_id, type_name, from_round, to_round):
+        """Summarise a map's events of a type for caching a log page.
+
+        Returns (count, max_id) of the events with from_round <= round <
+        to_round, which change whenever the page would, and the last round
+        with any event of the type.
+        """
+        row = await conn.fetchrow('''
+            SELECT count(*) FILTER (WHERE round >= $3 AND round < $4)
+                       AS count,
+                   max(id) FILTER (WHERE round >= $3 AND round < $4)
+                       AS max_id,
+                   max(round) AS last_round
+            FROM cs_go_hltv_events
+            WHERE map_id = $1 AND type = (
+                SELECT id FROM cs_go_hltv_event_types WHERE name = $2
+            )
+        ''', map_id, type_name, from_round, to_round)
+        return row['count'], row['max_id'], row['last_round']
+
+    @staticmethod
+    async def get_log(conn, map_id, type_name, from_round, to_round):
+        """Get a map's events of a type with from_round <= round <
+        to_round, in round then id order.
+
+        Rows have id, time, round, gsi_event_id, event, steam_id and, for
+        deaths, attacker and weapon.
+        """
+        return await conn.fetch('''
+            SELECT cs_go_hltv_events.id, cs_go_hltv_events.time,
+                   cs_go_hltv_events.round, cs_go_hltv_events.gsi_event_id,
+                   cs_go_hltv_events.event,
+                   players.steam_id, attackers.steam_id AS attacker,
+                   cs_go_death_events.weapon
+            FROM cs_go_hltv_events
+            LEFT JOIN cs_go_steam_ids players
+                ON players.id = cs_go_hltv_events.steam_id
+            LEFT JOIN cs_go_death_events
+                ON cs_go_death_events.hltv_event_id = cs_go_hltv_events.id
+            LEFT JOIN cs_go_steam_ids attackers
+                ON attackers.id = cs_go_death_events.attacker
+            WHERE cs_go_hltv_events.map_id = $1
+                AND cs_go_hltv_events.type = (
+                    SELECT id FROM cs_go_hltv_event_types WHERE name = $2
+                )
+                AND cs_go_hltv_events.round >= $3
+                AND cs_go_hltv_events.round < $4
+            ORDER BY cs_go_hltv_events.round, cs_go_hltv_events.id
+        ''', map_id, type_name, from_round, to_round)
+
+    @staticmethod
+    async def delete_by_streamer_id(conn, streamer_id, after_gsi_event_id=None,
+                                    last_gsi_event_id=None):
+        """Delete events extracted from a streamer's GSI events, optionally
+        only from those with ids in (after_gsi_event_id, last_gsi_event_id].
+        """
+        params = [streamer_id]
+        filters = ''
+        if after_gsi_event_id is not None:
+            params.append(after_gsi_event_id)
+            filters += ' AND gsi_event_id > $%d' % len(params)
+        if last_gsi_event_id is not None:
+            params.append(last_gsi_event_id)
+            filters += ' AND gsi_event_id <= $%d' % len(params)
+        await conn.execute('''
+            DELETE FROM cs_go_hltv_events WHERE streamer_id = $1%s
+        ''' % filters, *params)
 
 
 class CsGoSteamId(object):
@@ -315,8 +1104,27 @@ class CsGoSteamId(object):
             )
         ''')
 
+    @staticmethod
+    async def get_or_create_many(conn, steam_ids):
+        """Return a dict of the ids of steam_ids, creating missing ones."""
+        # Sorted so concurrent inserts of the same ids cannot deadlock
+        await conn.execute('''
+            INSERT INTO cs_go_steam_ids (steam_id)
+            SELECT unnest($1::text[])
+            ON CONFLICT (steam_id) DO NOTHING
+        ''', sorted(steam_ids))
+        rows = await conn.fetch('''
+            SELECT id, steam_id FROM cs_go_steam_ids
+            WHERE steam_id = ANY($1::text[])
+        ''', list(steam_ids))
+        return dict((row['steam_id'], row['id']) for row in rows)
+
 
 class CsGoDeathEvent(object):
+    """The attacker, victim and weapon of a death event.
+
+    attacker and weapon are NULL when they could not be worked out.
+    """
     @staticmethod
     async def create_schema(conn):
         await conn.execute('''
@@ -324,9 +1132,34 @@ class CsGoDeathEvent(object):
                 id serial PRIMARY KEY,
                 attacker integer REFERENCES cs_go_steam_ids (id),
                 victim integer REFERENCES cs_go_steam_ids (id),
-                weapon text
+                weapon text,
+                hltv_event_id integer UNIQUE
+                    REFERENCES cs_go_hltv_events (id) ON DELETE CASCADE
             )
         ''')
+        await CsGoDeathEvent.create_indexes(conn)
+
+    @staticmethod
+    async def create_indexes(conn):
+        await conn.execute('''
+            CREATE INDEX IF NOT EXISTS cs_go_death_events_attacker_idx
+            ON cs_go_death_events (attacker)
+        ''')
+        await conn.execute('''
+            CREATE INDEX IF NOT EXISTS cs_go_death_events_victim_idx
+            ON cs_go_death_events (victim)
+        ''')
+
+    @staticmethod
+    async def create_many(conn, deaths):
+        """Bulk insert (hltv_event_id, attacker, victim, weapon) tuples."""
+        if not deaths:
+            return
+        await conn.copy_records_to_table(
+            'cs_go_death_events',
+            records=deaths,
+            columns=('hltv_event_id', 'attacker', 'victim', 'weapon')
+        )
 
 
 class CsGoMap(object):
@@ -346,6 +1179,9 @@ class CsGoMap(object):
         await conn.execute('''
             CREATE UNIQUE INDEX ON cs_go_map (uuid)
         ''')
+        await conn.execute('''
+            CREATE INDEX ON cs_go_map (streamer_id, start_time)
+        ''')
 
     @staticmethod
     async def create(conn, uuid, start_time, streamer_id, map_name, team_1,
@@ -368,6 +1204,56 @@ class CsGoMap(object):
             maps.append(CsGoMap.from_row(record))
         return maps
 
+    @staticmethod
+    async def get_by_uuid(conn, uuid):
+        row = await conn.fetchrow('''
+            SELECT * FROM cs_go_map WHERE uuid = $1
+        ''', uuid)
+        if row is None:
+            raise NotFoundError()
+        return CsGoMap.from_row(row)
+
+    @staticmethod
+    async def get_latest_by_streamer_id(conn, streamer_id):
+        """Get the map a streamer started most recently."""
+        row = await conn.fetchrow('''
+            SELECT * FROM cs_go_map WHERE streamer_id = $1
+            ORDER BY start_time DESC, id DESC
+            LIMIT 1
+        ''', streamer_id)
+        if row is None:
+            raise NotFoundError()
+        return CsGoMap.from_row(row)
+
+    @staticmethod
+    async def get_end_time(conn, map_):
+        """Get when the streamer's next map started, which is when map_'s
+        events end. None while map_ is the latest.
+        """
+        if map_.start_time is None:
+            return None
+        return await conn.fetchval('''
+            SELECT min(start_time) FROM cs_go_map
+            WHERE streamer_id = $1 AND start_time > $2
+        ''', map_.streamer_id, map_.start_time)
+
+    @staticmethod
+    async def delete_by_streamer_id(conn, streamer_id):
+        """Delete a streamer's maps, their event relations and the events
+        extracted from them.
+        """
+        await conn.execute('''
+            DELETE FROM cs_go_event_map_releation
+            WHERE map_id IN (SELECT id FROM cs_go_map WHERE streamer_id = $1)
+        ''', streamer_id)
+        await conn.execute('''
+            DELETE FROM cs_go_hltv_events
+            WHERE map_id IN (SELECT id FROM cs_go_map WHERE streamer_id = $1)
+        ''', streamer_id)
+        await conn.execute('''
+            DELETE FROM cs_go_map WHERE streamer_id = $1
+        ''', streamer_id)
+
     @staticmethod
     def from_row(row):
         return CsGoMap(row['id'], row['uuid'], row['start_time'],
@@ -385,46 +1271,187 @@ class CsGoMap(object):
         self.team_2 = team_2
 
 
-class CsGoEventMapRelation(object):
+class CsGoMapHeatmap(object):
+    """The player position heatmap of a finished map.
+
+    counts is the grid_size * grid_size cell counts as little endian
+    unsigned 32 bit integers, row major from the top of the map.
+    """
     @staticmethod
     async def create_schema(conn):
         await conn.execute('''
-            CREATE TABLE cs_go_event_map_releation(
-                event_id integer REFERENCES cs_go_gsi_events (id),
-                map_id integer REFERENCES cs_go_map (id)
+            CREATE TABLE cs_go_map_heatmaps(
+                map_id integer PRIMARY KEY
+                    REFERENCES cs_go_map (id) ON DELETE CASCADE,
+                version integer NOT NULL,
+                grid_size integer NOT NULL,
+                min_x double precision NOT NULL,
+                min_y double precision NOT NULL,
+                max_x double precision NOT NULL,
+                max_y double precision NOT NULL,
+                samples integer NOT NULL,
+                counts bytea NOT NULL,
+                created_at timestamp
             )
         ''')
 
+    @staticmethod
+    async def save(conn, map_id, version, grid_size, bounds, samples,
+                   counts):
+        now = datetime.datetime.now()
+        min_x, min_y, max_x, max_y = bounds
+        values = (map_id, version, grid_size, min_x, min_y, max_x, max_y,
+                  samples, counts, now)
+        await conn.execute('''
+            INSERT INTO cs_go_map_heatmaps(map_id, version, grid_size,
+                                           min_x, min_y, max_x, max_y,
+                                           samples, counts, created_at)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
+            ON CONFLICT (map_id) DO UPDATE
+            SET version = EXCLUDED.version,
+                grid_size = EXCLUDED.grid_size,
+                min_x = EXCLUDED.min_x, min_y = EXCLUDED.min_y,
+                max_x = EXCLUDED.max_x, max_y = EXCLUDED.max_y,
+                samples = EXCLUDED.samples,
+                counts = EXCLUDED.counts,
+                created_at = EXCLUDED.created_at
+        ''', *values)
+        return CsGoMapHeatmap(map_id, version, grid_size, bounds, samples,
+                              counts, now)
+
+    @staticmethod
+    async def get_by_map_id(conn, map_id):
+        row = await conn.fetchrow('''
+            SELECT * FROM cs_go_map_heatmaps WHERE map_id = $1
+        ''', map_id)
+        if row is None:
+            raise NotFoundError()
+        return CsGoMapHeatmap(row['map_id'], row['version'],
+                              row['grid_size'],
+                              (row['min_x'], row['min_y'], row['max_x'],
+                               row['max_y']),
+                              row['samples'], row['counts'],
+                              row['created_at'])
+
+    def __init__(self, map_id, version, grid_size, bounds, samples, counts,
+                 created_at):
+        self.map_id = map_id
+        self.version = version
+        self.grid_size = grid_size
+        self.bounds = bounds
+        self.samples = samples
+        self.counts = counts
+        self.created_at = created_at
+
+
+class CsGoEventMapRelation(object):
+    @staticmethod
+    async def create_schema(conn):
+        if await CsGoGsiEvent.is_partitioned(conn):
+            # Foreign keys must reference the whole (id, time) primary key
+            # of a partitioned table, so event_id is left unconstrained.
+            await conn.execute('''
+                CREATE TABLE cs_go_event_map_releation(
+                    event_id integer,
+                    map_id integer REFERENCES cs_go_map (id)
+                )
+            ''')
+        else:
+            await conn.execute('''
+                CREATE TABLE cs_go_event_map_releation(
+                    event_id integer REFERENCES cs_go_gsi_events (id),
+                    map_id integer REFERENCES cs_go_map (id)
+                )
+            ''')
+        await conn.execute('''
+            CREATE INDEX ON cs_go_event_map_releation (event_id)
+        ''')
+        await conn.execute('''
+            CREATE INDEX ON cs_go_event_map_releation (map_id)
+        ''')
+        await conn.execute('''
+            CREATE UNIQUE INDEX ON cs_go_event_map_releation (event_id, map_id)
+        ''')
+
     @staticmethod
     async def create(conn, event_id, map_id):
         await conn.execute('''
             INSERT INTO cs_go_event_map_releation (event_id, map_id)
             VALUES ($1, $2)
+            ON CONFLICT DO NOTHING
         ''', event_id, map_id)
         return CsGoEventMapRelation(event_id, map_id)
 
     @staticmethod
-    async def get_oldest(conn, streamer_id, limit=100, offset=0):
+    async def create_many(conn, relations):
+        if not relations:
+            return []
+        await conn.copy_records_to_table(
+            'cs_go_event_map_releation',
+            records=relations,
+            columns=('event_id', 'map_id')
+        )
+        return [CsGoEventMapRelation(event_id, map_id)
+                for event_id, map_id in relations]
+
+    @staticmethod
+    async def create_many_missing(conn, relations):
+        """Bulk insert (event_id, map_id) pairs, skipping existing ones.
+
+        Unlike create_many this is safe to repeat. Returns the number of
+        relations inserted.
+        """
+        if not relations:
+            return 0
+        status = await conn.execute('''
+            INSERT INTO cs_go_event_map_releation (event_id, map_id)
+            SELECT * FROM unnest($1::integer[], $2::integer[])
+            ON CONFLICT DO NOTHING
+        ''', [event_id for event_id, _ in relations],
+            [map_id for _, map_id in relations])
+        return int(status.split()[-1])
+
+    @staticmethod
+    async def get_next(conn, streamer_id, after_id=0, limit=100, since=None):
+        """Get up to limit (event, map) pairs with an event id greater than
+        after_id, ordered by event id.
+
+        Pass the time of the event with after_id as since so only
+        partitions from then on are scanned.
+        """
+        params = [streamer_id]
+        if since is not None:
+            since -= EVENT_ORDER_SLACK
+        filters = _event_range_filter(params, after_id, since,
+                                      table='cs_go_gsi_events')
+        params.append(limit)
         ev_maps = []
-        async for record in conn.cursor('''
-            SELECT * FROM cs_go_gsi_events
+        async for record in _DeltaDecodingCursor(conn, conn.cursor('''
+            SELECT cs_go_gsi_events.id,
+                   cs_go_gsi_events.time,
+                   cs_go_gsi_events.event,
+                   cs_go_gsi_events.keyframe_id,
+                   cs_go_map.id AS map_id,
+                   cs_go_map.uuid AS map_uuid,
+                   cs_go_map.start_time,
+                   cs_go_map.map_name,
+                   cs_go_map.team_1,
+                   cs_go_map.team_2
+            FROM cs_go_gsi_events
             INNER JOIN cs_go_event_map_releation ON cs_go_gsi_events.id =
                        cs_go_event_map_releation.event_id
             INNER JOIN cs_go_map ON cs_go_event_map_releation.map_id =
                        cs_go_map.id
-            WHERE cs_go_gsi_events.streamer_id = $1
+            WHERE cs_go_gsi_events.streamer_id = $1%s
             ORDER BY cs_go_gsi_events.id ASC
-            LIMIT $2
-            OFFSET $3
-        ''', streamer_id, limit, offset):
-            ev = CsGoGsiEvent(conn, streamer_id,
-                              record['cs_go_gsi_events.time'],
-                              record['cs_go_gsi_events.event'])
-            map_ = CsGoMap(record['cs_go_map.start_time'],
-                           record['cs_go_map.streamer_id'],
-                           record['cs_go_map.map_name'],
-                           record['cs_go_map.team_1'],
-                           record['cs_go_map.team_2'])
+            LIMIT $%d
+        ''' % (filters, len(params)), *params)):
+            ev = CsGoGsiEvent(record['id'], record['time'],
+                              streamer_id, record['event'])
+            map_ = CsGoMap(record['map_id'], record['map_uuid'],
+                           record['start_time'], streamer_id,
+                           record['map_name'], record['team_1'],
+                           record['team_2'])
             ev_maps.append((ev, map_))
         return ev_maps
 
@@ -433,20 +1460,106 @@ class CsGoEventMapRelation(object):
         self.map_id = map_id
 
 
+class CsGoMapPopulatorCheckpoint(object):
+    """How far csgo_map_populator has got through a streamer's events.
+
+    map_state and tick_differ are the json of the MapState and TickDiffer
+    after the last event processed, and last_event_time is that event's
+    time.
+    """
+    @staticmethod
+    async def create_schema(conn):
+        await conn.execute('''
+            CREATE TABLE cs_go_map_populator_checkpoints(
+                streamer_id integer PRIMARY KEY
+                    REFERENCES cs_go_streamer (id),
+                last_event_id integer NOT NULL,
+                map_state json,
+                updated_at timestamp,
+                tick_differ json,
+                last_event_time timestamp
+            )
+        ''')
+
+    @staticmethod
+    async def get(conn, streamer_id):
+        row = await conn.fetchrow('''
+            SELECT * FROM cs_go_map_populator_checkpoints
+            WHERE streamer_id = $1
+        ''', streamer_id)
+        if row is None:
+            raise NotFoundError()
+        tick_differ = None
+        if row['tick_differ'] is not None:
+            tick_differ = json.loads(row['tick_differ'])
+        return CsGoMapPopulatorCheckpoint(row['streamer_id'],
+                                          row['last_event_id'],
+                                          json.loads(row['map_state']),
+                                          row['updated_at'],
+                                          tick_differ,
+                                          row['last_event_time'])
+
+    @staticmethod
+    async def save(conn, streamer_id, last_event_id, map_state,
+                   tick_differ=None, last_event_time=None):
+        now = datetime.datetime.now()
+        values = (streamer_id, last_event_id, json.dumps(map_state), now,
+                  json.dumps(tick_differ) if tick_differ is not None else None,
+                  last_event_time)
+        await conn.execute('''
+            INSERT INTO cs_go_map_populator_checkpoints(
+                streamer_id, last_event_id, map_state, updated_at,
+                tick_differ, last_event_time
+            )
+            VALUES ($1, $2, $3, $4, $5, $6)
+            ON CONFLICT (streamer_id) DO UPDATE
+            SET last_event_id = EXCLUDED.last_event_id,
+                map_state = EXCLUDED.map_state,
+                updated_at = EXCLUDED.updated_at,
+                tick_differ = EXCLUDED.tick_differ,
+                last_event_time = EXCLUDED.last_event_time
+        ''', *values)
+        return CsGoMapPopulatorCheckpoint(streamer_id, last_event_id,
+                                          map_state, now, tick_differ,
+                                          last_event_time)
+
+    @staticmethod
+    async def delete(conn, streamer_id):
+        await conn.execute('''
+            DELETE FROM cs_go_map_populator_checkpoints WHERE streamer_id = $1
+        ''', streamer_id)
+
+    def __init__(self, streamer_id, last_event_id, map_state, updated_at,
+                 tick_differ=None, last_event_time=None):
+        self.streamer_id = streamer_id
+        self.last_event_id = last_event_id
+        self.map_state = map_state
+        self.updated_at = updated_at
+        self.tick_differ = tick_differ
+        self.last_event_time = last_event_time
+
+
 async def create_schema(conn):
     await Game.create_schema(conn)
     await Replay.create_schema(conn)
-    await CsGoHltvEventType.create_schema(conn)
-    await CsGoHltvEvent.create_schema(conn)
-    await CsGoSteamId.create_schema(conn)
-    await CsGoDeathEvent.create_schema(conn)
+    await ReplayAnalysis.create_schema(conn)
+    await ReplayPlayer.create_schema(conn)
     await CsGoStreamer.create_schema(conn)
     await CsGoGsiEvent.create_schema(conn)
     await CsGoMap.create_schema(conn)
+    await CsGoHltvEventType.create_schema(conn)
+    await CsGoSteamId.create_schema(conn)
+    await CsGoHltvEvent.create_schema(conn)
+    await CsGoDeathEvent.create_schema(conn)
     await CsGoEventMapRelation.create_schema(conn)
+    await CsGoMapPopulatorCheckpoint.create_schema(conn)
+    await CsGoMapHeatmap.create_schema(conn)
 
 
 async def create_initial_records(conn):
     async with conn.transaction():
         await Game.create(conn, 'sc2', 'StarCraft 2')
         await Game.create(conn, 'cs:go', 'Counter Strike: Global Offensive')
+        await CsGoHltvEventType.get_or_create_many(
+            conn, CsGoHltvEventType.GSI_TYPES
+        )
@@ -2,28 +2,127 @@ import asyncio
 import collections
 from concurrent.futures import FIRST_COMPLETED
 import datetime
-# from enum import Enum
+from enum import Enum
+import itertools
 import json
+import logging
 import uuid
+import zlib
 
 from aiohttp import web
 import aiohttp_jinja2
 
+from cheeseshop import cache
 from cheeseshop import db
 from cheeseshop import dbapi
+from cheeseshop import jsondelta
+from cheeseshop.games import csgo_events
+from cheeseshop.games import csgo_heatmap
+from cheeseshop.games import csgo_ingest
 from cheeseshop.games import gameapi
+from cheeseshop import pubsub
+from cheeseshop import util
+
+
+LOG = logging.getLogger(__name__)
+
+# Events read with each db connection while streaming a replay
+EVENT_STREAM_PAGE_SIZE = 200
+# Rounds per page of the death and money logs, by default and at most
+EVENT_LOG_PAGE_ROUNDS = 5
+EVENT_LOG_MAX_PAGE_ROUNDS = 30
+# Responses to GSI events which were not accepted, by the reason, which the
+# streamer's owner sends back over the broker for events forwarded to it
+GSI_REJECTIONS = {
+    'full': (503, 'GSI ingest queue is full', {'Retry-After': '1'}),
+    'closed': (503, 'Shutting down', None),
+    'unavailable': (503, 'GSI broker is unavailable', {'Retry-After': '1'}),
+    'error': (500, 'Failed to ingest GSI event', None),
+}
+
+
+class ViewerPolicy(Enum):
+    # Keep up to max_pending messages, dropping the oldest when full
+    DROP_OLDEST = 'drop_oldest'
+    # Only ever keep the most recent message
+    LATEST = 'latest'
+
+
+# Viewers which ask for this websocket subprotocol get a snapshot of the
+# latest event when they join and then deltas. Others get every event in
+# full, as sent by the game.
+GSI_PROTOCOL_DELTA = 'cheeseshop.gsi.v2'
+
+
+class GsiFrame(object):
+    """An event as sent to viewers, in full or as a delta.
+
+    The delta against the previous event is only worked out if a viewer
+    needs it, and then only once however many viewers there are.
+    """
+    def __init__(self, seq, text, doc=None, previous_doc=None):
+        self.seq = seq
+        self.text = text
+        self._doc = doc
+        self._previous_doc = previous_doc
+        self._snapshot = None
+        self._delta = None
+
+    @property
+    def doc(self):
+        if self._doc is None:
+            self._doc = json.loads(self.text)
+        return self._doc
+
+    def snapshot(self):
+        if self._snapshot is None:
+            self._snapshot = '{"type":"snapshot","seq":%d,"state":%s}' % (
+                self.seq, self.text
+            )
+        return self._snapshot
+
+    def delta(self):
+        """Return the delta message against the previous event, or None if
+        there is none or it would not be smaller than a snapshot.
+        """
+        if self._delta is None and self._previous_doc is not None:
+            ops = jsondelta.diff(self._previous_doc, self.doc)
+            self._delta = '{"type":"delta","seq":%d,"ops":%s}' % (
+                self.seq, jsondelta.dumps(ops)
+            )
+            if len(self._delta) >= len(self.snapshot()):
+                self._delta = ''
+            self._previous_doc = None
+        return self._delta or None
 
 
 class GsiPlayer(object):
-    def __init__(self, request, streamer_id):
+    def __init__(self, request, streamer_id,
+                 policy=ViewerPolicy.DROP_OLDEST, max_pending=20,
+                 keyframe_interval=50):
         self._request = request
         self._streamer_id = streamer_id
         self._ws = None
-        self._event_queue = asyncio.Queue(maxsize=20)
+        self.policy = policy
+        if policy == ViewerPolicy.LATEST:
+            max_pending = 1
+        self._pending = collections.deque(maxlen=max_pending)
+        self._wakeup = asyncio.Event()
+        self._join_frame = None
+        self.keyframe_interval = keyframe_interval
+        self.protocol = None
+        self._last_seq = None
+        self._since_snapshot = 0
+        self.sent = 0
+        self.sent_bytes = 0
+        self.dropped = 0
 
     async def handle(self):
-        self._ws = web.WebSocketResponse()
+        self._ws = web.WebSocketResponse(protocols=(GSI_PROTOCOL_DELTA,))
         await self._ws.prepare(self._request)
+        self.protocol = self._ws.ws_protocol
+        if self.protocol == GSI_PROTOCOL_DELTA:
+            self._queue_join_frame()
 
         send_task = asyncio.ensure_future(self._send())
         listen_task = asyncio.ensure_future(self._listen())
@@ -35,18 +134,103 @@ class GsiPlayer(object):
 
         return self._ws
 
-    async def handle_event(self, gsi_event):
-        await self._event_queue.put(gsi_event)
+    def join(self, frame):
+        """Set the latest frame when the viewer joined, which delta
+        viewers start from.
+        """
+        self._join_frame = frame
+
+    def _queue_join_frame(self):
+        frame, self._join_frame = self._join_frame, None
+        if frame is None:
+            return
+        # Without room the oldest pending event is sent as a snapshot instead
+        if len(self._pending) < self._pending.maxlen:
+            self._pending.appendleft(frame)
+            self._wakeup.set()
+
+    def deliver(self, frame):
+        """Queue a frame without waiting on the viewer."""
+        if len(self._pending) == self._pending.maxlen:
+            self.dropped += 1
+        self._pending.append(frame)
+        self._wakeup.set()
+
+    def stats(self):
+        return {
+            'policy': self.policy.value,
+            'protocol': self.protocol,
+            'pending': len(self._pending),
+            'sent': self.sent,
+            'sent_bytes': self.sent_bytes,
+            'dropped': self.dropped
+        }
+
+    def _encode(self, frame):
+        if self.protocol != GSI_PROTOCOL_DELTA:
+            return frame.text
+        message = None
+        # After a drop, or on joining, there is nothing to apply a delta to
+        if self._last_seq == frame.seq - 1 and \
+                self._since_snapshot < self.keyframe_interval:
+            message = frame.delta()
+        self._last_seq = frame.seq
+        if message is None:
+            self._since_snapshot = 0
+            return frame.snapshot()
+        self._since_snapshot += 1
+        return message
 
     async def _send(self):
         while True:
-            self._ws.send_json(await self._event_queue.get())
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._pending:
+                message = self._encode(self._pending.popleft())
+                await self._ws.send_str(message)
+                self.sent += 1
+                self.sent_bytes += len(message)
 
     async def _listen(self):
         async for msg in self._ws:  # noqa: F841
             pass
 
 
+class GsiBroadcaster(object):
+    """Fans events out to every viewer of a GSI source.
+
+    publish() never awaits a viewer; each GsiPlayer buffers according to its
+    own policy and sends from its own task, so a slow viewer only affects
+    itself. The latest frame is kept for viewers which join later.
+    """
+    def __init__(self):
+        self.players = []
+        self.latest = None
+
+    def add(self, player):
+        player.join(self.latest)
+        self.players.append(player)
+
+    def remove(self, player):
+        self.players.remove(player)
+
+    def publish(self, message, doc=None):
+        """Publish the json text of an event, and optionally its already
+        decoded document.
+        """
+        if self.latest is None:
+            frame = GsiFrame(0, message, doc)
+        else:
+            frame = GsiFrame(self.latest.seq + 1, message, doc,
+                             self.latest.doc)
+        self.latest = frame
+        for player in self.players:
+            player.deliver(frame)
+
+    def stats(self):
+        return [player.stats() for player in self.players]
+
+
 class MapState(object):
     def __init__(self):
         self.phase = None
@@ -57,7 +241,45 @@ class MapState(object):
         self.uuid = None
         self.map = None
 
-    async def update(self, event, conn, streamer, event_id):
+    def dump(self):
+        """Return the state as a json serializable dict, see load()."""
+        return {
+            'phase': self.phase,
+            'name': self.name,
+            'team_ct': self.team_ct,
+            'team_t': self.team_t,
+            'map_uuid': self.map.uuid if self.map is not None else None
+        }
+
+    @staticmethod
+    async def load(conn, state):
+        """Rebuild a MapState from the output of dump()."""
+        map_state = MapState()
+        map_state.phase = state['phase']
+        map_state.name = state['name']
+        map_state.team_ct = state['team_ct']
+        map_state.team_t = state['team_t']
+        if state['map_uuid'] is not None:
+            map_state.map = await dbapi.CsGoMap.get_by_uuid(conn,
+                                                            state['map_uuid'])
+            map_state.uuid = map_state.map.uuid
+            map_state._db_created = True
+        return map_state
+
+    async def update(self, event, conn, streamer, event_id, time=None):
+        await self.advance(event, conn, streamer, time)
+        if self.map is not None:
+            await dbapi.CsGoEventMapRelation.create(conn, event_id,
+                                                    self.map.id)
+
+    async def advance(self, event, conn, streamer, time=None):
+        """Update the state from an event, creating a map if needed.
+
+        Returns the map the event belongs to, or None. Unlike update() this
+        does not link the event to the map so callers can batch that. time
+        is when the event was received and becomes the start time of any
+        new map.
+        """
         map_ = event.get('map', {})
         phase = map_.get('phase')
         name = map_.get('name')
@@ -74,16 +296,13 @@ class MapState(object):
         self.team_ct = team_ct
         self.team_t = team_t
 
-        await self._ensure_db(conn, streamer)
-
-        if self.map is not None:
-            await dbapi.CsGoEventMapRelation.create(conn, event_id,
-                                                    self.map.id)
+        await self._ensure_db(conn, streamer, time)
+        return self.map
 
-    async def _ensure_db(self, conn, streamer):
+    async def _ensure_db(self, conn, streamer, time=None):
         if self._db_created is False:
             if None not in (self.phase, self.name, self.team_t, self.team_ct):
-                await self.create_db_obj(conn, streamer)
+                await self.create_db_obj(conn, streamer, time)
                 self._db_created = True
 
     def is_new_map(self, phase, name, team_ct, team_t):
@@ -108,26 +327,285 @@ class MapState(object):
             return None
         return list(sorted((self.team_t, self.team_ct)))[1]
 
-    async def create_db_obj(self, conn, streamer):
+    async def create_db_obj(self, conn, streamer, time=None):
         self.uuid = str(uuid.uuid4())
         self.map = await dbapi.CsGoMap.create(
-            conn, self.uuid, datetime.datetime.now(), streamer.id, self.name,
-            self.team_1, self.team_2
+            conn, self.uuid, time or datetime.datetime.now(), streamer.id,
+            self.name, self.team_1, self.team_2
         )
         return self.map
 
 
+def streamer_worker(streamer_uuid, workers):
+    """Return the index of the webapp worker which owns a streamer.
+
+    Only the owner keeps the MapState of a streamer, so its events are
+    split into maps the same way whichever worker received them.
+    """
+    return zlib.crc32(streamer_uuid.encode()) % workers
+
+
 class GsiSource(object):
     def __init__(self):
         self.map_state = MapState()
+        self.tick_differ = csgo_events.TickDiffer()
         self.map_id = None
-        self.players = []
+        self.broadcaster = GsiBroadcaster()
+
+
+class StreamerCache(object):
+    """In memory lookup of streamers by uuid and id.
+
+    Misses fall back to the db. UUIDs which are not in the db are
+    remembered for negative_ttl seconds so repeated requests for them do
+    not reach the db either.
+    """
+    def __init__(self, sql_pool, max_size=1024, negative_ttl=30):
+        self.sql_pool = sql_pool
+        self.max_size = max_size
+        self.negative_ttl = negative_ttl
+        self._by_uuid = cache.LruCache(max_size)
+        self._by_id = cache.LruCache(max_size)
+        self._missing = cache.LruCache(max_size)
+
+    async def load(self):
+        async with self.sql_pool.acquire() as conn:
+            async with conn.transaction():
+                streamers = await dbapi.CsGoStreamer.get_all(conn)
+        for streamer in streamers[:self.max_size]:
+            self.add(streamer)
+
+    def add(self, streamer):
+        self._by_uuid.put(streamer.uuid, streamer)
+        self._by_id.put(streamer.id, streamer)
+        self._missing.pop(streamer.uuid)
+
+    async def get_by_uuid(self, streamer_uuid):
+        streamer = self._by_uuid.get(streamer_uuid)
+        if streamer is not None:
+            return streamer
+
+        loop = asyncio.get_event_loop()
+        expires = self._missing.get(streamer_uuid)
+        if expires is not None and expires > loop.time():
+            raise dbapi.NotFoundError()
+
+        try:
+            async with self.sql_pool.acquire() as conn:
+                streamer = await dbapi.CsGoStreamer.get_by_uuid(
+                    conn, streamer_uuid
+                )
+        except dbapi.NotFoundError:
+            self._missing.put(streamer_uuid, loop.time() + self.negative_ttl)
+            raise
+        self.add(streamer)
+        return streamer
+
+    async def get_by_id(self, streamer_id):
+        streamer = self._by_id.get(streamer_id)
+        if streamer is not None:
+            return streamer
+        async with self.sql_pool.acquire() as conn:
+            streamer = await dbapi.CsGoStreamer.get_by_id(conn, streamer_id)
+        self.add(streamer)
+        return streamer
 
 
 class CsGoApi(gameapi.GameApi):
-    def __init__(self, config, sql_pool):
+    """The CS:GO routes of one webapp worker.
+
+    With more than one worker, GSI events are passed to the other workers
+    through the broker at broker_path, so every worker's viewers get them.
+    Events a worker receives for a streamer it does not own are forwarded
+    to the owner, which stores them and replies whether it accepted them,
+    so the GSI client is told to retry events which were not stored.
+    """
+    def __init__(self, config, sql_pool, worker_index=0, broker_path=None):
         super(CsGoApi, self).__init__(config, sql_pool)
         self._gsi_sources = collections.defaultdict(GsiSource)
+        self.worker_index = worker_index
+        gsi_config = config.gsi
+        keyframe_interval = None
+        if gsi_config.event_storage == 'delta':
+            keyframe_interval = gsi_config.delta_keyframe_interval
+        event_store = None
+        if gsi_config.extract_events:
+            event_store = csgo_events.EventStore(
+                gsi_config.steam_id_cache_size
+            )
+        self.gsi_ingest = csgo_ingest.GsiIngestQueue(
+            sql_pool,
+            max_size=gsi_config.ingest_queue_size,
+            batch_size=gsi_config.ingest_batch_size,
+            flush_interval=gsi_config.ingest_flush_interval,
+            keyframe_interval=keyframe_interval,
+            on_map_over=self._on_map_over,
+            event_store=event_store,
+            retries=gsi_config.ingest_retries,
+            retry_interval=gsi_config.ingest_retry_interval
+        )
+        self.heatmaps = csgo_heatmap.HeatmapStore(
+            sql_pool, max_size=gsi_config.heatmap_cache_size
+        )
+        self.streamers = StreamerCache(
+            sql_pool,
+            max_size=gsi_config.streamer_cache_size,
+            negative_ttl=gsi_config.streamer_negative_ttl
+        )
+        self._maintenance_task = None
+        self.bus = None
+        self._bus_events = None
+        self._bus_task = None
+        self._forward_ids = itertools.count()
+        self._forwarded = {}
+        if broker_path is not None:
+            self.bus = pubsub.BrokerClient(broker_path, self._on_bus_message)
+            self._bus_events = asyncio.Queue(
+                maxsize=gsi_config.ingest_queue_size
+            )
+
+    async def start(self):
+        await self.streamers.load()
+        self.gsi_ingest.start()
+        if self.bus is not None:
+            self.bus.start()
+            self._bus_task = asyncio.ensure_future(
+                self._ingest_bus_events()
+            )
+        # Partitions are maintained by one worker
+        if self.worker_index == 0:
+            self._maintenance_task = asyncio.ensure_future(
+                self._maintain_events()
+            )
+
+    async def stop(self):
+        if self._maintenance_task is not None:
+            self._maintenance_task.cancel()
+        if self.bus is not None:
+            await self.bus.close()
+            self._bus_task.cancel()
+        await self.gsi_ingest.close()
+
+    def owns_streamer(self, streamer_uuid):
+        return streamer_worker(streamer_uuid,
+                               self.config.workers) == self.worker_index
+
+    def _on_bus_message(self, topic, body):
+        # Topics are "event <streamer uuid> <worker>" for events the owner
+        # accepted, which the worker that received them has already sent to
+        # its viewers, "ingest <streamer uuid> <worker> <request id>" for
+        # events forwarded to the owner, and "ack <worker> <request id>" for
+        # the owner's reply to a forwarded event
+        kind, *args = topic.split(' ')
+        if kind == 'ack':
+            self._on_ack(int(args[0]), int(args[1]), body)
+        elif kind == 'event':
+            if int(args[1]) != self.worker_index:
+                self._gsi_sources[args[0]].broadcaster.publish(
+                    body, json.loads(body)
+                )
+        elif kind == 'ingest' and self.owns_streamer(args[0]):
+            origin, request_id = int(args[1]), int(args[2])
+            try:
+                self._bus_events.put_nowait((args[0], body, origin,
+                                             request_id))
+            except asyncio.QueueFull:
+                self._ack(origin, request_id, 'full')
+
+    def _on_ack(self, worker_index, request_id, reason):
+        if worker_index != self.worker_index:
+            return
+        # Missing if we stopped waiting for it
+        future = self._forwarded.get(request_id)
+        if future is not None and not future.done():
+            future.set_result(reason)
+
+    def _ack(self, worker_index, request_id, reason):
+        self.bus.publish('ack %d %d' % (worker_index, request_id), reason)
+
+    async def _ingest_bus_events(self):
+        # One at a time, so events are queued in the order they arrived
+        while True:
+            streamer_uuid, event_text, origin, request_id = \
+                await self._bus_events.get()
+            try:
+                streamer = await self.streamers.get_by_uuid(streamer_uuid)
+                gsi_data = json.loads(event_text)
+                self.gsi_ingest.put(self._gsi_sources[streamer_uuid],
+                                    streamer, gsi_data, event_text)
+            except csgo_ingest.QueueFullError:
+                reason = 'full'
+            except csgo_ingest.QueueClosedError:
+                reason = 'closed'
+            except Exception:
+                LOG.exception('Failed to ingest GSI event of %s',
+                              streamer_uuid)
+                reason = 'error'
+            else:
+                reason = 'ok'
+                self._publish_accepted(streamer_uuid, event_text, gsi_data,
+                                       origin)
+            self._ack(origin, request_id, reason)
+
+    def _publish_accepted(self, streamer_uuid, event_text, gsi_data,
+                          origin):
+        """Send an event which will be stored to every worker's viewers,
+        other than those of origin, which sends it to them itself.
+        """
+        if origin != self.worker_index:
+            self._gsi_sources[streamer_uuid].broadcaster.publish(event_text,
+                                                                 gsi_data)
+        if self.bus is not None:
+            # Other workers' viewers only get it when the broker has room
+            self.bus.publish('event %s %d' % (streamer_uuid, origin),
+                             event_text)
+
+    async def _forward(self, streamer_uuid, event_text):
+        """Send a GSI event to the worker owning its streamer.
+
+        Returns 'ok' once the owner has queued it to be stored, otherwise
+        a key of GSI_REJECTIONS.
+        """
+        request_id = next(self._forward_ids)
+        topic = 'ingest %s %d %d' % (streamer_uuid, self.worker_index,
+                                     request_id)
+        if not self.bus.publish(topic, event_text):
+            return 'unavailable'
+        future = asyncio.get_event_loop().create_future()
+        self._forwarded[request_id] = future
+        try:
+            # The broker may drop the event or the owner's reply
+            return await asyncio.wait_for(future,
+                                          self.config.gsi.forward_timeout)
+        except asyncio.TimeoutError:
+            return 'unavailable'
+        finally:
+            del self._forwarded[request_id]
+
+    def _on_map_over(self, map_):
+        asyncio.ensure_future(self.heatmaps.store(map_.uuid))
+
+    async def _maintain_events(self):
+        gsi_config = self.config.gsi
+        retention = None
+        if gsi_config.event_retention_days is not None:
+            retention = datetime.timedelta(
+                days=gsi_config.event_retention_days
+            )
+        while True:
+            try:
+                async with self.sql_pool.acquire() as conn:
+                    dropped = await dbapi.CsGoGsiEvent.maintain(
+                        conn, datetime.datetime.now(),
+                        months_ahead=gsi_config.partition_months_ahead,
+                        retention=retention
+                    )
+                for partition in dropped:
+                    LOG.info('Dropped GSI event partition %s',
+                             partition.name)
+            except Exception:
+                LOG.exception('GSI event maintenance failed')
+            await asyncio.sleep(gsi_config.maintenance_interval)
 
     def add_routes(self, router):
         router.add_post('/games/csgo/gsi/sources/{streamer_uuid}/input',
@@ -136,6 +614,8 @@ class CsGoApi(gameapi.GameApi):
                        self._handle_play_gsi)
         router.add_get('/games/csgo/gsi/sources/{streamer_uuid}/replay',
                        self._handle_replay_gsi)
+        router.add_get('/games/csgo/gsi/sources/{streamer_uuid}/viewers',
+                       self._handle_gsi_viewers)
         router.add_get('/games/csgo/gsi/sources',
                        self._handle_get_gsi_source)
         router.add_post('/games/csgo/gsi/sources',
@@ -146,17 +626,29 @@ class CsGoApi(gameapi.GameApi):
                        self._handle_gsi_map_replay)
         router.add_get('/games/csgo/gsi/maps/{map_uuid}/position_heatmap',
                        self._handle_gsi_map_heatmap)
+        router.add_get('/games/csgo/gsi/maps/{map_uuid}/heatmap',
+                       self._handle_gsi_map_heatmap_grid)
         router.add_get('/games/csgo/gsi/sources/{streamer_uuid}/deathlog',
                        self._handle_gsi_deathlog)
         router.add_get('/games/csgo/gsi/sources/{streamer_uuid}/moneylog',
                        self._handle_gsi_moneylog)
+        for log, handler in (('deathlog', self._handle_gsi_deathlog_events),
+                             ('moneylog', self._handle_gsi_moneylog_events)):
+            router.add_get(
+                '/games/csgo/gsi/sources/{streamer_uuid}/%s/events' % log,
+                handler
+            )
+            router.add_get('/games/csgo/gsi/maps/{map_uuid}/%s/events' % log,
+                           handler)
 
     @aiohttp_jinja2.template('csgo_deathlog.html')
     async def _handle_gsi_deathlog(self, request):
         streamer_uuid = request.match_info.get('streamer_uuid')
         ws_url = '/games/csgo/gsi/sources/%s/play' % streamer_uuid
         return {
-            'gsi_websocket_url': ws_url
+            'gsi_websocket_url': ws_url,
+            'events_url': '/games/csgo/gsi/sources/%s/deathlog/events'
+                          % streamer_uuid
         }
 
     @aiohttp_jinja2.template('csgo_moneylog.html')
@@ -164,73 +656,330 @@ class CsGoApi(gameapi.GameApi):
         streamer_uuid = request.match_info.get('streamer_uuid')
         ws_url = '/games/csgo/gsi/sources/%s/play' % streamer_uuid
         return {
-            'gsi_websocket_url': ws_url
+            'gsi_websocket_url': ws_url,
+            'events_url': '/games/csgo/gsi/sources/%s/moneylog/events'
+                          % streamer_uuid
         }
 
-    @aiohttp_jinja2.template('get_upload.html')
-    @db.with_transaction
-    async def _handle_input_gsi(self, conn, request):
-        streamer_uuid = request.match_info.get('streamer_uuid')
-        streamer = await dbapi.CsGoStreamer.get_by_uuid(conn, streamer_uuid)
-
-        gsi_data = await request.json()
-        gsi_source = self._gsi_sources[streamer_uuid]
-        event = await dbapi.CsGoGsiEvent.create(conn,
-                                                datetime.datetime.now(),
-                                                streamer.id,
-                                                json.dumps(gsi_data))
-        await gsi_source.map_state.update(gsi_data, conn, streamer,
-                                          event.id)
+    async def _handle_gsi_deathlog_events(self, request):
+        return await self._handle_gsi_event_log(
+            dbapi.CsGoHltvEventType.DEATH, request
+        )
 
-        for player in gsi_source.players:
-            await player.handle_event(gsi_data)
+    async def _handle_gsi_moneylog_events(self, request):
+        return await self._handle_gsi_event_log(
+            dbapi.CsGoHltvEventType.MONEY, request
+        )
 
-        return {}
+    async def _handle_gsi_event_log(self, event_type, request):
+        """Serve a page of rounds of a map's death or money events.
+
+        Maps are given by uuid, or for a streamer are the map they started
+        most recently. ?from_round= and ?rounds= select the page, and
+        next_round in the response is the from_round of the next page or
+        null on the last. last_gsi_timestamp is the provider timestamp of
+        the newest GSI event the page's events came from, so live events up
+        to it can be skipped. Responses have an ETag so unchanged pages can
+        be revalidated with If-None-Match without reading the events.
+        """
+        from_round, to_round = self._get_round_range(request)
+        streamer = None
+        if 'streamer_uuid' in request.match_info:
+            streamer = await self._get_streamer(request)
+        async with self.sql_pool.acquire() as conn:
+            map_ = await self._get_event_log_map(conn, request, streamer)
+            if map_ is None:
+                return web.json_response({'map_uuid': None, 'events': [],
+                                          'next_round': None,
+                                          'last_gsi_timestamp': None})
+
+            count, max_id, last_round = \
+                await dbapi.CsGoHltvEvent.get_log_version(
+                    conn, map_.id, event_type, from_round, to_round
+                )
+            etag = '"%d-%s-%d-%d-%d-%d-%d"' % (
+                map_.id, event_type, from_round, to_round, count,
+                max_id or 0, -1 if last_round is None else last_round
+            )
+            headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+            if_none_match = request.headers.get('If-None-Match', '')
+            if etag in [tag.strip() for tag in if_none_match.split(',')]:
+                return web.Response(status=304, headers=headers)
+            rows = await dbapi.CsGoHltvEvent.get_log(conn, map_.id,
+                                                     event_type, from_round,
+                                                     to_round)
+
+        next_round = None
+        if last_round is not None and last_round >= to_round:
+            next_round = to_round
+        events = [self._event_log_item(event_type, row) for row in rows]
+        last_gsi_timestamp = None
+        if events:
+            last = max(events, key=lambda item: item['gsi_event_id'] or 0)
+            last_gsi_timestamp = last.get('gsi_timestamp')
+        return web.json_response({
+            'map_uuid': map_.uuid,
+            'events': events,
+            'next_round': next_round,
+            'last_gsi_timestamp': last_gsi_timestamp
+        }, headers=headers)
+
+    def _get_round_range(self, request):
+        try:
+            from_round = int(request.query.get('from_round', 0))
+            rounds = int(request.query.get('rounds', EVENT_LOG_PAGE_ROUNDS))
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=str(e))
+        if from_round < 0 or not 0 < rounds <= EVENT_LOG_MAX_PAGE_ROUNDS:
+            raise web.HTTPBadRequest(
+                text='from_round must not be negative and rounds must be '
+                     'from 1 to %d' % EVENT_LOG_MAX_PAGE_ROUNDS
+            )
+        return from_round, from_round + rounds
+
+    async def _get_event_log_map(self, conn, request, streamer=None):
+        """Get the map of an event log, or None if the streamer has none."""
+        if streamer is not None:
+            try:
+                return await dbapi.CsGoMap.get_latest_by_streamer_id(
+                    conn, streamer.id
+                )
+            except dbapi.NotFoundError:
+                return None
+        try:
+            return await dbapi.CsGoMap.get_by_uuid(
+                conn, request.match_info['map_uuid']
+            )
+        except dbapi.NotFoundError:
+            raise web.HTTPNotFound(text='Unknown map')
+
+    @staticmethod
+    def _event_log_item(event_type, row):
+        item = json.loads(row['event'])
+        item.update({
+            'id': row['id'],
+            'time': str(row['time']),
+            'round': row['round'],
+            'gsi_event_id': row['gsi_event_id'],
+            'steam_id': row['steam_id']
+        })
+        if event_type == dbapi.CsGoHltvEventType.DEATH:
+            item['attacker'] = row['attacker']
+            item['weapon'] = row['weapon']
+        return item
+
+    async def _get_streamer(self, request):
+        streamer_uuid = request.match_info.get('streamer_uuid')
+        try:
+            return await self.streamers.get_by_uuid(streamer_uuid)
+        except dbapi.NotFoundError:
+            raise web.HTTPNotFound(text='Unknown GSI source')
+
+    async def _handle_input_gsi(self, request):
+        streamer = await self._get_streamer(request)
+        event_text = await request.text()
+        gsi_data = json.loads(event_text)
+        gsi_source = self._gsi_sources[streamer.uuid]
+
+        if self.owns_streamer(streamer.uuid):
+            # Events are written to the db in batches by the ingest queue
+            try:
+                self.gsi_ingest.put(gsi_source, streamer, gsi_data,
+                                    event_text)
+            except csgo_ingest.QueueFullError:
+                return self._gsi_rejected('full')
+            except csgo_ingest.QueueClosedError:
+                return self._gsi_rejected('closed')
+            self._publish_accepted(streamer.uuid, event_text, gsi_data,
+                                   self.worker_index)
+        else:
+            # Viewers only get events the owner accepted, once
+            reason = await self._forward(streamer.uuid, event_text)
+            if reason != 'ok':
+                return self._gsi_rejected(reason)
+
+        gsi_source.broadcaster.publish(event_text, gsi_data)
+
+        return web.Response()
+
+    @staticmethod
+    def _gsi_rejected(reason):
+        status, text, headers = GSI_REJECTIONS[reason]
+        return web.Response(text=text, status=status, headers=headers)
 
     async def _handle_play_gsi(self, request):
-        streamer_uuid = request.match_info.get('streamer_uuid')
-        player = GsiPlayer(request, streamer_uuid)
+        streamer = await self._get_streamer(request)
+        streamer_uuid = streamer.uuid
+        try:
+            policy = ViewerPolicy(request.query.get('policy', 'drop_oldest'))
+        except ValueError:
+            return web.Response(text='Unknown viewer policy', status=400)
+        player = GsiPlayer(
+            request, streamer_uuid, policy=policy,
+            keyframe_interval=self.config.gsi.viewer_keyframe_interval
+        )
+        broadcaster = self._gsi_sources[streamer_uuid].broadcaster
         try:
-            self._gsi_sources[streamer_uuid].players.append(player)
+            broadcaster.add(player)
             return await player.handle()
         finally:
-            self._gsi_sources[streamer_uuid].players.remove(player)
+            broadcaster.remove(player)
 
-    @db.with_transaction
-    async def _handle_replay_gsi(self, conn, request):
-        streamer_uuid = request.match_info.get('streamer_uuid')
-        streamer = await dbapi.CsGoStreamer.get_by_uuid(conn, streamer_uuid)
-        events = await dbapi.CsGoGsiEvent.get_by_streamer_id(conn, streamer.id)
-        dict_events = []
-        for event in events:
-            time_str = str(event.time)
-            dict_events.append({
-                'time': time_str,
-                'event': json.loads(event.event)
-            })
-        return web.json_response(dict_events)
+    async def _handle_gsi_viewers(self, request):
+        """Stats of the viewers connected to this worker."""
+        streamer = await self._get_streamer(request)
+        broadcaster = self._gsi_sources[streamer.uuid].broadcaster
+        return web.json_response(broadcaster.stats())
 
-    @db.with_transaction
-    async def _handle_gsi_map_replay(self, conn, request):
+    async def _handle_replay_gsi(self, request):
+        streamer = await self._get_streamer(request)
+        event_range = self._get_event_range(request)
+
+        def cursor(conn, **page_range):
+            return dbapi.CsGoGsiEvent.cursor_by_streamer_id(
+                conn, streamer.id, **page_range
+            )
+        return await self._stream_events(request, cursor, event_range)
+
+    async def _handle_gsi_map_replay(self, request):
         map_uuid = request.match_info.get('map_uuid')
-        events = await dbapi.CsGoGsiEvent.get_by_map_uuid(conn, map_uuid)
-        dict_events = []
-        for event in events:
-            time_str = str(event.time)
-            dict_events.append({
-                'time': time_str,
-                'event': json.loads(event.event)
-            })
-        return web.json_response(dict_events)
+        event_range = self._get_event_range(request)
+        async with self.sql_pool.acquire() as conn:
+            try:
+                map_ = await dbapi.CsGoMap.get_by_uuid(conn, map_uuid)
+            except dbapi.NotFoundError:
+                raise web.HTTPNotFound(text='Unknown map')
+            end_time = await dbapi.CsGoMap.get_end_time(conn, map_)
+
+        def cursor(conn, **page_range):
+            return dbapi.CsGoGsiEvent.cursor_by_map(conn, map_,
+                                                    end_time=end_time,
+                                                    **page_range)
+        return await self._stream_events(request, cursor, event_range)
+
+    def _get_event_range(self, request):
+        query = request.query
+
+        def param(name, parse):
+            if name not in query:
+                return None
+            return parse(query[name])
+
+        try:
+            event_range = {
+                'after_id': param('after_id', int),
+                'limit': param('limit', int),
+                'since': param('since', util.parse_time),
+                'until': param('until', util.parse_time)
+            }
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=str(e))
+        if event_range['limit'] is not None and event_range['limit'] < 0:
+            raise web.HTTPBadRequest(text='limit must not be negative')
+        return event_range
+
+    async def _stream_events(self, request, cursor, event_range):
+        """Stream event rows as a JSON array, or NDJSON if ?format=ndjson.
+
+        cursor(conn, after_id, limit, since, until) returns a cursor over
+        the events. They are read a page at a time from after the last id
+        of the previous page, and no db connection is held while a page is
+        written, so slow clients do not use up the pool. The stored event
+        json is passed through as is rather than being decoded and encoded
+        again.
+        """
+        ndjson = request.query.get('format') == 'ndjson'
+        resp = web.StreamResponse()
+        if ndjson:
+            resp.content_type = 'application/x-ndjson'
+        else:
+            resp.content_type = 'application/json'
+        await resp.prepare(request)
+
+        page_range = dict(event_range)
+        first = True
+        if not ndjson:
+            await resp.write(b'[')
+        while page_range['limit'] != 0:
+            page = await self._read_event_page(cursor, page_range)
+            if not page:
+                break
+            items = [self._event_item(record) for record in page]
+            if ndjson:
+                text = '\n'.join(items) + '\n'
+            else:
+                text = ','.join(items)
+                if not first:
+                    text = ',' + text
+            first = False
+            await resp.write(text.encode())
+        if not ndjson:
+            await resp.write(b']')
+        await resp.write_eof()
+        return resp
+
+    async def _read_event_page(self, cursor, page_range):
+        """Read the next page of events and move page_range past it."""
+        limit = EVENT_STREAM_PAGE_SIZE
+        if page_range['limit'] is not None:
+            limit = min(limit, page_range['limit'])
+        page = []
+        async with self.sql_pool.acquire() as conn:
+            async with conn.transaction():
+                async for record in cursor(conn, **dict(page_range,
+                                                        limit=limit)):
+                    page.append(record)
+        if len(page) < limit:
+            # The last page
+            page_range['limit'] = 0
+        else:
+            page_range['after_id'] = page[-1]['id']
+            if page_range['limit'] is not None:
+                page_range['limit'] -= len(page)
+        return page
+
+    @staticmethod
+    def _event_item(record):
+        return '{"id": %d, "time": %s, "event": %s}' % (
+            record['id'],
+            json.dumps(str(record['time'])),
+            record['event'] or 'null'
+        )
 
     @aiohttp_jinja2.template('csgo_position_heatmap.html')
     async def _handle_gsi_map_heatmap(self, request):
         map_uuid = request.match_info.get('map_uuid')
-        ws_url = '/games/csgo/gsi/maps/%s/replay' % map_uuid
         return {
-            'gsi_websocket_url': ws_url
+            'heatmap_url': '/games/csgo/gsi/maps/%s/heatmap' % map_uuid
         }
 
+    async def _handle_gsi_map_heatmap_grid(self, request):
+        """Serve a map's position heatmap as JSON, or with ?format=binary
+        as the raw grid counts with the rest in headers.
+        """
+        map_uuid = request.match_info.get('map_uuid')
+        output_format = request.query.get('format', 'json')
+        if output_format not in ('json', 'binary'):
+            raise web.HTTPBadRequest(text='format must be json or binary')
+        try:
+            heatmap = await self.heatmaps.get(map_uuid)
+        except dbapi.NotFoundError:
+            raise web.HTTPNotFound(text='Unknown map')
+        if output_format == 'json':
+            return web.json_response(heatmap.to_dict())
+        return web.Response(
+            body=heatmap.counts_bytes(),
+            content_type='application/octet-stream',
+            headers={
+                'X-Heatmap-Map-Name': heatmap.map_name or '',
+                'X-Heatmap-Grid-Size': str(heatmap.grid_size),
+                'X-Heatmap-Bounds': ','.join(str(bound)
+                                             for bound in heatmap.bounds),
+                'X-Heatmap-Samples': str(heatmap.samples),
+                'X-Heatmap-Complete': str(heatmap.complete).lower()
+            }
+        )
+
     @aiohttp_jinja2.template('get_gsi.html')
     @db.with_transaction
     async def _handle_get_gsi_source(self, conn, request):
@@ -240,13 +989,17 @@ class CsGoApi(gameapi.GameApi):
         }
 
     @aiohttp_jinja2.template('post_gsi_source.html')
-    @db.with_transaction
-    async def _handle_post_gsi_source(self, conn, request):
+    async def _handle_post_gsi_source(self, request):
         req_data = await request.post()
         name = req_data['source_name']
         streamer_uuid = uuid.uuid4()
-        streamer = await dbapi.CsGoStreamer.create(conn, str(streamer_uuid),
-                                                   name)
+        async with self.sql_pool.acquire() as conn:
+            async with conn.transaction():
+                streamer = await dbapi.CsGoStreamer.create(
+                    conn, str(streamer_uuid), name
+                )
+        # Cached once committed, as a rolled back streamer does not exist
+        self.streamers.add(streamer)
         return {
             'streamer': streamer,
             'streamer_gsi_url': self._url_for_streamer(streamer)
@@ -0,0 +1,224 @@
+import collections
+import json
+
+from cheeseshop import cache
+from cheeseshop import dbapi
+
+
+ExtractedEvent = collections.namedtuple(
+    'ExtractedEvent',
+    ('type', 'round', 'steam_id', 'data', 'attacker', 'weapon')
+)
+
+
+def _players(event):
+    """Return a dict of the players in an event by steam id.
+
+    Spectators get every player in allplayers, players only themselves.
+    """
+    players = event.get('allplayers')
+    if isinstance(players, dict):
+        return players
+    player = event.get('player')
+    if isinstance(player, dict) and 'steamid' in player:
+        return {player['steamid']: player}
+    return {}
+
+
+def _active_weapon(player):
+    for weapon in (player.get('weapons') or {}).values():
+        if weapon.get('state') == 'active':
+            return weapon.get('name')
+    return None
+
+
+def _increase(previous, current):
+    if previous is None or current is None:
+        return 0
+    return max(current - previous, 0)
+
+
+class TickDiffer(object):
+    """Turn a streamer's GSI events into death, money and round events.
+
+    Each event is compared with the state of the previous one, so events
+    must be passed to diff() in the order they were received. State is
+    reset when the map changes, as match stats start again from zero.
+    """
+    def __init__(self):
+        self.map_id = None
+        self.round_phase = None
+        self.players = {}
+
+    def dump(self):
+        """Return the state as a json serializable dict, see load()."""
+        return {
+            'map_id': self.map_id,
+            'round_phase': self.round_phase,
+            'players': self.players
+        }
+
+    @staticmethod
+    def load(state):
+        differ = TickDiffer()
+        differ.map_id = state['map_id']
+        differ.round_phase = state['round_phase']
+        differ.players = state['players']
+        return differ
+
+    def diff(self, event, map_id=None):
+        """Return the ExtractedEvents between the last event and this one.
+
+        The attacker and weapon of a death are only known when exactly one
+        player died and one player got a kill in the same tick. Data has the
+        event's provider timestamp as gsi_timestamp, so viewers can tell
+        which live events they already have.
+        """
+        if map_id != self.map_id:
+            self.map_id = map_id
+            self.round_phase = None
+            self.players = {}
+
+        round_ = (event.get('map') or {}).get('round')
+        extracted = self._diff_round(event, round_)
+        extracted.extend(self._diff_players(event, round_))
+        timestamp = (event.get('provider') or {}).get('timestamp')
+        if timestamp is not None:
+            for item in extracted:
+                item.data['gsi_timestamp'] = timestamp
+        return extracted
+
+    def _diff_round(self, event, round_):
+        round_state = event.get('round') or {}
+        phase = round_state.get('phase')
+        if phase is None or phase == self.round_phase:
+            return []
+        self.round_phase = phase
+        data = {'phase': phase}
+        if 'win_team' in round_state:
+            data['win_team'] = round_state['win_team']
+        return [ExtractedEvent(dbapi.CsGoHltvEventType.ROUND, round_, None,
+                               data, None, None)]
+
+    def _diff_players(self, event, round_):
+        extracted = []
+        victims = []
+        killers = []
+        players = _players(event)
+        for steam_id, player in sorted(players.items()):
+            match_stats = player.get('match_stats') or {}
+            current = {
+                'kills': match_stats.get('kills'),
+                'deaths': match_stats.get('deaths'),
+                'money': (player.get('state') or {}).get('money')
+            }
+            previous = self.players.get(steam_id)
+            self.players[steam_id] = current
+            if previous is None:
+                continue
+            deaths = _increase(previous['deaths'], current['deaths'])
+            victims.extend([steam_id] * deaths)
+            if _increase(previous['kills'], current['kills']):
+                killers.append(steam_id)
+            if None not in (previous['money'], current['money']) and \
+                    previous['money'] != current['money']:
+                extracted.append(ExtractedEvent(
+                    dbapi.CsGoHltvEventType.MONEY, round_, steam_id, {
+                        'name': player.get('name'),
+                        'team': player.get('team'),
+                        'money': current['money'],
+                        'change': current['money'] - previous['money']
+                    }, None, None
+                ))
+
+        attacker = weapon = None
+        if len(victims) == 1 and len(killers) == 1:
+            attacker = killers[0]
+            weapon = _active_weapon(players[attacker])
+        for victim in victims:
+            data = {
+                'name': players[victim].get('name'),
+                'team': players[victim].get('team')
+            }
+            if attacker is not None:
+                data['attacker_name'] = players[attacker].get('name')
+            extracted.append(ExtractedEvent(
+                dbapi.CsGoHltvEventType.DEATH, round_, victim, data,
+                attacker, weapon
+            ))
+        return extracted
+
+
+class SteamIdCache(object):
+    """Interned db ids of steam ids, so each is only looked up once.
+
+    Ids created in a transaction which is rolled back do not exist, so
+    clear() the cache when that happens.
+    """
+    def __init__(self, max_size=65536):
+        self._ids = cache.LruCache(max_size)
+
+    async def get_ids(self, conn, steam_ids):
+        ids = {}
+        missing = set()
+        for steam_id in steam_ids:
+            id_ = self._ids.get(steam_id)
+            if id_ is None:
+                missing.add(steam_id)
+            else:
+                ids[steam_id] = id_
+        if missing:
+            created = await dbapi.CsGoSteamId.get_or_create_many(conn,
+                                                                 missing)
+            for steam_id, id_ in created.items():
+                self._ids.put(steam_id, id_)
+            ids.update(created)
+        return ids
+
+    def clear(self):
+        self._ids.clear()
+
+
+class EventStore(object):
+    """Bulk writer of extracted events."""
+    def __init__(self, steam_id_cache_size=65536):
+        self.steam_ids = SteamIdCache(steam_id_cache_size)
+        self._type_ids = None
+
+    async def write(self, conn, rows):
+        """Store (time, streamer_id, map_id, gsi_event_id, ExtractedEvent)
+        tuples.
+        """
+        if not rows:
+            return
+        if self._type_ids is None:
+            self._type_ids = await dbapi.CsGoHltvEventType.get_or_create_many(
+                conn, dbapi.CsGoHltvEventType.GSI_TYPES
+            )
+        steam_ids = set()
+        for _, _, _, _, extracted in rows:
+            steam_ids.update(steam_id for steam_id in (extracted.steam_id,
+                                                       extracted.attacker)
+                             if steam_id is not None)
+        ids = await self.steam_ids.get_ids(conn, steam_ids)
+
+        events = []
+        for time, streamer_id, map_id, gsi_event_id, extracted in rows:
+            events.append((time, self._type_ids[extracted.type], streamer_id,
+                           map_id, gsi_event_id, extracted.round,
+                           ids.get(extracted.steam_id),
+                           json.dumps(extracted.data)))
+        event_ids = await dbapi.CsGoHltvEvent.create_many(conn, events)
+
+        deaths = []
+        for event_id, row in zip(event_ids, rows):
+            extracted = row[4]
+            if extracted.type == dbapi.CsGoHltvEventType.DEATH:
+                deaths.append((event_id, ids.get(extracted.attacker),
+                               ids[extracted.steam_id], extracted.weapon))
+        await dbapi.CsGoDeathEvent.create_many(conn, deaths)
+
+    def clear(self):
+        """Forget cached ids, after a write was rolled back."""
+        self.steam_ids.clear()
+        self._type_ids = None
@@ -0,0 +1,306 @@
+import array
+import asyncio
+import json
+import logging
+import math
+import sys
+
+from cheeseshop import cache
+from cheeseshop import dbapi
+
+
+LOG = logging.getLogger(__name__)
+
+# Cells along each side of the square grid
+GRID_SIZE = 64
+# Stored heatmaps of a different version are rebuilt
+HEATMAP_VERSION = 1
+# Positions of maps without a radar are kept until there are this many,
+# then binned against bounds which grow to fit later positions
+MAX_PENDING_POSITIONS = 1024
+# Radar images are RADAR_SIZE pixels square
+RADAR_SIZE = 1024
+# (pos_x, pos_y, scale) from each map's resource/overviews/<map>.txt: the
+# world coordinates of the top left corner of its radar and the world units
+# per radar pixel. Other maps are bounded by the positions seen instead.
+MAP_OVERVIEWS = {
+    'de_ancient': (-2953, 2164, 5.0),
+    'de_cache': (-2000, 3250, 5.5),
+    'de_cbble': (-3840, 3072, 6.0),
+    'de_dust2': (-2476, 3239, 4.4),
+    'de_inferno': (-2087, 3870, 4.9),
+    'de_mirage': (-3230, 1713, 5.0),
+    'de_nuke': (-3453, 2887, 7.0),
+    'de_overpass': (-4831, 1781, 5.2),
+    'de_train': (-2477, 2392, 4.7),
+    'de_vertigo': (-3168, 1762, 4.0),
+}
+
+
+def overview_bounds(map_name):
+    """Return (min_x, min_y, max_x, max_y) of a map's radar, or None."""
+    overview = MAP_OVERVIEWS.get(map_name)
+    if overview is None:
+        return None
+    pos_x, pos_y, scale = overview
+    size = RADAR_SIZE * scale
+    return (pos_x, pos_y - size, pos_x + size, pos_y)
+
+
+def event_positions(event):
+    """Yield the (x, y) position of each player in an event.
+
+    Only spectators get allplayers, whose positions are "x, y, z" strings.
+    """
+    for player in (event.get('allplayers') or {}).values():
+        try:
+            x, y, _ = player['position'].split(',')
+            x, y = float(x), float(y)
+        except (KeyError, AttributeError, ValueError):
+            continue
+        if math.isfinite(x) and math.isfinite(y):
+            yield x, y
+
+
+class Heatmap(object):
+    """Counts of player positions in a grid_size x grid_size grid.
+
+    counts is row major with row 0 at max_y, the top of the radar, and
+    column 0 at min_x. complete is True once the map reached gameover.
+    """
+    def __init__(self, map_name, grid_size, bounds, counts, samples,
+                 complete):
+        self.map_name = map_name
+        self.grid_size = grid_size
+        self.bounds = bounds
+        self.counts = counts
+        self.samples = samples
+        self.complete = complete
+
+    def to_dict(self):
+        """Return the grid as a json serializable dict.
+
+        Only cells with a count are included, as [column, row, count].
+        """
+        cells = []
+        for i, count in enumerate(self.counts):
+            if count:
+                cells.append([i % self.grid_size, i // self.grid_size,
+                              count])
+        return {
+            'map_name': self.map_name,
+            'grid_size': self.grid_size,
+            'bounds': list(self.bounds),
+            'samples': self.samples,
+            'max': max(self.counts) if self.counts else 0,
+            'complete': self.complete,
+            'radar': self.map_name in MAP_OVERVIEWS,
+            'cells': cells
+        }
+
+    def counts_bytes(self):
+        """Return the counts as little endian unsigned 32 bit integers."""
+        counts = array.array('I', self.counts)
+        if sys.byteorder != 'little':
+            counts.byteswap()
+        return counts.tobytes()
+
+    @staticmethod
+    def counts_from_bytes(data):
+        counts = array.array('I')
+        counts.frombytes(data)
+        if sys.byteorder != 'little':
+            counts.byteswap()
+        return counts
+
+
+class HeatmapBuilder(object):
+    """Bin the player positions of a map's events, one event at a time.
+
+    Maps with a known radar are binned against its bounds as events are
+    added. For other maps the first max_pending positions are kept to find
+    bounds fitting them, then binned; the bounds are doubled whenever a
+    later position falls outside them, merging the counts into the larger
+    cells, so memory does not grow with the length of the map.
+    """
+    def __init__(self, map_name, grid_size=GRID_SIZE,
+                 max_pending=MAX_PENDING_POSITIONS):
+        self.map_name = map_name
+        self.grid_size = grid_size
+        self.max_pending = max_pending
+        self.bounds = overview_bounds(map_name)
+        self.counts = self._empty_counts()
+        self.samples = 0
+        self.complete = False
+        self.last_event_id = None
+        self._growable = self.bounds is None
+        self._xs = array.array('d')
+        self._ys = array.array('d')
+
+    def add(self, event, event_id=None):
+        if (event.get('map') or {}).get('phase') == 'gameover':
+            self.complete = True
+        if event_id is not None:
+            self.last_event_id = event_id
+        for x, y in event_positions(event):
+            self._add_position(x, y)
+
+    def _add_position(self, x, y):
+        if self.bounds is None:
+            self._xs.append(x)
+            self._ys.append(y)
+            if len(self._xs) >= self.max_pending:
+                self.bounds, self.counts = self._bin_pending()
+                self.samples = len(self._xs)
+                self._xs = array.array('d')
+                self._ys = array.array('d')
+            return
+        if self._growable:
+            self._grow(x, y)
+        if self._bin(self.counts, self.bounds, x, y):
+            self.samples += 1
+
+    def _empty_counts(self):
+        return array.array('I', bytes(4 * self.grid_size * self.grid_size))
+
+    def _bin(self, counts, bounds, x, y, count=1):
+        min_x, min_y, max_x, max_y = bounds
+        if not (min_x <= x <= max_x and min_y <= y <= max_y):
+            return False
+        last = self.grid_size - 1
+        col = min(int((x - min_x) * self.grid_size / (max_x - min_x)), last)
+        row = min(int((max_y - y) * self.grid_size / (max_y - min_y)), last)
+        counts[row * self.grid_size + col] += count
+        return True
+
+    def _bin_pending(self):
+        """Return bounds fitting the kept positions and their counts."""
+        counts = self._empty_counts()
+        if not self._xs:
+            return (0, 0, 0, 0), counts
+        # Square bounds, so cells are square like those of a radar
+        min_x, max_x = min(self._xs), max(self._xs)
+        min_y, max_y = min(self._ys), max(self._ys)
+        size = max(max_x - min_x, max_y - min_y, 1.0)
+        bounds = (min_x, max_y - size, min_x + size, max_y)
+        for x, y in zip(self._xs, self._ys):
+            self._bin(counts, bounds, x, y)
+        return bounds, counts
+
+    def _grow(self, x, y):
+        """Double the bounds towards (x, y) until they contain it."""
+        min_x, min_y, max_x, max_y = self.bounds
+        if min_x <= x <= max_x and min_y <= y <= max_y:
+            return
+        while not (min_x <= x <= max_x and min_y <= y <= max_y):
+            size = max_x - min_x
+            if x < min_x:
+                min_x -= size
+            else:
+                max_x += size
+            if y < min_y:
+                min_y -= size
+            else:
+                max_y += size
+
+        # Move each count to the cell holding the centre of its old cell
+        old_min_x, _, old_max_x, old_max_y = self.bounds
+        cell_size = (old_max_x - old_min_x) / self.grid_size
+        bounds = (min_x, min_y, max_x, max_y)
+        counts = self._empty_counts()
+        for i, count in enumerate(self.counts):
+            if count:
+                self._bin(counts, bounds,
+                          old_min_x + (i % self.grid_size + 0.5) * cell_size,
+                          old_max_y - (i // self.grid_size + 0.5) * cell_size,
+                          count)
+        self.bounds = bounds
+        self.counts = counts
+
+    def heatmap(self):
+        if self.bounds is None:
+            bounds, counts = self._bin_pending()
+            return Heatmap(self.map_name, self.grid_size, bounds, counts,
+                           len(self._xs), self.complete)
+        return Heatmap(self.map_name, self.grid_size, self.bounds,
+                       array.array('I', self.counts), self.samples,
+                       self.complete)
+
+
+class _CacheEntry(object):
+    def __init__(self, map_name):
+        self.lock = asyncio.Lock()
+        self.builder = HeatmapBuilder(map_name)
+        self.heatmap = None
+
+
+class HeatmapStore(object):
+    """Heatmaps of maps by uuid, kept in memory and in the db.
+
+    Heatmaps of maps still being played are built from the map's events
+    and extended with only the new events on the next request. Once a map
+    reaches gameover its heatmap is stored so it is never built again.
+    """
+    def __init__(self, sql_pool, max_size=128):
+        self.sql_pool = sql_pool
+        self._entries = cache.LruCache(max_size)
+
+    async def get(self, map_uuid):
+        """Return the heatmap of a map, raising NotFoundError if unknown."""
+        entry = self._entries.get(map_uuid)
+        if entry is not None and entry.heatmap is not None:
+            return entry.heatmap
+        async with self.sql_pool.acquire() as conn:
+            map_ = await dbapi.CsGoMap.get_by_uuid(conn, map_uuid)
+            if entry is None:
+                entry = self._entries.get(map_uuid)
+            if entry is None:
+                entry = _CacheEntry(map_.map_name)
+                self._entries.put(map_uuid, entry)
+            async with entry.lock:
+                if entry.heatmap is None:
+                    await self._update(conn, map_, entry)
+        return entry.heatmap or entry.builder.heatmap()
+
+    async def _update(self, conn, map_, entry):
+        if entry.builder.last_event_id is None:
+            stored = await self._get_stored(conn, map_)
+            if stored is not None:
+                entry.heatmap = stored
+                return
+
+        builder = entry.builder
+        async with conn.transaction():
+            cursor = await dbapi.CsGoGsiEvent.cursor_by_map_uuid(
+                conn, map_.uuid, after_id=builder.last_event_id
+            )
+            async for record in cursor:
+                builder.add(json.loads(record['event'] or 'null') or {},
+                            record['id'])
+
+        if builder.complete:
+            heatmap = builder.heatmap()
+            await dbapi.CsGoMapHeatmap.save(
+                conn, map_.id, HEATMAP_VERSION, heatmap.grid_size,
+                heatmap.bounds, heatmap.samples, heatmap.counts_bytes()
+            )
+            entry.heatmap = heatmap
+            entry.builder = None
+
+    async def _get_stored(self, conn, map_):
+        try:
+            row = await dbapi.CsGoMapHeatmap.get_by_map_id(conn, map_.id)
+        except dbapi.NotFoundError:
+            return None
+        if row.version != HEATMAP_VERSION:
+            return None
+        return Heatmap(map_.map_name, row.grid_size, row.bounds,
+                       Heatmap.counts_from_bytes(row.counts), row.samples,
+                       True)
+
+    async def store(self, map_uuid):
+        """Build and store the heatmap of a map which reached gameover."""
+        try:
+            await self.get(map_uuid)
+        except Exception:
+            LOG.exception('Failed to store heatmap of map %s', map_uuid)
@@ -0,0 +1,212 @@
+import asyncio
+import collections
+import copy
+import datetime
+import logging
+
+from cheeseshop import dbapi
+from cheeseshop import jsondelta
+
+
+LOG = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class QueueClosedError(Exception):
+    pass
+
+
+GsiIngestItem = collections.namedtuple(
+    'GsiIngestItem',
+    ('gsi_source', 'streamer', 'time', 'gsi_data', 'event_text')
+)
+
+
+class GsiIngestQueue(object):
+    """Write-behind queue for incoming GSI events.
+
+    Events are buffered in memory and written in bulk whenever batch_size
+    events are waiting or flush_interval seconds have passed, whichever
+    comes first. The queue is bounded; put() raises QueueFullError rather
+    than growing without limit.
+
+    If keyframe_interval is set events are stored as jsondelta patches
+    against a keyframe, which is started every keyframe_interval events
+    per streamer.
+
+    on_map_over is called with each map which reached gameover once the
+    events which ended it have been written.
+
+    If event_store is set death, money and round events are extracted
+    with each source's tick_differ and written with it in the same
+    transaction as the GSI events.
+
+    A batch which fails to be written is retried up to retries times,
+    waiting retry_interval seconds and then twice as long each time, with
+    the map state and tick differ of its sources as they were before it.
+    Events keep being queued meanwhile, until the queue is full.
+    """
+    def __init__(self, sql_pool, max_size=10000, batch_size=500,
+                 flush_interval=0.5, keyframe_interval=None,
+                 on_map_over=None, event_store=None, retries=5,
+                 retry_interval=0.5):
+        self.sql_pool = sql_pool
+        self.retries = retries
+        self.retry_interval = retry_interval
+        self.on_map_over = on_map_over
+        self.event_store = event_store
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.keyframe_interval = keyframe_interval
+        self._encoders = {}
+        self._queue = asyncio.Queue(maxsize=max_size)
+        self._closing = False
+        self._flush_task = None
+
+    def start(self):
+        self._flush_task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        """Stop accepting events and wait for queued ones to be written."""
+        self._closing = True
+        if self._flush_task is not None:
+            await self._flush_task
+            self._flush_task = None
+
+    def put(self, gsi_source, streamer, gsi_data, event_text):
+        if self._closing:
+            raise QueueClosedError()
+        item = GsiIngestItem(gsi_source, streamer,
+                             datetime.datetime.now(), gsi_data, event_text)
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            raise QueueFullError()
+
+    async def join(self):
+        """Wait until every event put so far has been written."""
+        await self._queue.join()
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    async def _run(self):
+        while not (self._closing and self._queue.empty()):
+            batch = await self._next_batch()
+            if batch:
+                await self._flush(batch)
+
+    async def _next_batch(self):
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.flush_interval
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                item = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            batch.append(item)
+        return batch
+
+    async def _flush(self, batch):
+        try:
+            delay = self.retry_interval
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    await asyncio.sleep(delay)
+                    delay *= 2
+                if await self._try_flush(batch):
+                    return
+            LOG.error('Dropped %d GSI events after %d attempts', len(batch),
+                      self.retries + 1)
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+    async def _try_flush(self, batch):
+        """Write a batch, returning whether it was written."""
+        states = self._save_states(batch)
+        try:
+            async with self.sql_pool.acquire() as conn:
+                async with conn.transaction():
+                    finished_maps = await self._write(conn, batch)
+        except Exception:
+            LOG.exception('Failed to write %d GSI events', len(batch))
+            # Maps, keyframes and steam ids from this batch were never
+            # stored
+            for source, map_state, tick_differ in states:
+                source.map_state = map_state
+                source.tick_differ = tick_differ
+            for item in batch:
+                self._encoders.pop(item.streamer.id, None)
+            if self.event_store is not None:
+                self.event_store.clear()
+            return False
+        if self.on_map_over is not None:
+            for map_ in finished_maps:
+                self.on_map_over(map_)
+        return True
+
+    @staticmethod
+    def _save_states(batch):
+        """Return copies of the state of the sources of a batch."""
+        states = {}
+        for item in batch:
+            source = item.gsi_source
+            if id(source) not in states:
+                states[id(source)] = (source, copy.copy(source.map_state),
+                                      copy.deepcopy(source.tick_differ))
+        return list(states.values())
+
+    async def _write(self, conn, batch):
+        ids = await dbapi.CsGoGsiEvent.reserve_ids(conn, len(batch))
+        rows = []
+        for id_, item in zip(ids, batch):
+            text, keyframe_id = item.event_text, None
+            if self.keyframe_interval is not None:
+                text, keyframe_id = self._get_encoder(item.streamer).encode(
+                    id_, item.gsi_data, item.event_text, item.time
+                )
+            rows.append((item.time, item.streamer.id, text, keyframe_id))
+        events = await dbapi.CsGoGsiEvent.create_many(conn, rows, ids=ids)
+
+        relations = []
+        finished_maps = []
+        extracted_rows = []
+        for item, event in zip(batch, events):
+            map_state = item.gsi_source.map_state
+            was_over = map_state.phase == 'gameover'
+            map_ = await map_state.advance(
+                item.gsi_data, conn, item.streamer, item.time
+            )
+            map_id = None
+            if map_ is not None:
+                map_id = map_.id
+                relations.append((event.id, map_.id))
+                if map_state.phase == 'gameover' and not was_over:
+                    finished_maps.append(map_)
+            if self.event_store is not None:
+                for extracted in item.gsi_source.tick_differ.diff(
+                        item.gsi_data, map_id):
+                    extracted_rows.append((item.time, item.streamer.id,
+                                           map_id, event.id, extracted))
+        await dbapi.CsGoEventMapRelation.create_many(conn, relations)
+        if self.event_store is not None:
+            await self.event_store.write(conn, extracted_rows)
+        return finished_maps
+
+    def _get_encoder(self, streamer):
+        encoder = self._encoders.get(streamer.id)
+        if encoder is None:
+            encoder = jsondelta.KeyframeEncoder(self.keyframe_interval)
+            self._encoders[streamer.id] = encoder
+        return encoder
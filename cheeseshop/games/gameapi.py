@@ -2,3 +2,9 @@ class GameApi(object):
     def __init__(self, config, sql_pool):
         self.config = config
         self.sql_pool = sql_pool
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
@@ -0,0 +1,112 @@
+"""Compact patches between JSON documents.
+
+A patch is a list of operations. [path, value] sets the key at path to
+value, adding it if needed, and [path] removes it. path is a list of object
+keys; an empty path replaces the whole document. Lists are compared and
+replaced as a whole.
+"""
+import json
+
+
+def diff(old, new):
+    """Return a patch which turns old into new."""
+    ops = []
+    _diff(old, new, [], ops)
+    return ops
+
+
+def _diff(old, new, path, ops):
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key, value in new.items():
+            if key in old:
+                _diff(old[key], value, path + [key], ops)
+            else:
+                ops.append([path + [key], value])
+        for key in old:
+            if key not in new:
+                ops.append([path + [key]])
+    # 1 == 1.0 == True in python but not in json
+    elif type(old) is not type(new) or old != new:
+        ops.append([path, new])
+
+
+def apply(doc, ops):
+    """Return doc with the patch ops applied.
+
+    doc is not modified. Only the objects along changed paths are copied,
+    everything else is shared with doc.
+    """
+    result = doc
+    copied = set()
+
+    def copy(obj):
+        if id(obj) in copied:
+            return obj
+        obj = dict(obj)
+        copied.add(id(obj))
+        return obj
+
+    for op in ops:
+        path = op[0]
+        if not path:
+            result = op[1]
+            continue
+        result = copy(result)
+        parent = result
+        for key in path[:-1]:
+            child = copy(parent[key])
+            parent[key] = child
+            parent = child
+        if len(op) > 1:
+            parent[path[-1]] = op[1]
+        else:
+            del parent[path[-1]]
+    return result
+
+
+def dumps(obj):
+    return json.dumps(obj, separators=(',', ':'))
+
+
+class KeyframeEncoder(object):
+    """Encodes a stream of documents as keyframes plus patches.
+
+    Every document after a keyframe is stored as a patch against that
+    keyframe, so any one of them can be rebuilt from two rows. A new
+    keyframe is started every keyframe_interval documents, whenever a
+    patch would not be smaller than the document itself and at the start
+    of every month, so a patch is always in the same monthly partition as
+    its keyframe and outlives it by no more than the partition does.
+    """
+    def __init__(self, keyframe_interval=50):
+        self.keyframe_interval = keyframe_interval
+        self.reset()
+
+    def reset(self):
+        self.keyframe_id = None
+        self._keyframe = None
+        self._keyframe_month = None
+        self._since_keyframe = 0
+
+    def encode(self, doc_id, doc, text, time=None):
+        """Return (stored text, keyframe id) for a document.
+
+        keyframe id is None when the document is stored in full. time is
+        when the document is stored, if it is partitioned by month.
+        """
+        month = None
+        if time is not None:
+            month = (time.year, time.month)
+        if (self._keyframe is not None and
+                self._since_keyframe < self.keyframe_interval and
+                month == self._keyframe_month):
+            patch = dumps(diff(self._keyframe, doc))
+            if len(patch) < len(text):
+                self._since_keyframe += 1
+                return patch, self.keyframe_id
+
+        self.keyframe_id = doc_id
+        self._keyframe = doc
+        self._keyframe_month = month
+        self._since_keyframe = 0
+        return text, None
@@ -1,22 +1,43 @@
 import argparse
 import asyncio
+import logging
 import os
+import shutil
+import signal
+import socket
 import sys
+import tempfile
 import uuid
 
 from aiohttp import web
 import aiohttp_jinja2
 import jinja2
 
+from cheeseshop import cache
 from cheeseshop import config as cs_config
 from cheeseshop import db
 from cheeseshop import dbapi
 from cheeseshop.games import csgo
+from cheeseshop import migrations
 from cheeseshop import objectstoreapi
+from cheeseshop import pubsub
 from cheeseshop import swift
 from cheeseshop import util
 
 
+# Largest form field other than the replay file accepted on upload
+MAX_UPLOAD_FIELD_SIZE = 4096
+# Replays the sha1sum bloom filter is sized for
+REPLAY_HASH_CAPACITY = 1000000
+# Swift response headers passed on to clients downloading a replay
+DOWNLOAD_PROXY_HEADERS = ('Content-Type', 'Content-Range', 'ETag',
+                          'Last-Modified')
+# Seconds between checks of whether a worker process has exited
+WORKER_POLL_INTERVAL = 0.5
+
+LOG = logging.getLogger(__name__)
+
+
 def parse_args(args):
     parser = argparse.ArgumentParser(description='cheeseshop webapp.')
     parser.add_argument('config_file', type=str,
@@ -26,32 +47,65 @@ def parse_args(args):
 
 
 class App(object):
-    def __init__(self, config, sql_pool):
+    def __init__(self, config, sql_pool, worker_index=0, broker_path=None):
         self.config = config
         self.sql_pool = sql_pool
 
-        self._csgo_api = csgo.CsGoApi(self.config, self.sql_pool)
+        self._csgo_api = csgo.CsGoApi(self.config, self.sql_pool,
+                                      worker_index=worker_index,
+                                      broker_path=broker_path)
+        self._keystone = None
+        self._http_session = None
+        # Sha1sums of stored replays, used to skip duplicate lookups
+        self._replay_hashes = cache.BloomFilter(REPLAY_HASH_CAPACITY)
 
     def add_routes(self, router):
         router.add_get('/upload', self.handle_get_upload)
         router.add_post('/upload', self.handle_post_upload)
         router.add_get('/list_replays', self.handle_list_replays)
+        router.add_get('/replays/{uuid}/download',
+                       self.handle_get_replay_download)
+        router.add_get('/replays/{uuid}/players',
+                       self.handle_get_replay_players)
+        router.add_get('/replays/{uuid}/analyses/{analysis}',
+                       self.handle_get_replay_analysis)
         router.add_static('/static/',
                           path=os.path.dirname(__file__) + '/static',
                           name='static')
 
         self._csgo_api.add_routes(router)
 
-    def run(self):
+    def make_web_app(self):
         web_app = web.Application()
         self.add_routes(web_app.router)
+        web_app.on_startup.append(self.on_startup)
+        web_app.on_cleanup.append(self.on_cleanup)
 
         aiohttp_jinja2.setup(
             web_app,
             loader=jinja2.PackageLoader('cheeseshop', 'templates')
         )
+        return web_app
+
+    def run(self, sock=None):
+        web_app = self.make_web_app()
+        if sock is None:
+            web.run_app(web_app, host=self.config.host,
+                        port=self.config.port)
+        else:
+            web.run_app(web_app, sock=sock)
+
+    async def on_startup(self, web_app):
+        self._http_session = swift.create_http_session(self.config.swift)
+        await self._load_replay_hashes()
+        await self._csgo_api.start()
 
-        web.run_app(web_app, host=self.config.host, port=self.config.port)
+    async def on_cleanup(self, web_app):
+        # Runs once in-flight requests are done so queued GSI events drain
+        await self._csgo_api.stop()
+        if self._keystone is not None:
+            await self._keystone.close()
+        await self._http_session.close()
 
     @aiohttp_jinja2.template('get_upload.html')
     @db.with_transaction
@@ -62,7 +116,7 @@ class App(object):
         }
 
     async def handle_post_upload(self, request):
-        req_data = await request.post()
+        req_data, replay_file = await self._read_upload_form(request)
         replay = None
 
         async with self.sql_pool.acquire() as conn:
@@ -72,8 +126,9 @@ class App(object):
                 if ('replay_sha1sum' in req_data and not
                         util.truthy(req_data.get('overwrite'))):
                     try:
-                        await dbapi.Replay.get_by_sha1sum(
-                            conn, req_data['replay_sha1sum']
+                        await self._get_replay_by_sha1sum(
+                            conn, req_data['replay_sha1sum'],
+                            keep_unfinished=True
                         )
                     except dbapi.NotFoundError:
                         pass
@@ -82,8 +137,7 @@ class App(object):
                                             status=409)
                     sha = req_data['replay_sha1sum']
                 # If we werent supplied a sha1sum then the file must be sent
-                elif ('replay_sha1sum' not in req_data and
-                        'replay_file' not in req_data):
+                elif 'replay_sha1sum' not in req_data and replay_file is None:
                     return web.Response(
                         text='Must specify sha1sum or send file',
                         status=400
@@ -92,73 +146,425 @@ class App(object):
                     sha = None
 
                 game = await dbapi.Game.get_by_name(conn, req_data['game'])
-                replay_uuid = str(uuid.uuid4())
-                replay = await dbapi.Replay.create(
-                    conn,
-                    replay_uuid,
-                    game.id,
-                    dbapi.ReplayUploadState.UPLOADING_TO_SWIFT,
-                    sha
-                )
+                try:
+                    replay = await self._create_replay(conn, game, sha)
+                except dbapi.ConflictError:
+                    return web.Response(text='Replay sha1 already exists',
+                                        status=409)
 
         # Swift uploads can take a while so release our db connection
         swift_data = objectstoreapi.ReplayData(
             replay.uuid,
             self.config.swift.replays_container
         )
-        async with self._keystone_session() as keystone_session:
-            async with self._swift_client(keystone_session) as swift_client:
-                if 'replay_file' in req_data:
-                    await swift_data.set_data(
-                        swift_client,
-                        req_data['replay_file'].file.read()
-                    )
-                elif 'replay_sha1sum' in req_data:
-                    tempurl = await swift_data.create_tempurl(swift_client)
-                    context = {
-                        'tempurl': tempurl
-                    }
-                    return aiohttp_jinja2.render_template(
-                        'post_upload_tempurl.html',
-                        request,
-                        context
-                    )
-
-        async with self.sql_pool.acquire() as conn:
-            async with conn.transaction():
-                await replay.set_upload_state(
-                    conn,
-                    dbapi.ReplayUploadState.COMPLETE
+        keystone_session = self._keystone_session()
+        async with self._swift_client(keystone_session) as swift_client:
+            if replay_file is not None:
+                replay, error = await self._upload_replay_file(
+                    request, replay_file, replay, sha, swift_data,
+                    swift_client
+                )
+                if error is not None:
+                    return error
+            elif 'replay_sha1sum' in req_data:
+                tempurl = await swift_data.create_tempurl(swift_client)
+                context = {
+                    'tempurl': tempurl
+                }
+                return aiohttp_jinja2.render_template(
+                    'post_upload_tempurl.html',
+                    request,
+                    context
                 )
 
         context = {
             'game': game,
-            'replay': replay
+            'replay': replay,
+            'duplicate': replay.uuid != swift_data.uuid
         }
         return aiohttp_jinja2.render_template('post_upload_fullreplay.html',
                                               request,
                                               context)
 
+    async def _create_replay(self, conn, game, sha):
+        replay_uuid = str(uuid.uuid4())
+        state = dbapi.ReplayUploadState.UPLOADING_TO_SWIFT
+        try:
+            return await dbapi.Replay.create(conn, replay_uuid, game.id,
+                                             state, sha)
+        except dbapi.ConflictError:
+            try:
+                await self._get_sha1sum_holder(conn, sha,
+                                               keep_unfinished=True)
+            except dbapi.NotFoundError:
+                # Held by a failed upload, which has given it up
+                return await dbapi.Replay.create(conn, replay_uuid, game.id,
+                                                 state, sha)
+            raise
+
+    async def _upload_replay_file(self, request, replay_file, replay, sha,
+                                  swift_data, swift_client):
+        # The request body bounds the file size, which decides whether it
+        # needs to be a segmented large object
+        uploaded_sha, _ = await swift_data.upload_stream(
+            swift_client,
+            replay_file.read_chunk,
+            size_hint=request.content_length
+        )
+        uploaded_uuid = replay.uuid
+        replay, error = await self._finish_upload(replay, sha, uploaded_sha)
+        if error is not None or replay.uuid != uploaded_uuid:
+            # Rejected or already stored, so drop what we uploaded
+            await swift_data.delete(swift_client)
+        return replay, error
+
+    async def _finish_upload(self, replay, expected_sha, uploaded_sha):
+        """Record an uploaded replay's sha1sum and final upload state.
+
+        If another replay already has the uploaded sha1sum the new replay
+        is deleted and the existing one returned in its place. Returns the
+        replay and an error response if the upload was rejected.
+        """
+        async with self.sql_pool.acquire() as conn:
+            async with conn.transaction():
+                if expected_sha is not None and expected_sha != uploaded_sha:
+                    # Deleted so the sha1sum it claimed is free for the
+                    # file which really has it
+                    await replay.delete(conn)
+                    return replay, web.Response(
+                        text='Replay does not match sha1sum', status=400
+                    )
+                if expected_sha is None:
+                    existing = await self._set_sha1sum_or_get_existing(
+                        conn, replay, uploaded_sha
+                    )
+                    if existing is not None:
+                        await replay.delete(conn)
+                        return existing, None
+                await replay.set_upload_state(
+                    conn, dbapi.ReplayUploadState.COMPLETE
+                )
+        self._replay_hashes.add(uploaded_sha)
+        return replay, None
+
+    async def _set_sha1sum_or_get_existing(self, conn, replay, sha1sum):
+        try:
+            return await self._get_replay_by_sha1sum(conn, sha1sum)
+        except dbapi.NotFoundError:
+            pass
+        try:
+            await replay.set_sha1sum(conn, sha1sum)
+        except dbapi.ConflictError:
+            # Added since we loaded our hashes, for instance by another
+            # webapp process
+            try:
+                return await self._get_sha1sum_holder(conn, sha1sum)
+            except dbapi.NotFoundError:
+                await replay.set_sha1sum(conn, sha1sum)
+        return None
+
+    async def _get_replay_by_sha1sum(self, conn, sha1sum,
+                                     keep_unfinished=False):
+        # Most uploads are new, so skip the query when we know that
+        if sha1sum not in self._replay_hashes:
+            raise dbapi.NotFoundError()
+        return await self._get_sha1sum_holder(conn, sha1sum, keep_unfinished)
+
+    async def _get_sha1sum_holder(self, conn, sha1sum, keep_unfinished=False):
+        """Return the replay with sha1sum, raising NotFoundError if none.
+
+        Only complete replays count, and unfinished uploads if
+        keep_unfinished is set. Others give up the sha1sum so the file can
+        still be uploaded, rather than being taken for a duplicate of a
+        replay which cannot be downloaded.
+        """
+        replay = await dbapi.Replay.get_by_sha1sum(conn, sha1sum)
+        state = replay.upload_state
+        if state == dbapi.ReplayUploadState.COMPLETE or \
+                (keep_unfinished and state != dbapi.ReplayUploadState.ERROR):
+            return replay
+        await replay.set_sha1sum(conn, None)
+        raise dbapi.NotFoundError()
+
+    async def _load_replay_hashes(self):
+        async with self.sql_pool.acquire() as conn:
+            async with conn.transaction():
+                async for row in dbapi.Replay.cursor_sha1sums(conn):
+                    self._replay_hashes.add(row['sha1sum'])
+
+    async def _read_upload_form(self, request):
+        """Read the upload form without reading the replay file.
+
+        Returns the form fields and the replay_file part, which is None if
+        no file was sent. Fields after the file are not read, so the file
+        must be the last field in the form.
+        """
+        if request.content_type != 'multipart/form-data':
+            return await request.post(), None
+
+        fields = {}
+        reader = await request.multipart()
+        while True:
+            part = await reader.next()
+            if part is None:
+                return fields, None
+            if part.name == 'replay_file':
+                return fields, part
+            value = bytearray()
+            while True:
+                chunk = await part.read_chunk()
+                if not chunk:
+                    break
+                value.extend(chunk)
+                if len(value) > MAX_UPLOAD_FIELD_SIZE:
+                    raise web.HTTPBadRequest(text='Form field %s is too '
+                                                  'large' % part.name)
+            fields[part.name] = value.decode(
+                part.get_charset(default='utf-8')
+            )
+
     @aiohttp_jinja2.template('list_replays.html')
     @db.with_transaction
     async def handle_list_replays(self, conn, request):
         replays = await dbapi.Replay.get_all(conn)
+        players = await dbapi.ReplayPlayer.get_by_replay_ids(
+            conn, [replay.id for replay in replays]
+        )
         return {
-            'replays': replays
+            'replays': replays,
+            'players': players
         }
 
+    async def _get_replay(self, conn, request):
+        try:
+            return await dbapi.Replay.get_by_uuid(conn,
+                                                  request.match_info['uuid'])
+        except dbapi.NotFoundError:
+            raise web.HTTPNotFound(text='No such replay')
+
+    @db.with_connection
+    async def handle_get_replay_players(self, conn, request):
+        """Players and races of a replay, as stored by player_names."""
+        replay = await self._get_replay(conn, request)
+        players = await dbapi.ReplayPlayer.get_by_replay_ids(conn,
+                                                             [replay.id])
+        if not players[replay.id]:
+            raise web.HTTPNotFound(text='Replay has not been analyzed')
+        return web.json_response([player.to_dict()
+                                  for player in players[replay.id]])
+
+    @db.with_connection
+    async def handle_get_replay_analysis(self, conn, request):
+        """The stored result of a worker analysis of a replay, of the
+        latest version unless ?version= is given.
+        """
+        replay = await self._get_replay(conn, request)
+        version = request.query.get('version')
+        if version is not None:
+            try:
+                version = int(version)
+            except ValueError:
+                raise web.HTTPBadRequest(text='Invalid version')
+        try:
+            analysis = await dbapi.ReplayAnalysis.get(
+                conn, replay.id, request.match_info['analysis'], version
+            )
+        except dbapi.NotFoundError:
+            raise web.HTTPNotFound(text='Replay has not been analyzed')
+        # Served as stored, without decoding and encoding it again
+        return web.Response(text=analysis.result,
+                            content_type='application/json',
+                            headers={'X-Analysis-Version':
+                                     str(analysis.version)})
+
+    async def handle_get_replay_download(self, request):
+        """Stream a replay from swift, honouring any Range header.
+
+        With ?tempurl=true redirect to a GET tempurl instead, so the
+        client fetches straight from swift.
+        """
+        async with self.sql_pool.acquire() as conn:
+            replay = await self._get_replay(conn, request)
+        if replay.upload_state == dbapi.ReplayUploadState.ERROR:
+            raise web.HTTPNotFound(text='Replay upload failed')
+
+        swift_data = objectstoreapi.ReplayData(
+            replay.uuid,
+            self.config.swift.replays_container
+        )
+        keystone_session = self._keystone_session()
+        async with self._swift_client(keystone_session) as swift_client:
+            if util.truthy(request.query.get('tempurl')):
+                tempurl = await swift_data.create_tempurl(swift_client,
+                                                          method='GET')
+                raise web.HTTPFound(tempurl)
+            try:
+                async with swift_data.open(
+                        swift_client,
+                        range_header=request.headers.get('Range')
+                ) as reader:
+                    return await self._stream_download(request, replay,
+                                                       reader)
+            except swift.ObjectNotFoundError:
+                raise web.HTTPNotFound(text='Replay is not in storage')
+            except swift.RangeNotSatisfiableError as e:
+                headers = None
+                if e.content_range is not None:
+                    headers = {'Content-Range': e.content_range}
+                raise web.HTTPRequestRangeNotSatisfiable(headers=headers)
+
+    async def _stream_download(self, request, replay, reader):
+        resp = web.StreamResponse(status=reader.status)
+        for header in DOWNLOAD_PROXY_HEADERS:
+            if header in reader.headers:
+                resp.headers[header] = reader.headers[header]
+        resp.headers['Accept-Ranges'] = 'bytes'
+        resp.headers['Content-Disposition'] = (
+            'attachment; filename="%s"' % replay.uuid
+        )
+        if reader.content_length is not None:
+            resp.content_length = reader.content_length
+        else:
+            resp.enable_chunked_encoding()
+        await resp.prepare(request)
+        # Chunks go straight from the swift response to the client
+        while True:
+            chunk = await reader.read_chunk()
+            if not chunk:
+                break
+            await resp.write(chunk)
+        await resp.write_eof()
+        return resp
+
     def _keystone_session(self):
-        swift_config = self.config.swift
-        return swift.KeystoneSession(swift_config.auth_url,
-                                     swift_config.project_id,
-                                     swift_config.user_id,
-                                     swift_config.password)
+        # Shared by every request so the token and catalog are reused
+        if self._keystone is None:
+            swift_config = self.config.swift
+            self._keystone = swift.KeystoneSession(
+                swift_config.auth_url,
+                swift_config.project_id,
+                swift_config.user_id,
+                swift_config.password,
+                http_session=self._http_session
+            )
+        return self._keystone
 
     def _swift_client(self, keystone_session):
         swift_config = self.config.swift
         return swift.SwiftClient(keystone_session,
                                  swift_config.region,
-                                 temp_url_key=swift_config.temp_url_key)
+                                 temp_url_key=swift_config.temp_url_key,
+                                 http_session=self._http_session,
+                                 segment_size=swift_config.segment_size,
+                                 large_object_threshold=(
+                                     swift_config.large_object_threshold
+                                 ),
+                                 upload_concurrency=(
+                                     swift_config.upload_concurrency
+                                 ),
+                                 segment_retries=swift_config.segment_retries)
+
+
+class WorkerSupervisor(object):
+    """Waits on the worker processes of the webapp.
+
+    When one exits the others are stopped too, as the streamers it owned
+    would no longer be stored.
+    """
+    def __init__(self, pids):
+        self.running = set(pids)
+        self.stopping = False
+        self.failed = False
+
+    def stop(self):
+        if self.stopping:
+            return
+        self.stopping = True
+        for pid in self.running:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    async def wait(self):
+        while self.running:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                await asyncio.sleep(WORKER_POLL_INTERVAL)
+                continue
+            self.running.discard(pid)
+            if status != 0 or not self.stopping:
+                LOG.error('Worker process %d exited with wait status %d',
+                          pid, status)
+                self.failed = True
+            self.stop()
+
+
+def _listen(host, port):
+    family, type_, proto, _, address = socket.getaddrinfo(
+        host, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE
+    )[0]
+    sock = socket.socket(family, type_, proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    sock.listen(128)
+    return sock
+
+
+def _run_worker(config, worker_index, sock, broker_path):
+    # Signals for the supervisor, such as ^C, do not reach workers directly
+    os.setpgid(0, 0)
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    loop = asyncio.get_event_loop()
+    pool = loop.run_until_complete(db.create_pool(config.sql))
+    app = App(config, pool, worker_index=worker_index,
+              broker_path=broker_path)
+    app.run(sock=sock)
+
+
+def run_workers(config):
+    """Run config.workers webapp processes accepting on one socket.
+
+    GSI events are relayed between the workers by a broker in this
+    process, which they connect to on a unix socket. Returns the exit
+    status.
+    """
+    sock = _listen(config.host, config.port)
+    broker_dir = tempfile.mkdtemp(prefix='cheeseshop-')
+    broker_path = os.path.join(broker_dir, 'gsi.sock')
+    broker_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    broker_sock.bind(broker_path)
+    broker_sock.listen(config.workers)
+
+    pids = []
+    for worker_index in range(config.workers):
+        pid = os.fork()
+        if pid == 0:
+            broker_sock.close()
+            try:
+                _run_worker(config, worker_index, sock, broker_path)
+            except Exception:
+                LOG.exception('Worker %d failed', worker_index)
+                os._exit(1)
+            os._exit(0)
+        pids.append(pid)
+    sock.close()
+
+    supervisor = WorkerSupervisor(pids)
+    loop = asyncio.get_event_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, supervisor.stop)
+    broker = pubsub.Broker()
+    try:
+        loop.run_until_complete(broker.start(broker_sock))
+        loop.run_until_complete(supervisor.wait())
+        loop.run_until_complete(broker.close())
+    finally:
+        shutil.rmtree(broker_dir)
+    return 1 if supervisor.failed else 0
 
 
 def main():
@@ -166,13 +572,16 @@ def main():
 
     config = cs_config.Config.from_yaml_file(args.config_file)
 
+    if config.workers > 1 and not args.create_schema:
+        # Workers are forked before anything uses an event loop
+        sys.exit(run_workers(config))
+
     loop = asyncio.get_event_loop()
     pool = loop.run_until_complete(db.create_pool(config.sql))
 
     if args.create_schema:
         conn = loop.run_until_complete(pool.acquire())
-        loop.run_until_complete(dbapi.create_schema(conn))
-        loop.run_until_complete(dbapi.create_initial_records(conn))
+        loop.run_until_complete(migrations.create_schema(conn))
         print('DB Schema created')
     else:
         app = App(config, pool)
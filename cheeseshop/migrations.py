@@ -0,0 +1,355 @@
+"""Versioned schema migrations.
+
+dbapi.create_schema() always builds the latest schema and is stamped with
+the latest version. Databases created before migrations existed have no
+schema_version table and are treated as being at version 1. Every schema
+change after that goes both in dbapi.create_schema() and in a new
+Migration at the end of MIGRATIONS.
+
+Migrations which are not transactional (for instance because they use
+CREATE INDEX CONCURRENTLY) must be safe to re-run if they fail part way.
+"""
+import datetime
+
+from cheeseshop import dbapi
+
+
+# Arbitrary key for the advisory lock held while upgrading
+MIGRATION_LOCK_ID = 0x636865657365
+
+
+class MigrationError(Exception):
+    pass
+
+
+class Migration(object):
+    def __init__(self, version, description, upgrade=None,
+                 transactional=True):
+        self.version = version
+        self.description = description
+        self._upgrade = upgrade
+        self.transactional = transactional
+
+    async def upgrade(self, conn):
+        if self._upgrade is not None:
+            await self._upgrade(conn)
+
+
+async def create_index_concurrently(conn, name, table, columns,
+                                    unique=False):
+    """Build an index without blocking writes to table.
+
+    A failed concurrent build leaves an invalid index behind, so drop that
+    before trying again.
+    """
+    valid = await conn.fetchval('''
+        SELECT pg_index.indisvalid FROM pg_index
+        INNER JOIN pg_class ON pg_class.oid = pg_index.indexrelid
+        WHERE pg_class.relname = $1
+    ''', name)
+    if valid is False:
+        await conn.execute('DROP INDEX CONCURRENTLY IF EXISTS %s' % name)
+    await conn.execute('''
+        CREATE %sINDEX CONCURRENTLY IF NOT EXISTS %s ON %s (%s)
+    ''' % ('UNIQUE ' if unique else '', name, table, columns))
+
+
+def _create_table(table, create_schema):
+    """Return a migration step running create_schema unless table exists.
+
+    This keeps the migration a no-op on databases which were given the
+    latest schema by dbapi.create_schema() without being stamped.
+    """
+    async def upgrade(conn):
+        exists = await conn.fetchval('SELECT to_regclass($1) IS NOT NULL',
+                                     table)
+        if not exists:
+            await create_schema(conn)
+    return upgrade
+
+
+async def _add_gsi_event_indexes(conn):
+    await create_index_concurrently(conn,
+                                    'cs_go_gsi_events_streamer_id_id_idx',
+                                    'cs_go_gsi_events', 'streamer_id, id')
+    await create_index_concurrently(conn,
+                                    'cs_go_event_map_releation_event_id_idx',
+                                    'cs_go_event_map_releation', 'event_id')
+    await create_index_concurrently(conn,
+                                    'cs_go_event_map_releation_map_id_idx',
+                                    'cs_go_event_map_releation', 'map_id')
+
+
+async def _partition_gsi_events(conn):
+    """Turn cs_go_gsi_events into a table partitioned by month.
+
+    The existing table becomes a single partition holding everything up
+    to the end of next month. New monthly partitions start after that and
+    the old data is dropped in one go once retention passes it.
+    """
+    if not dbapi.partitioning_supported(conn):
+        return
+    if await dbapi.CsGoGsiEvent.is_partitioned(conn):
+        return
+
+    this_month = dbapi.start_of_month(datetime.datetime.now())
+    boundary = dbapi.start_of_next_month(
+        dbapi.start_of_next_month(this_month)
+    )
+    await create_index_concurrently(conn, 'cs_go_gsi_events_id_time_idx',
+                                    'cs_go_gsi_events', 'id, time',
+                                    unique=True)
+    # Validating the range as a check constraint first means neither
+    # SET NOT NULL nor ATTACH PARTITION need to scan the table while
+    # holding an exclusive lock.
+    await conn.execute('''
+        ALTER TABLE cs_go_gsi_events
+        DROP CONSTRAINT IF EXISTS cs_go_gsi_events_legacy_time_check
+    ''')
+    await conn.execute('''
+        ALTER TABLE cs_go_gsi_events
+        ADD CONSTRAINT cs_go_gsi_events_legacy_time_check
+        CHECK (time IS NOT NULL AND time < '%s') NOT VALID
+    ''' % boundary)
+    await conn.execute('''
+        ALTER TABLE cs_go_gsi_events
+        VALIDATE CONSTRAINT cs_go_gsi_events_legacy_time_check
+    ''')
+
+    async with conn.transaction():
+        await conn.execute('''
+            ALTER TABLE cs_go_event_map_releation
+            DROP CONSTRAINT IF EXISTS cs_go_event_map_releation_event_id_fkey
+        ''')
+        await conn.execute('''
+            ALTER TABLE cs_go_gsi_events ALTER COLUMN time SET NOT NULL
+        ''')
+        # Index names are unique per schema, so the legacy table's names
+        # are freed for the partitioned table
+        await conn.execute('''
+            ALTER TABLE cs_go_gsi_events
+            RENAME CONSTRAINT cs_go_gsi_events_pkey
+            TO cs_go_gsi_events_legacy_pkey
+        ''')
+        await conn.execute('''
+            ALTER INDEX IF EXISTS cs_go_gsi_events_streamer_id_id_idx
+            RENAME TO cs_go_gsi_events_legacy_streamer_id_id_idx
+        ''')
+        await conn.execute('''
+            ALTER TABLE cs_go_gsi_events RENAME TO cs_go_gsi_events_legacy
+        ''')
+        await conn.execute('''
+            CREATE TABLE cs_go_gsi_events(
+                id integer NOT NULL
+                    DEFAULT nextval('cs_go_gsi_events_id_seq'),
+                time timestamp NOT NULL,
+                streamer_id integer REFERENCES cs_go_streamer (id),
+                event json,
+                PRIMARY KEY (id, time)
+            ) PARTITION BY RANGE (time)
+        ''')
+        await conn.execute('''
+            ALTER SEQUENCE cs_go_gsi_events_id_seq
+            OWNED BY cs_go_gsi_events.id
+        ''')
+        await conn.execute('''
+            ALTER TABLE cs_go_gsi_events
+            ATTACH PARTITION cs_go_gsi_events_legacy
+            FOR VALUES FROM (MINVALUE) TO ('%s')
+        ''' % boundary)
+        # Matches the renamed index on the legacy table, so that is
+        # attached rather than rebuilt
+        await conn.execute('''
+            CREATE INDEX cs_go_gsi_events_streamer_id_id_idx
+            ON cs_go_gsi_events (streamer_id, id)
+        ''')
+        await dbapi.CsGoGsiEventPartition.create_default(conn)
+        await dbapi.CsGoGsiEventPartition.ensure(conn, boundary)
+
+
+async def _add_gsi_event_keyframe_id(conn):
+    await conn.execute('''
+        ALTER TABLE cs_go_gsi_events
+        ADD COLUMN IF NOT EXISTS keyframe_id integer
+    ''')
+
+
+async def _unique_event_map_relations(conn):
+    await conn.execute('''
+        DELETE FROM cs_go_event_map_releation a
+        USING cs_go_event_map_releation b
+        WHERE a.ctid < b.ctid
+            AND a.event_id = b.event_id AND a.map_id = b.map_id
+    ''')
+    await create_index_concurrently(
+        conn, 'cs_go_event_map_releation_event_id_map_id_idx',
+        'cs_go_event_map_releation', 'event_id, map_id', unique=True
+    )
+
+
+async def _extract_gsi_events(conn):
+    """Give the until now unused death and hltv event tables what events
+    extracted from GSI need, and seed the event types.
+    """
+    for column in ('streamer_id integer REFERENCES cs_go_streamer (id)',
+                   'map_id integer REFERENCES cs_go_map (id)',
+                   'gsi_event_id integer',
+                   'round integer',
+                   'steam_id integer REFERENCES cs_go_steam_ids (id)'):
+        await conn.execute('''
+            ALTER TABLE cs_go_hltv_events ADD COLUMN IF NOT EXISTS %s
+        ''' % column)
+    await conn.execute('''
+        ALTER TABLE cs_go_death_events
+        ADD COLUMN IF NOT EXISTS hltv_event_id integer UNIQUE
+            REFERENCES cs_go_hltv_events (id) ON DELETE CASCADE
+    ''')
+    await conn.execute('''
+        ALTER TABLE cs_go_map_populator_checkpoints
+        ADD COLUMN IF NOT EXISTS tick_differ json
+    ''')
+    await dbapi.CsGoHltvEvent.create_indexes(conn)
+    await dbapi.CsGoDeathEvent.create_indexes(conn)
+    await dbapi.CsGoHltvEventType.get_or_create_many(
+        conn, dbapi.CsGoHltvEventType.GSI_TYPES
+    )
+
+
+async def _add_map_streamer_index(conn):
+    await create_index_concurrently(conn,
+                                    'cs_go_map_streamer_id_start_time_idx',
+                                    'cs_go_map', 'streamer_id, start_time')
+
+
+async def _add_checkpoint_last_event_time(conn):
+    await conn.execute('''
+        ALTER TABLE cs_go_map_populator_checkpoints
+        ADD COLUMN IF NOT EXISTS last_event_time timestamp
+    ''')
+
+
+MIGRATIONS = [
+    Migration(1, 'Initial schema'),
+    Migration(2, 'Index GSI events by streamer and map relations',
+              _add_gsi_event_indexes, transactional=False),
+    Migration(3, 'Partition GSI events by month',
+              _partition_gsi_events, transactional=False),
+    Migration(4, 'Allow delta encoded GSI events',
+              _add_gsi_event_keyframe_id),
+    Migration(5, 'Store replay analysis results',
+              _create_table('replay_analyses',
+                            dbapi.ReplayAnalysis.create_schema)),
+    Migration(6, 'Store the players of analyzed replays',
+              _create_table('replay_players',
+                            dbapi.ReplayPlayer.create_schema)),
+    Migration(7, 'Make event map relations unique',
+              _unique_event_map_relations, transactional=False),
+    Migration(8, 'Checkpoint the map populator',
+              _create_table('cs_go_map_populator_checkpoints',
+                            dbapi.CsGoMapPopulatorCheckpoint.create_schema)),
+    Migration(9, 'Store position heatmaps of finished maps',
+              _create_table('cs_go_map_heatmaps',
+                            dbapi.CsGoMapHeatmap.create_schema)),
+    Migration(10, 'Extract death, money and round events from GSI',
+              _extract_gsi_events),
+    Migration(11, 'Index maps by streamer',
+              _add_map_streamer_index, transactional=False),
+    Migration(12, 'Checkpoint the time of the map populator\'s last event',
+              _add_checkpoint_last_event_time),
+]
+
+
+def latest_version():
+    return MIGRATIONS[-1].version
+
+
+async def _create_version_table(conn):
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version(
+            version integer PRIMARY KEY,
+            description text,
+            applied_at timestamp
+        )
+    ''')
+
+
+async def _table_exists(conn, name):
+    return await conn.fetchval('SELECT to_regclass($1) IS NOT NULL', name)
+
+
+async def get_version(conn):
+    """Return the current schema version, or None for an empty database."""
+    if await _table_exists(conn, 'schema_version'):
+        version = await conn.fetchval('''
+            SELECT max(version) FROM schema_version
+        ''')
+        if version is not None:
+            return version
+    if await _table_exists(conn, 'games'):
+        return 1
+    return None
+
+
+async def _record(conn, migration):
+    await conn.execute('''
+        INSERT INTO schema_version(version, description, applied_at)
+        VALUES ($1, $2, $3)
+        ON CONFLICT (version) DO NOTHING
+    ''', migration.version, migration.description, datetime.datetime.now())
+
+
+async def stamp(conn, version):
+    """Mark every migration up to version as applied."""
+    await _create_version_table(conn)
+    for migration in MIGRATIONS:
+        if migration.version <= version:
+            await _record(conn, migration)
+
+
+async def create_schema(conn):
+    """Create the latest schema in an empty database."""
+    async with conn.transaction():
+        await dbapi.create_schema(conn)
+        await stamp(conn, latest_version())
+    await dbapi.create_initial_records(conn)
+
+
+async def status(conn):
+    """Return (current version, list of pending migrations)."""
+    version = await get_version(conn)
+    if version is None:
+        return None, list(MIGRATIONS)
+    return version, [m for m in MIGRATIONS if m.version > version]
+
+
+async def upgrade(conn, target=None, log=print):
+    """Apply pending migrations up to target (default latest)."""
+    target = latest_version() if target is None else target
+    await conn.execute('SELECT pg_advisory_lock($1)', MIGRATION_LOCK_ID)
+    try:
+        version = await get_version(conn)
+        if version is None:
+            log('Creating schema at version %d' % latest_version())
+            await create_schema(conn)
+            return latest_version()
+        if target < version:
+            raise MigrationError('Cannot downgrade from version %d to %d'
+                                 % (version, target))
+
+        await stamp(conn, version)
+        for migration in MIGRATIONS:
+            if not version < migration.version <= target:
+                continue
+            log('Applying migration %d: %s' % (migration.version,
+                                               migration.description))
+            if migration.transactional:
+                async with conn.transaction():
+                    await migration.upgrade(conn)
+                    await _record(conn, migration)
+            else:
+                await migration.upgrade(conn)
+                await _record(conn, migration)
+            version = migration.version
+        return version
+    finally:
+        await conn.execute('SELECT pg_advisory_unlock($1)', MIGRATION_LOCK_ID)
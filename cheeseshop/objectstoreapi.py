@@ -6,5 +6,37 @@ class ReplayData(object):
     async def set_data(self, swift_client, data):
         await swift_client.create_object(self.uuid, data, self.container)
 
-    async def create_tempurl(self, swift_client):
-        return await swift_client.create_tempurl(self.uuid, self.container)
+    async def set_data_segmented(self, swift_client, data, **kwargs):
+        """Upload data as a large object of parallel uploaded segments.
+
+        See SwiftClient.create_large_object for kwargs.
+        """
+        return await swift_client.create_large_object(self.uuid, data,
+                                                      self.container,
+                                                      **kwargs)
+
+    async def upload_stream(self, swift_client, read, size_hint=None):
+        return await swift_client.upload_stream(self.uuid, read,
+                                                self.container,
+                                                size_hint=size_hint)
+
+    async def delete(self, swift_client):
+        await swift_client.delete_object(self.uuid, self.container)
+
+    def open(self, swift_client, range_header=None):
+        """Stream the replay, see SwiftClient.open_object."""
+        return swift_client.open_object(self.uuid, self.container,
+                                        range_header=range_header)
+
+    async def download(self, swift_client, fileobj):
+        """Write the whole replay to fileobj, a chunk at a time."""
+        async with self.open(swift_client) as reader:
+            while True:
+                chunk = await reader.read_chunk()
+                if not chunk:
+                    break
+                fileobj.write(chunk)
+
+    async def create_tempurl(self, swift_client, method='PUT'):
+        return await swift_client.create_tempurl(self.uuid, self.container,
+                                                 method=method)
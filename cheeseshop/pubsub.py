@@ -0,0 +1,175 @@
+"""Publish subscribe between the processes of a multi worker webapp.
+
+A Broker in the supervising process listens on a unix socket which every
+worker connects to with a BrokerClient. Each message a client publishes is
+relayed to every other client. Messages are a topic and a text body, sent
+as a 4 byte length followed by the topic, a newline and the body.
+
+Delivery is best effort: nothing waits on a process which is not reading,
+instead messages to it are dropped while max_buffer bytes are waiting to
+be sent to it, like the drop policies of GSI viewers.
+"""
+import asyncio
+import logging
+import struct
+
+
+LOG = logging.getLogger(__name__)
+
+_HEADER = struct.Struct('!I')
+# Larger than the largest request body the webapp accepts
+MAX_MESSAGE_SIZE = 4 * 1024 * 1024
+
+
+class MessageTooLargeError(Exception):
+    pass
+
+
+def encode_message(topic, body):
+    payload = topic.encode() + b'\n' + body.encode()
+    if len(payload) > MAX_MESSAGE_SIZE:
+        raise MessageTooLargeError()
+    return _HEADER.pack(len(payload)) + payload
+
+
+def decode_message(payload):
+    """Return the topic and body of an encoded message without its
+    header.
+    """
+    topic, body = payload.split(b'\n', 1)
+    return topic.decode(), body.decode()
+
+
+async def read_message(reader):
+    """Read an encoded message including its header, or None at EOF."""
+    try:
+        header = await reader.readexactly(_HEADER.size)
+        size, = _HEADER.unpack(header)
+        if size > MAX_MESSAGE_SIZE:
+            raise MessageTooLargeError()
+        return header + await reader.readexactly(size)
+    except asyncio.IncompleteReadError:
+        return None
+
+
+def _buffer_full(writer, max_buffer):
+    return writer.transport.get_write_buffer_size() > max_buffer
+
+
+class Broker(object):
+    def __init__(self, max_buffer=16777216):
+        self.max_buffer = max_buffer
+        self.relayed = 0
+        self.dropped = 0
+        self._server = None
+        self._writers = set()
+
+    async def start(self, sock):
+        """Serve clients on an already bound and listening unix socket."""
+        self._server = await asyncio.start_unix_server(self._handle_client,
+                                                       sock=sock)
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for writer in list(self._writers):
+            writer.close()
+
+    async def _handle_client(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                message = await read_message(reader)
+                if message is None:
+                    break
+                self._relay(writer, message)
+        except (ConnectionError, MessageTooLargeError):
+            LOG.exception('Dropping broker client')
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    def _relay(self, sender, message):
+        for writer in self._writers:
+            if writer is sender:
+                continue
+            if _buffer_full(writer, self.max_buffer):
+                self.dropped += 1
+            else:
+                writer.write(message)
+                self.relayed += 1
+
+
+class BrokerClient(object):
+    """A connection to a Broker, which reconnects if it is lost.
+
+    on_message(topic, body) is called with every message published by
+    other clients. Messages published while disconnected are dropped.
+    """
+    def __init__(self, path, on_message, max_buffer=16777216,
+                 reconnect_interval=1):
+        self.path = path
+        self.on_message = on_message
+        self.max_buffer = max_buffer
+        self.reconnect_interval = reconnect_interval
+        self.published = 0
+        self.dropped = 0
+        self.connected = asyncio.Event()
+        self._writer = None
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def publish(self, topic, body):
+        """Send a message without waiting, returns whether it was sent."""
+        writer = self._writer
+        if writer is None or _buffer_full(writer, self.max_buffer):
+            self.dropped += 1
+            return False
+        writer.write(encode_message(topic, body))
+        self.published += 1
+        return True
+
+    async def _run(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(
+                    self.path
+                )
+            except OSError:
+                LOG.warning('Unable to connect to broker at %s', self.path)
+            else:
+                await self._receive(reader, writer)
+                LOG.warning('Lost connection to broker at %s', self.path)
+            await asyncio.sleep(self.reconnect_interval)
+
+    async def _receive(self, reader, writer):
+        self._writer = writer
+        self.connected.set()
+        try:
+            while True:
+                message = await read_message(reader)
+                if message is None:
+                    return
+                topic, body = decode_message(message[_HEADER.size:])
+                try:
+                    self.on_message(topic, body)
+                except Exception:
+                    LOG.exception('Error handling message on %s', topic)
+        except (ConnectionError, MessageTooLargeError):
+            LOG.exception('Error reading from broker')
+        finally:
+            self.connected.clear()
+            self._writer = None
+            writer.close()
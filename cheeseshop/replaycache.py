@@ -0,0 +1,235 @@
+"""On disk cache of replay files, keyed by sha1sum.
+
+A cache directory may be shared by any number of worker processes. Each
+replay is fetched at most once at a time: the first process to miss takes
+an exclusive lock for that sha1sum and downloads into a temporary file,
+which is only renamed into place once its sha1 has been checked. Others
+block on the same lock and find the finished file when they get it.
+
+Entries are evicted least recently used first, by modification time,
+which is bumped on every hit. Hit and miss counts are kept in a small
+json file in the cache directory so they cover every process using it.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+
+DEFAULT_MAX_SIZE = 10737418240
+STATS_FILE = 'stats.json'
+LOCK_FILE = '.lock'
+LOCK_DIR = 'locks'
+TEMP_PREFIX = '.tmp-'
+
+_SHA1SUM_RE = re.compile('^[0-9a-f]{40}$')
+
+
+class ReplayCacheError(Exception):
+    pass
+
+
+class HashMismatchError(ReplayCacheError):
+    def __init__(self, expected, actual):
+        super().__init__('Fetched replay has sha1sum %s, expected %s'
+                         % (actual, expected))
+        self.expected = expected
+        self.actual = actual
+
+
+class _FileLock(object):
+    """Exclusive flock on path, released when closed.
+
+    flock locks belong to the open file, so two _FileLocks on the same
+    path block each other even within one process.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def acquire(self, blocking=True):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(fd, flags)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+        return True
+
+    def release(self):
+        os.close(self._fd)
+        self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class _HashingWriter(object):
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self.sha1 = hashlib.sha1()
+        self.size = 0
+
+    def write(self, data):
+        self.sha1.update(data)
+        self.size += len(data)
+        return self._fileobj.write(data)
+
+
+class ReplayCache(object):
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = os.path.expanduser(directory)
+        self.max_size = max_size
+        os.makedirs(os.path.join(self.directory, LOCK_DIR), exist_ok=True)
+
+    def path_for(self, sha1sum):
+        return os.path.join(self.directory, sha1sum[:2], sha1sum)
+
+    def get(self, sha1sum, fetch):
+        """Return the path of the replay with sha1sum, fetching it on a miss.
+
+        fetch(fileobj) is called with a writable file object to write the
+        replay to. The result is only cached if its sha1 matches, otherwise
+        HashMismatchError is raised.
+
+        Another process may evict the file once it is over max_size, so
+        open it promptly.
+        """
+        sha1sum = sha1sum.lower()
+        if not _SHA1SUM_RE.match(sha1sum):
+            raise ValueError('Invalid sha1sum: %s' % sha1sum)
+
+        path = self.path_for(sha1sum)
+        if self._touch(path):
+            self._record(hits=1)
+            return path
+        with _FileLock(self._lock_path(sha1sum)):
+            # Someone else may have fetched it while we waited for the lock
+            if self._touch(path):
+                self._record(hits=1)
+                return path
+            size = self._fetch(sha1sum, path, fetch)
+        self._record(misses=1, bytes_fetched=size)
+        self._evict(keep=path)
+        return path
+
+    def stats(self):
+        """Return hit, miss and eviction counts and the current size."""
+        with _FileLock(os.path.join(self.directory, LOCK_FILE)):
+            stats = self._read_stats()
+        entries = self._entries()
+        stats['entries'] = len(entries)
+        stats['size'] = sum(size for _, size, _ in entries)
+        stats['max_size'] = self.max_size
+        return stats
+
+    def _lock_path(self, sha1sum):
+        return os.path.join(self.directory, LOCK_DIR, sha1sum)
+
+    @staticmethod
+    def _touch(path):
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    @staticmethod
+    def _fetch(sha1sum, path, fetch):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                writer = _HashingWriter(fh)
+                fetch(writer)
+                fh.flush()
+                os.fsync(fh.fileno())
+            actual = writer.sha1.hexdigest()
+            if actual != sha1sum:
+                raise HashMismatchError(sha1sum, actual)
+            os.rename(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        return writer.size
+
+    def _entries(self):
+        """Return (mtime, size, path) of every cached replay."""
+        entries = []
+        for prefix in os.listdir(self.directory):
+            prefix_dir = os.path.join(self.directory, prefix)
+            if len(prefix) != 2 or not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                if name.startswith(TEMP_PREFIX):
+                    continue
+                path = os.path.join(prefix_dir, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _evict(self, keep):
+        with _FileLock(os.path.join(self.directory, LOCK_FILE)):
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+            evictions = 0
+            for _, size, path in sorted(entries):
+                if total <= self.max_size:
+                    break
+                if path == keep:
+                    continue
+                # Skip entries being fetched again right now
+                lock = _FileLock(self._lock_path(os.path.basename(path)))
+                if not lock.acquire(blocking=False):
+                    continue
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                finally:
+                    lock.release()
+                total -= size
+                evictions += 1
+            if evictions:
+                self._update_stats(evictions=evictions)
+
+    def _record(self, **counts):
+        with _FileLock(os.path.join(self.directory, LOCK_FILE)):
+            self._update_stats(**counts)
+
+    def _read_stats(self):
+        stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes_fetched': 0}
+        try:
+            with open(os.path.join(self.directory, STATS_FILE)) as fh:
+                stats.update(json.load(fh))
+        except (FileNotFoundError, ValueError):
+            pass
+        return stats
+
+    def _update_stats(self, **counts):
+        # Caller holds the cache lock
+        stats = self._read_stats()
+        for key, count in counts.items():
+            stats[key] += count
+        fd, temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX,
+                                         dir=self.directory)
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(stats, fh)
+        os.rename(temp_path, os.path.join(self.directory, STATS_FILE))
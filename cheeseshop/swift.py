@@ -1,8 +1,73 @@
-import aiohttp
+import asyncio
+import datetime
 import hmac
+from hashlib import md5
 from hashlib import sha1
+import json
+import logging
+import os
 from time import time
 
+import aiohttp
+
+
+LOG = logging.getLogger(__name__)
+
+# Bytes read from the client at a time when streaming an upload
+STREAM_CHUNK_SIZE = 64 * 1024
+DEFAULT_SEGMENT_SIZE = 100 * 1024 * 1024
+DEFAULT_LARGE_OBJECT_THRESHOLD = 1024 * 1024 * 1024
+# Static large object segments go in <container><suffix>
+SEGMENT_CONTAINER_SUFFIX = '_segments'
+# Seconds before the first retry of a failed segment, doubled each time
+SEGMENT_RETRY_DELAY = 0.5
+
+
+class SwiftError(Exception):
+    pass
+
+
+class ObjectNotFoundError(SwiftError):
+    pass
+
+
+class RangeNotSatisfiableError(SwiftError):
+    def __init__(self, content_range):
+        super(RangeNotSatisfiableError, self).__init__(content_range)
+        self.content_range = content_range
+
+
+def create_http_session(swift_config):
+    """Create a pooled ClientSession to share between keystone and swift.
+
+    The caller owns the session and must close it.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=swift_config.pool_limit,
+        limit_per_host=swift_config.pool_limit_per_host,
+        keepalive_timeout=swift_config.keepalive_timeout,
+        ttl_dns_cache=swift_config.dns_cache_ttl
+    )
+    return aiohttp.ClientSession(connector=connector)
+
+
+class _SharedSession(object):
+    def __init__(self, session):
+        self.session = session
+
+    async def __aenter__(self):
+        return self.session
+
+    async def __aexit__(self, *args):
+        pass
+
+
+def _client_session(http_session):
+    """Context manager for http_session, or a one-off session if None."""
+    if http_session is not None:
+        return _SharedSession(http_session)
+    return aiohttp.ClientSession()
+
 
 class KeystoneCatalogEndpoint(object):
     def __init__(self, id, interface, region, region_id, url):
@@ -22,8 +87,8 @@ class KeystoneCatalogService(object):
 
     @classmethod
     def from_raw_service_entry(self, service_entry):
-        endpoints = map(lambda x: KeystoneCatalogEndpoint(**x),
-                        service_entry['endpoints'])
+        endpoints = [KeystoneCatalogEndpoint(**x)
+                     for x in service_entry['endpoints']]
         id = service_entry['id']
         service_type = service_entry['type']
         name = service_entry['name']
@@ -43,10 +108,8 @@ class KeystoneCatalogService(object):
 class KeystoneCatalog(object):
     @classmethod
     def from_raw_catalog(self, raw_catalog):
-        services = map(
-            lambda x: KeystoneCatalogService.from_raw_service_entry(x),
-            raw_catalog
-        )
+        services = [KeystoneCatalogService.from_raw_service_entry(x)
+                    for x in raw_catalog]
         return KeystoneCatalog(services)
 
     def __init__(self, services):
@@ -60,35 +123,52 @@ class KeystoneCatalog(object):
         return services
 
 
+def parse_keystone_time(val):
+    """Parse a keystone timestamp into a naive UTC datetime."""
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%SZ'):
+        try:
+            return datetime.datetime.strptime(val, fmt)
+        except ValueError:
+            pass
+    raise ValueError('Invalid keystone time: %s' % val)
+
+
 class KeystoneToken(object):
     def __init__(self, token_id, expires_at):
         self.token_id = token_id
         self.expires_at = expires_at
 
+    def expires_in(self):
+        """Seconds until the token expires, or None if it does not."""
+        if self.expires_at is None:
+            return None
+        delta = self.expires_at - datetime.datetime.utcnow()
+        return delta.total_seconds()
+
 
 class KeystoneSession(object):
-    def __init__(self, auth_url, project_id, user_id, password):
+    """A keystone token and service catalog shared by the whole app.
+
+    The token and catalog are cached until refresh_margin seconds before
+    the token expires, at which point they are refreshed in the
+    background. Only one authentication request is ever in flight;
+    concurrent callers wait on it rather than sending their own.
+    """
+    def __init__(self, auth_url, project_id, user_id, password,
+                 refresh_margin=300, http_session=None):
         self.auth_url = auth_url
         self.project_id = project_id
         self.user_id = user_id
         self.password = password
+        self.refresh_margin = refresh_margin
+        self.http_session = http_session
         self._latest_token = None
         self.catalog = []
+        self._auth_future = None
+        self._refresh_handle = None
 
     async def __aenter__(self):
-        token_uri = '%s/v3/auth/tokens' % self.auth_url
-        async with aiohttp.ClientSession() as client:
-            async with client.post(token_uri, json=self.get_req_obj()) as req:
-                assert req.status == 201
-                # TODO(greghaynes): Set expires time
-                self._latest_token = KeystoneToken(
-                    req.headers['X-Subject-Token'],
-                    None
-                )
-                token_resp = await req.json()
-                self.catalog = KeystoneCatalog.from_raw_catalog(
-                    token_resp['token']['catalog']
-                )
+        await self.get_token()
         return self
 
     async def __aexit__(self, *args):
@@ -98,6 +178,88 @@ class KeystoneSession(object):
     def token(self):
         return self._latest_token
 
+    async def get_token(self):
+        """Return a token, authenticating if there is no usable one."""
+        token = self._latest_token
+        if token is None:
+            await self._authenticate()
+        else:
+            expires_in = token.expires_in()
+            if expires_in is not None and expires_in <= 0:
+                await self._authenticate()
+            elif expires_in is not None and expires_in < self.refresh_margin:
+                self._start_refresh()
+        return self._latest_token
+
+    async def get_catalog(self):
+        await self.get_token()
+        return self.catalog
+
+    async def invalidate(self, token):
+        """Discard token, for instance after a 401, and get a new one.
+
+        If the token has already been replaced the current one is returned
+        without authenticating again.
+        """
+        if self._latest_token is token:
+            self._latest_token = None
+        return await self.get_token()
+
+    async def close(self):
+        if self._refresh_handle is not None:
+            self._refresh_handle.cancel()
+            self._refresh_handle = None
+        if self._auth_future is not None:
+            self._auth_future.cancel()
+            self._auth_future = None
+
+    async def _authenticate(self):
+        await asyncio.shield(self._start_refresh())
+
+    def _start_refresh(self):
+        if self._auth_future is None:
+            self._auth_future = asyncio.ensure_future(self._request_token())
+            self._auth_future.add_done_callback(self._refresh_done)
+        return self._auth_future
+
+    def _refresh_done(self, future):
+        if future is self._auth_future:
+            self._auth_future = None
+        if not future.cancelled() and future.exception() is not None:
+            LOG.error('Failed to get keystone token: %r', future.exception())
+
+    async def _request_token(self):
+        token_uri = '%s/v3/auth/tokens' % self.auth_url
+        async with _client_session(self.http_session) as client:
+            async with client.post(token_uri, json=self.get_req_obj()) as req:
+                if req.status != 201:
+                    raise SwiftError('Keystone authentication failed with '
+                                     'status %d' % req.status)
+                token_resp = await req.json()
+                expires_at = token_resp['token'].get('expires_at')
+                if expires_at is not None:
+                    expires_at = parse_keystone_time(expires_at)
+                self.catalog = KeystoneCatalog.from_raw_catalog(
+                    token_resp['token']['catalog']
+                )
+                self._latest_token = KeystoneToken(
+                    req.headers['X-Subject-Token'],
+                    expires_at
+                )
+        self._schedule_refresh()
+
+    def _schedule_refresh(self):
+        if self._refresh_handle is not None:
+            self._refresh_handle.cancel()
+            self._refresh_handle = None
+        expires_in = self._latest_token.expires_in()
+        if expires_in is None:
+            return
+        delay = max(expires_in - self.refresh_margin, 0)
+        self._refresh_handle = asyncio.get_event_loop().call_later(
+            delay, self._start_refresh
+        )
+
     def get_req_obj(self):
         return {
             "auth": {
@@ -121,10 +283,186 @@ class KeystoneSession(object):
         }
 
 
+class _UploadStream(object):
+    """Reads an upload through read(size), counting and hashing it."""
+    def __init__(self, read, chunk_size=STREAM_CHUNK_SIZE):
+        self._read = read
+        self.chunk_size = chunk_size
+        self.sha1 = sha1()
+        self.size = 0
+        self._buffer = b''
+        self._eof = False
+
+    async def _fill(self):
+        if self._buffer or self._eof:
+            return
+        chunk = await self._read(self.chunk_size)
+        if chunk:
+            self.sha1.update(chunk)
+            self.size += len(chunk)
+            self._buffer = chunk
+        else:
+            self._eof = True
+
+    async def at_eof(self):
+        await self._fill()
+        return not self._buffer
+
+    async def read(self, limit):
+        """Return up to limit bytes, or b'' at the end of the stream."""
+        await self._fill()
+        chunk = self._buffer[:limit]
+        self._buffer = self._buffer[limit:]
+        return chunk
+
+
+class _StreamBody(object):
+    """Request body of up to limit bytes from an _UploadStream.
+
+    Sent with chunked transfer encoding, one stream chunk at a time.
+    """
+    def __init__(self, stream, limit=None):
+        self._stream = stream
+        self.limit = limit
+        self.md5 = md5()
+        self.size = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        want = self._stream.chunk_size
+        if self.limit is not None:
+            want = min(want, self.limit - self.size)
+        chunk = b''
+        if want > 0:
+            chunk = await self._stream.read(want)
+        if not chunk:
+            raise StopAsyncIteration()
+        self.md5.update(chunk)
+        self.size += len(chunk)
+        return chunk
+
+
+class _SegmentSource(object):
+    """Random access reads from bytes or a file for segmented uploads."""
+    def __init__(self, data):
+        self._data = data
+        if hasattr(data, 'fileno'):
+            self.size = os.fstat(data.fileno()).st_size
+        else:
+            self._data = memoryview(data)
+            self.size = len(self._data)
+
+    async def read(self, offset, size):
+        if isinstance(self._data, memoryview):
+            return self._data[offset:offset + size]
+        # pread does not move the file offset, so reads can overlap
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, os.pread,
+                                          self._data.fileno(), size, offset)
+
+
+def format_range(start, end=None):
+    """Return a Range header for bytes start to end inclusive.
+
+    A negative start with no end means the last -start bytes.
+    """
+    if start < 0:
+        return 'bytes=%d' % start
+    return 'bytes=%d-%s' % (start, '' if end is None else end)
+
+
+class ObjectReader(object):
+    """A GET of a swift object, for use as an async context manager.
+
+    The body is not read until asked for, so it can be streamed through
+    in chunks. status is 200, or 206 for a range request.
+    """
+    def __init__(self, swift_client, uri, range_header=None):
+        self._swift_client = swift_client
+        self._uri = uri
+        self._range_header = range_header
+        self._session = None
+        self._response = None
+        self.status = None
+        self.headers = None
+
+    async def __aenter__(self):
+        self._session = _client_session(self._swift_client.http_session)
+        client = await self._session.__aenter__()
+        try:
+            self._response = await self._get(client)
+        except BaseException:
+            await self._session.__aexit__(None, None, None)
+            raise
+        self.status = self._response.status
+        self.headers = self._response.headers
+        return self
+
+    async def __aexit__(self, *args):
+        self._response.release()
+        await self._session.__aexit__(*args)
+
+    async def _get(self, client):
+        keystone_session = self._swift_client._keystone_session
+        token = await keystone_session.get_token()
+        headers = {}
+        if self._range_header is not None:
+            headers['Range'] = self._range_header
+        for attempt in range(2):
+            if attempt > 0:
+                token = await keystone_session.invalidate(token)
+            headers['X-Auth-Token'] = token.token_id
+            response = await client.get(self._uri, headers=headers)
+            if response.status != 401:
+                break
+            response.release()
+
+        if response.status in (200, 206):
+            return response
+        response.release()
+        if response.status == 404:
+            raise ObjectNotFoundError(self._uri)
+        if response.status == 416:
+            raise RangeNotSatisfiableError(
+                response.headers.get('Content-Range')
+            )
+        raise SwiftError('GET of %s failed with status %d'
+                         % (self._uri, response.status))
+
+    @property
+    def content_length(self):
+        return self._response.content_length
+
+    async def read_chunk(self, size=STREAM_CHUNK_SIZE):
+        """Return up to size bytes of the body, or b'' at the end."""
+        return await self._response.content.read(size)
+
+    async def read(self):
+        return await self._response.read()
+
+
+def _segment_entry(container, name, etag, size):
+    return {
+        'path': '/%s/%s' % (container, name),
+        'etag': etag,
+        'size_bytes': size
+    }
+
+
 class SwiftClient(object):
     def __init__(self, keystone_session, region_id, interface='public',
-                 container=None, temp_url_key=None):
+                 container=None, temp_url_key=None, http_session=None,
+                 segment_size=DEFAULT_SEGMENT_SIZE,
+                 large_object_threshold=DEFAULT_LARGE_OBJECT_THRESHOLD,
+                 upload_concurrency=4, segment_retries=3):
         self._keystone_session = keystone_session
+        self.http_session = http_session
+        self.segment_size = segment_size
+        self.large_object_threshold = large_object_threshold
+        self.upload_concurrency = upload_concurrency
+        self.segment_retries = segment_retries
         self.region_id = region_id
         self.interface = interface
         self.container = container
@@ -132,7 +470,7 @@ class SwiftClient(object):
         self.temp_url_key = temp_url_key
 
     async def __aenter__(self):
-        catalog = self._keystone_session.catalog
+        catalog = await self._keystone_session.get_catalog()
         object_services = list(catalog.get_services('object-store'))
         assert len(object_services) == 1
         self.service = object_services[0]
@@ -150,19 +488,201 @@ class SwiftClient(object):
         assert container is not None or self.container is not None
         container = container or self.container
         put_uri = '%s/%s/%s' % (self.endpoint.url, container, name)
-        headers = {'X-Auth-Token': self._keystone_session.token.token_id}
-        async with aiohttp.ClientSession() as client:
-            async with client.put(put_uri, data=data, headers=headers) as req:
-                await req.text()
-                assert req.status == 201
+        status = await self._request('PUT', put_uri, data=data)
+        assert status == 201
+
+    def open_object(self, name, container=None, range_header=None):
+        """Return an ObjectReader for streaming an object.
+
+        range_header is passed to swift as the Range header, see
+        format_range.
+        """
+        assert container is not None or self.container is not None
+        container = container or self.container
+        uri = '%s/%s/%s' % (self.endpoint.url, container, name)
+        return ObjectReader(self, uri, range_header)
+
+    async def delete_object(self, name, container=None):
+        """Delete an object, and its segments if it is a large object."""
+        assert container is not None or self.container is not None
+        container = container or self.container
+        delete_uri = '%s/%s/%s?multipart-manifest=delete' % (
+            self.endpoint.url, container, name
+        )
+        status = await self._request('DELETE', delete_uri)
+        if status not in (200, 204, 404):
+            raise SwiftError('Delete of %s/%s failed with status %d'
+                             % (container, name, status))
+
+    async def upload_stream(self, name, read, container=None,
+                            size_hint=None):
+        """Upload the bytes returned by read(size) until it returns b''.
+
+        Only one chunk is held in memory at a time. If size_hint is unknown
+        or above large_object_threshold the object is stored as a static
+        large object of segment_size segments. Returns the sha1 hexdigest
+        and size of the data.
+        """
+        assert container is not None or self.container is not None
+        container = container or self.container
+        stream = _UploadStream(read)
+        if (size_hint is not None and
+                size_hint <= self.large_object_threshold):
+            await self._put_stream(container, name, _StreamBody(stream))
+        else:
+            await self._upload_segmented(container, name, stream)
+        return stream.sha1.hexdigest(), stream.size
+
+    async def _put_stream(self, container, name, body):
+        put_uri = '%s/%s/%s' % (self.endpoint.url, container, name)
+        # A streamed body cannot be sent twice, so no retry on 401
+        status = await self._request('PUT', put_uri, data=body, retry=False)
+        if status != 201:
+            raise SwiftError('Upload of %s/%s failed with status %d'
+                             % (container, name, status))
+
+    async def _upload_segmented(self, container, name, stream):
+        if await stream.at_eof():
+            await self.create_object(name, b'', container)
+            return
+
+        segment_container = container + SEGMENT_CONTAINER_SUFFIX
+        await self._create_container(segment_container)
+        segments = []
+        while not await stream.at_eof():
+            segment_name = '%s/%08d' % (name, len(segments))
+            body = _StreamBody(stream, self.segment_size)
+            await self._put_stream(segment_container, segment_name, body)
+            segments.append(_segment_entry(segment_container, segment_name,
+                                           body.md5.hexdigest(), body.size))
+        await self._put_slo_manifest(container, name, segments)
+
+    async def create_large_object(self, name, data, container=None,
+                                  segment_size=None, concurrency=None,
+                                  retries=None, manifest='slo'):
+        """Upload data as segments in parallel, then write a manifest.
+
+        data is a bytes-like object or a binary file with a fileno(). At
+        most concurrency segments are read and in flight at once, and each
+        failed segment is retried up to retries times. Both default to the
+        client's upload_concurrency and segment_retries. manifest is 'slo'
+        for a static large object or 'dlo' for a dynamic one. Returns the
+        segment entries of the manifest.
+        """
+        assert manifest in ('slo', 'dlo')
+        assert container is not None or self.container is not None
+        container = container or self.container
+        segment_size = segment_size or self.segment_size
+        if concurrency is None:
+            concurrency = self.upload_concurrency
+        if retries is None:
+            retries = self.segment_retries
+        source = _SegmentSource(data)
+        count = max(1, -(-source.size // segment_size))
+
+        segment_container = container + SEGMENT_CONTAINER_SUFFIX
+        await self._create_container(segment_container)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def upload(index):
+            async with semaphore:
+                chunk = await source.read(index * segment_size, segment_size)
+                return await self._put_segment(
+                    segment_container, '%s/%08d' % (name, index), chunk,
+                    retries
+                )
+
+        tasks = [asyncio.ensure_future(upload(i)) for i in range(count)]
+        try:
+            segments = await asyncio.gather(*tasks)
+        except Exception:
+            for task in tasks:
+                task.cancel()
+            raise
+
+        if manifest == 'slo':
+            await self._put_slo_manifest(container, name, segments)
+        else:
+            await self._put_dlo_manifest(container, name, segment_container)
+        return segments
+
+    async def _put_segment(self, container, name, chunk, retries):
+        etag = md5(chunk).hexdigest()
+        put_uri = '%s/%s/%s' % (self.endpoint.url, container, name)
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                await asyncio.sleep(SEGMENT_RETRY_DELAY * 2 ** (attempt - 1))
+            try:
+                # Swift checks the ETag, so corrupted segments fail too
+                status = await self._request('PUT', put_uri, data=chunk,
+                                             headers={'ETag': etag})
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                LOG.warning('Upload of segment %s/%s failed: %r',
+                            container, name, e)
+                continue
+            if status == 201:
+                return _segment_entry(container, name, etag, len(chunk))
+            LOG.warning('Upload of segment %s/%s failed with status %d',
+                        container, name, status)
+        raise SwiftError('Upload of segment %s/%s failed after %d attempts'
+                         % (container, name, retries + 1))
+
+    async def _create_container(self, container):
+        status = await self._request('PUT', '%s/%s' % (self.endpoint.url,
+                                                       container))
+        if status not in (201, 202):
+            raise SwiftError('Failed to create container %s: status %d'
+                             % (container, status))
+
+    async def _put_slo_manifest(self, container, name, segments):
+        manifest_uri = '%s/%s/%s?multipart-manifest=put' % (
+            self.endpoint.url, container, name
+        )
+        status = await self._request('PUT', manifest_uri,
+                                     data=json.dumps(segments))
+        if status != 201:
+            raise SwiftError('Manifest upload for %s/%s failed with '
+                             'status %d' % (container, name, status))
+
+    async def _put_dlo_manifest(self, container, name, segment_container):
+        manifest_uri = '%s/%s/%s' % (self.endpoint.url, container, name)
+        headers = {'X-Object-Manifest': '%s/%s/' % (segment_container, name)}
+        status = await self._request('PUT', manifest_uri, data=b'',
+                                     headers=headers)
+        if status != 201:
+            raise SwiftError('Manifest upload for %s/%s failed with '
+                             'status %d' % (container, name, status))
+
+    async def _request(self, method, uri, retry=True, headers=None,
+                       **kwargs):
+        """Make an authenticated request and return the response status.
+
+        A 401 means our token was revoked or expired early, so get a new
+        one and, if retry is set, try once more.
+        """
+        headers = dict(headers or {})
+        token = await self._keystone_session.get_token()
+        async with _client_session(self.http_session) as client:
+            for attempt in range(2 if retry else 1):
+                if attempt > 0:
+                    token = await self._keystone_session.invalidate(token)
+                headers['X-Auth-Token'] = token.token_id
+                async with client.request(method, uri, headers=headers,
+                                          **kwargs) as req:
+                    await req.text()
+                    if req.status != 401:
+                        return req.status
+        if not retry:
+            # Make sure the next request uses a new token
+            await self._keystone_session.invalidate(token)
+        return req.status
 
-    async def create_tempurl(self, name, container=None):
+    async def create_tempurl(self, name, container=None, method='PUT',
+                             duration_in_seconds=60 * 60 * 2):
         assert container is not None or self.container is not None
         container = container or self.container
-        method = 'PUT'
         proto, barf, host, version, auth_account = self.endpoint.url.split('/')
         location = "/" + "/".join([version, auth_account, container, name])
-        duration_in_seconds = 60 * 60 * 2
         expires = str(int(time() + duration_in_seconds))
         hmac_body = b"\n".join(map(lambda x: x.encode(),
                                    [method, expires, location]))
@@ -1,5 +1,15 @@
+import asyncio
 import collections
+import datetime
+from hashlib import md5
 from hashlib import sha1
+import json
+import re
+
+from aiohttp import test_utils
+from aiohttp import web
+
+from cheeseshop import swift
 from cheeseshop.swift import SwiftClient
 
 
@@ -26,6 +36,9 @@ class FakeKeystoneSession(object):
     async def __aexit__(self, *args, **kwargs):
         pass
 
+    async def close(self):
+        pass
+
 
 class FakeEndpoint(object):
     def __init__(self, url):
@@ -34,7 +47,7 @@ class FakeEndpoint(object):
 
 class FakeSwiftClient(SwiftClient):
     def __init__(self, keystone_session, region_id, interface='public',
-                 temp_url_key=None):
+                 temp_url_key=None, **kwargs):
         global swift_storage
         if swift_storage is None:
             swift_storage = collections.defaultdict(dict)
@@ -51,10 +64,65 @@ class FakeSwiftClient(SwiftClient):
     async def create_object(self, name, data, container):
         set_swift_object(name, data, container)
 
+    async def upload_stream(self, name, read, container, size_hint=None):
+        data = bytearray()
+        while True:
+            chunk = await read(64 * 1024)
+            if not chunk:
+                break
+            data.extend(chunk)
+        set_swift_object(name, bytes(data), container)
+        return sha1(data).hexdigest(), len(data)
+
+    async def delete_object(self, name, container):
+        swift_storage[container].pop(name, None)
+
+    def open_object(self, name, container, range_header=None):
+        return FakeObjectReader(swift_storage[container].get(name),
+                                range_header)
+
     async def get_object(self, name, container):
         return get_swift_object(name, container)
 
 
+class FakeObjectReader(object):
+    """Serves an object from memory like swift.ObjectReader."""
+    def __init__(self, data, range_header=None):
+        self._data = data
+        self._range_header = range_header
+        self.headers = {}
+
+    async def __aenter__(self):
+        if self._data is None:
+            raise swift.ObjectNotFoundError()
+        self.status = 200
+        if self._range_header is not None:
+            match = re.match(r'bytes=(\d*)-(\d*)$', self._range_header)
+            start, end = match.groups()
+            size = len(self._data)
+            if not start:
+                start, end = size - int(end), size - 1
+            else:
+                start = int(start)
+                end = min(int(end), size - 1) if end else size - 1
+            if start >= size:
+                raise swift.RangeNotSatisfiableError('bytes */%d' % size)
+            self.status = 206
+            self.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end,
+                                                                size)
+            self._data = self._data[start:end + 1]
+        self.content_length = len(self._data)
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def read_chunk(self, size=64 * 1024):
+        chunk = self._data[:size]
+        self._data = self._data[size:]
+        return chunk
+
+
 class FakeHmac(object):
     def __init__(self, key, hmac_body, digest=sha1):
         self.key = key
@@ -63,3 +131,237 @@ class FakeHmac(object):
 
     def hexdigest(self):
         return "DAEDBEFFCAFE"
+
+
+class FakeKeystoneSwift(object):
+    """Serves keystone tokens and a swift object store.
+
+    If stream_bandwidth is set each request body is read no faster than
+    that many bytes per second, like a single TCP stream to a remote
+    swift. The next fail_puts object PUTs get a 503.
+    """
+    def __init__(self, expires_in=3600, stream_bandwidth=None):
+        self.expires_in = expires_in
+        self.stream_bandwidth = stream_bandwidth
+        self.fail_puts = 0
+        self.auth_count = 0
+        self.revoked = set()
+        self.objects = {}
+        self.containers = set()
+        self.manifests = set()
+        # Client addresses seen, one per connection
+        self.peers = set()
+        self.server = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/v3/auth/tokens', self.handle_auth)
+        app.router.add_put('/v1/AUTH_test/{container}',
+                           self.handle_put_container)
+        app.router.add_put('/v1/AUTH_test/{container}/{name:.+}',
+                           self.handle_put)
+        app.router.add_delete('/v1/AUTH_test/{container}/{name:.+}',
+                              self.handle_delete)
+        app.router.add_get('/v1/AUTH_test/{container}/{name:.+}',
+                           self.handle_get)
+        self.server = test_utils.TestServer(app)
+        await self.server.start_server()
+
+    async def close(self):
+        await self.server.close()
+
+    @property
+    def url(self):
+        return str(self.server.make_url('')).rstrip('/')
+
+    async def handle_auth(self, request):
+        self.auth_count += 1
+        # Give concurrent callers a chance to pile up
+        await asyncio.sleep(0.01)
+        expires_at = (datetime.datetime.utcnow() +
+                      datetime.timedelta(seconds=self.expires_in))
+        catalog = [{
+            'id': 'swift-id',
+            'name': 'swift',
+            'type': 'object-store',
+            'endpoints': [{
+                'id': 'endpoint-id',
+                'interface': 'public',
+                'region': 'region',
+                'region_id': 'region',
+                'url': '%s/v1/AUTH_test' % self.url
+            }]
+        }]
+        return web.json_response(
+            {'token': {
+                'expires_at': expires_at.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+                'catalog': catalog
+            }},
+            status=201,
+            headers={'X-Subject-Token': 'token-%d' % self.auth_count}
+        )
+
+    async def handle_put(self, request):
+        self.peers.add(request.transport.get_extra_info('peername'))
+        if request.headers['X-Auth-Token'] in self.revoked:
+            return web.Response(status=401)
+        key = (request.match_info['container'], request.match_info['name'])
+        data = await self._read_body(request)
+        if self.fail_puts > 0:
+            self.fail_puts -= 1
+            return web.Response(status=503)
+        if ('ETag' in request.headers and
+                request.headers['ETag'] != md5(data).hexdigest()):
+            return web.Response(status=422)
+        if 'X-Object-Manifest' in request.headers:
+            container, prefix = request.headers['X-Object-Manifest'].split(
+                '/', 1
+            )
+            data = b''.join(self.objects[(c, name)]
+                            for c, name in sorted(self.objects)
+                            if c == container and name.startswith(prefix))
+            self.manifests.add(key)
+        elif request.query.get('multipart-manifest') == 'put':
+            segments = []
+            for segment in json.loads(data.decode()):
+                container, name = segment['path'].lstrip('/').split('/', 1)
+                segment_data = self.objects[(container, name)]
+                if (md5(segment_data).hexdigest() != segment['etag'] or
+                        len(segment_data) != segment['size_bytes']):
+                    return web.Response(status=400)
+                segments.append(segment_data)
+            data = b''.join(segments)
+            self.manifests.add(key)
+        self.objects[key] = data
+        return web.Response(status=201)
+
+    async def _read_body(self, request):
+        if self.stream_bandwidth is None:
+            return await request.read()
+        data = bytearray()
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        while True:
+            chunk = await request.content.read(64 * 1024)
+            if not chunk:
+                return bytes(data)
+            data.extend(chunk)
+            delay = start + len(data) / self.stream_bandwidth - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def handle_get(self, request):
+        if request.headers['X-Auth-Token'] in self.revoked:
+            return web.Response(status=401)
+        key = (request.match_info['container'], request.match_info['name'])
+        if key not in self.objects:
+            return web.Response(status=404)
+        data = self.objects[key]
+        if 'Range' not in request.headers:
+            return web.Response(body=data,
+                                headers={'ETag': md5(data).hexdigest()})
+        rng = request.http_range
+        start, stop, _ = rng.indices(len(data))
+        if start >= len(data):
+            return web.Response(
+                status=416, headers={'Content-Range': 'bytes */%d'
+                                     % len(data)}
+            )
+        return web.Response(
+            status=206, body=data[start:stop],
+            headers={'Content-Range': 'bytes %d-%d/%d'
+                     % (start, stop - 1, len(data))}
+        )
+
+    async def handle_delete(self, request):
+        key = (request.match_info['container'], request.match_info['name'])
+        if key not in self.objects:
+            return web.Response(status=404)
+        if (request.query.get('multipart-manifest') == 'delete' and
+                key in self.manifests):
+            prefix = key[1] + '/'
+            for segment in list(self.objects):
+                if (segment[0] == key[0] + '_segments' and
+                        segment[1].startswith(prefix)):
+                    del self.objects[segment]
+            self.manifests.discard(key)
+        del self.objects[key]
+        return web.Response(status=204)
+
+    async def handle_put_container(self, request):
+        container = request.match_info['container']
+        if container in self.containers:
+            return web.Response(status=202)
+        self.containers.add(container)
+        return web.Response(status=201)
+
+
+class FakeHltv(object):
+    """Serves hltv results and match pages and demo downloads.
+
+    matches maps a match id to its demo bytes, or None for a match without
+    a demo yet. Demo downloads honour Range requests unless ignore_range
+    is set, or answer them with the whole demo as a 206 if
+    whole_range is set.
+    """
+    def __init__(self, matches, ignore_range=False, whole_range=False):
+        self.matches = matches
+        self.ignore_range = ignore_range
+        self.whole_range = whole_range
+        self.requests = collections.Counter()
+        self.ranges = []
+        self.server = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/results', self.handle_results)
+        app.router.add_get('/matches/{id}/{slug}', self.handle_match)
+        app.router.add_get('/download/demo/{id}', self.handle_demo)
+        self.server = test_utils.TestServer(app)
+        await self.server.start_server()
+
+    async def close(self):
+        await self.server.close()
+
+    @property
+    def url(self):
+        return str(self.server.make_url('')).rstrip('/')
+
+    async def handle_results(self, request):
+        self.requests[request.path] += 1
+        links = ''.join('<a href="/matches/%s/team-vs-team-%s">match</a>'
+                        % (match_id, match_id) for match_id in self.matches)
+        return web.Response(text='<html><body>%s</body></html>' % links,
+                            content_type='text/html')
+
+    async def handle_match(self, request):
+        self.requests[request.path] += 1
+        match_id = request.match_info['id']
+        demo = ''
+        if self.matches[match_id] is not None:
+            demo = '<a href="/download/demo/%s">GOTV Demo</a>' % match_id
+        return web.Response(
+            text='<html><body><div class="date" data-unix="1500000000000">'
+                 '</div>%s</body></html>' % demo,
+            content_type='text/html'
+        )
+
+    async def handle_demo(self, request):
+        self.requests[request.path] += 1
+        data = self.matches[request.match_info['id']]
+        self.ranges.append(request.headers.get('Range'))
+        if 'Range' not in request.headers or self.ignore_range:
+            return web.Response(body=data)
+        start, stop, _ = request.http_range.indices(len(data))
+        if self.whole_range:
+            start, stop = 0, len(data)
+        if start >= len(data):
+            return web.Response(
+                status=416, headers={'Content-Range': 'bytes */%d'
+                                     % len(data)}
+            )
+        return web.Response(
+            status=206, body=data[start:stop],
+            headers={'Content-Range': 'bytes %d-%d/%d'
+                     % (start, stop - 1, len(data))}
+        )
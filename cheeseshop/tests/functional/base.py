@@ -1,10 +1,7 @@
 # import asyncio
 import copy
 
-from aiohttp import web
 from aiohttp.test_utils import TestClient
-import aiohttp_jinja2
-import jinja2
 
 from cheeseshop import db, dbapi
 from cheeseshop import main as cs_main
@@ -21,16 +18,8 @@ class FunctionalTestCase(base.TestCase):
         await self.client.start_server()
 
     def make_app(self):
-        app = cs_main.App(self.config, self.pool)
-        web_app = web.Application()
-        app.add_routes(web_app.router)
-
-        aiohttp_jinja2.setup(
-            web_app,
-            loader=jinja2.PackageLoader('cheeseshop', 'templates')
-        )
-
-        return web_app
+        self.cs_app = cs_main.App(self.config, self.pool)
+        return self.cs_app.make_web_app()
 
     async def _create_db(self):
         # We need to use db 'postgres' while creating our test db
@@ -1,4 +1,8 @@
+import datetime
+import json
+
 from cheeseshop import dbapi
+from cheeseshop import jsondelta
 from cheeseshop.tests.functional import base
 
 
@@ -36,3 +40,280 @@ class TestDbApi(base.FunctionalTestCase):
 
             replay = await dbapi.Replay.get_by_sha1sum(conn, '1234')
             self.assertEqual(replay, my_replay)
+
+    async def test_replay_analysis(self):
+        async with self.pool.acquire() as conn:
+            game = await dbapi.Game.get_by_name(conn, 'sc2')
+            replay = await dbapi.Replay.create(
+                conn, 'uuid-1234', game.id,
+                dbapi.ReplayUploadState.COMPLETE, '1234'
+            )
+            await dbapi.ReplayAnalysis.upsert_many(
+                conn, 'player_names', 1,
+                [('1234', [{'name': 'a'}]), ('unknown', [])]
+            )
+            await dbapi.ReplayAnalysis.upsert_many(
+                conn, 'player_names', 1, [('1234', [{'name': 'b'}])]
+            )
+            await dbapi.ReplayAnalysis.upsert_many(
+                conn, 'player_names', 2, [('1234', [{'name': 'c'}])]
+            )
+
+            self.assertEqual(
+                await dbapi.ReplayAnalysis.get_sha1sums(conn, 'player_names',
+                                                        1),
+                {'1234'}
+            )
+            self.assertEqual(
+                await dbapi.ReplayAnalysis.get_sha1sums(conn,
+                                                        'supply_breakdown',
+                                                        1),
+                set()
+            )
+            analysis = await dbapi.ReplayAnalysis.get(conn, replay.id,
+                                                      'player_names', 1)
+            self.assertEqual(json.loads(analysis.result), [{'name': 'b'}])
+            analysis = await dbapi.ReplayAnalysis.get(conn, replay.id,
+                                                      'player_names')
+            self.assertEqual(analysis.version, 2)
+            with self.assertRaises(dbapi.NotFoundError):
+                await dbapi.ReplayAnalysis.get(conn, replay.id,
+                                               'supply_breakdown')
+
+            await replay.delete(conn)
+            self.assertEqual(
+                await dbapi.ReplayAnalysis.get_sha1sums(conn, 'player_names',
+                                                        2),
+                set()
+            )
+
+    async def test_replay_players(self):
+        async with self.pool.acquire() as conn:
+            game = await dbapi.Game.get_by_name(conn, 'sc2')
+            replay = await dbapi.Replay.create(
+                conn, 'uuid-1234', game.id,
+                dbapi.ReplayUploadState.COMPLETE, '1234'
+            )
+            players = [{'pid': pid, 'name': 'player %d' % pid,
+                        'race': 'Zerg', 'pick_race': 'Random', 'team': pid,
+                        'result': None, 'is_human': True}
+                       for pid in (2, 1)]
+            await dbapi.ReplayPlayer.upsert_many(conn, 1,
+                                                 [('1234', players)])
+            players[0]['race'] = 'Terran'
+            await dbapi.ReplayPlayer.upsert_many(conn, 2,
+                                                 [('1234', players)])
+
+            by_replay = await dbapi.ReplayPlayer.get_by_replay_ids(
+                conn, [replay.id, replay.id + 1]
+            )
+            self.assertEqual(by_replay[replay.id + 1], [])
+            self.assertEqual([(p.pid, p.version, p.race)
+                              for p in by_replay[replay.id]],
+                             [(1, 2, 'Zerg'), (2, 2, 'Terran')])
+
+    async def test_event_map_relation_create_many_missing(self):
+        async with self.pool.acquire() as conn:
+            streamer = await dbapi.CsGoStreamer.create(conn, 'uuid',
+                                                       'streamer')
+            now = datetime.datetime.now()
+            events = await dbapi.CsGoGsiEvent.create_many(
+                conn, [(now, streamer.id, '{}'), (now, streamer.id, '{}')]
+            )
+            map_ = await dbapi.CsGoMap.create(conn, 'map-uuid', now,
+                                              streamer.id, 'de_dust2',
+                                              'team 1', 'team 2')
+            relations = [(events[0].id, map_.id)]
+            self.assertEqual(
+                await dbapi.CsGoEventMapRelation.create_many_missing(
+                    conn, relations
+                ),
+                1
+            )
+            relations.append((events[1].id, map_.id))
+            self.assertEqual(
+                await dbapi.CsGoEventMapRelation.create_many_missing(
+                    conn, relations
+                ),
+                1
+            )
+            await dbapi.CsGoEventMapRelation.create(conn, events[0].id,
+                                                    map_.id)
+            ev_maps = await dbapi.CsGoEventMapRelation.get_next(conn,
+                                                                streamer.id)
+            self.assertEqual([ev.id for ev, _ in ev_maps],
+                             [events[0].id, events[1].id])
+
+    async def test_gsi_event_create_many(self):
+        async with self.pool.acquire() as conn:
+            streamer = await dbapi.CsGoStreamer.create(conn, 'streamer-uuid',
+                                                       'a streamer')
+            now = datetime.datetime.now()
+            events = await dbapi.CsGoGsiEvent.create_many(conn, [
+                (now, streamer.id, json.dumps({'tick': tick}))
+                for tick in range(3)
+            ])
+            self.assertEqual(len(events), 3)
+            self.assertEqual(sorted(ev.id for ev in events),
+                             [ev.id for ev in events])
+
+            async with conn.transaction():
+                stored = await dbapi.CsGoGsiEvent.get_oldest_by_streamer_id(
+                    conn, streamer.id
+                )
+            self.assertEqual([ev.id for ev in stored],
+                             [ev.id for ev in events])
+            self.assertEqual([json.loads(ev.event)['tick'] for ev in stored],
+                             [0, 1, 2])
+
+    async def test_gsi_event_get_next(self):
+        async with self.pool.acquire() as conn:
+            streamer = await dbapi.CsGoStreamer.create(conn, 'streamer-uuid',
+                                                       'a streamer')
+            events = await dbapi.CsGoGsiEvent.create_many(conn, [
+                (datetime.datetime.now(), streamer.id, json.dumps({}))
+                for _ in range(5)
+            ])
+
+            async with conn.transaction():
+                page = await dbapi.CsGoGsiEvent.get_next_by_streamer_id(
+                    conn, streamer.id, limit=3
+                )
+                self.assertEqual([ev.id for ev in page],
+                                 [ev.id for ev in events[:3]])
+                page = await dbapi.CsGoGsiEvent.get_next_by_streamer_id(
+                    conn, streamer.id, after_id=page[-1].id, limit=3
+                )
+                self.assertEqual([ev.id for ev in page],
+                                 [ev.id for ev in events[3:]])
+
+    async def test_gsi_event_get_next_since(self):
+        async with self.pool.acquire() as conn:
+            streamer = await dbapi.CsGoStreamer.create(conn, 'streamer-uuid',
+                                                       'a streamer')
+            now = datetime.datetime.now()
+            old, new = await dbapi.CsGoGsiEvent.create_many(conn, [
+                (now - datetime.timedelta(days=1), streamer.id, '{}'),
+                (now, streamer.id, '{}')
+            ])
+
+            async with conn.transaction():
+                page = await dbapi.CsGoGsiEvent.get_next_by_streamer_id(
+                    conn, streamer.id, since=now
+                )
+            self.assertEqual([ev.id for ev in page], [new.id])
+
+    async def test_gsi_event_map_bounds(self):
+        async with self.pool.acquire() as conn:
+            streamer = await dbapi.CsGoStreamer.create(conn, 'streamer-uuid',
+                                                       'a streamer')
+            start = datetime.datetime.now() - datetime.timedelta(days=1)
+            next_start = start + datetime.timedelta(hours=1)
+            map_ = await dbapi.CsGoMap.create(conn, 'map-uuid', start,
+                                              streamer.id, 'de_dust2',
+                                              'team 1', 'team 2')
+            self.assertIsNone(await dbapi.CsGoMap.get_end_time(conn, map_))
+            await dbapi.CsGoMap.create(conn, 'next-map-uuid', next_start,
+                                       streamer.id, 'de_nuke', 'team 1',
+                                       'team 2')
+            self.assertEqual(await dbapi.CsGoMap.get_end_time(conn, map_),
+                             next_start)
+
+            # Only the event from while the map was played is replayed, even
+            # if the others were wrongly linked to it
+            events = await dbapi.CsGoGsiEvent.create_many(conn, [
+                (start - datetime.timedelta(hours=1), streamer.id, '{}'),
+                (start, streamer.id, '{}'),
+                (next_start + datetime.timedelta(hours=1), streamer.id, '{}')
+            ])
+            await dbapi.CsGoEventMapRelation.create_many(
+                conn, [(ev.id, map_.id) for ev in events]
+            )
+            async with conn.transaction():
+                replayed = await dbapi.CsGoGsiEvent.get_by_map_uuid(
+                    conn, 'map-uuid'
+                )
+            self.assertEqual([ev.id for ev in replayed], [events[1].id])
+
+    async def test_gsi_event_retention(self):
+        async with self.pool.acquire() as conn:
+            streamer = await dbapi.CsGoStreamer.create(conn, 'streamer-uuid',
+                                                       'a streamer')
+            old_month = datetime.datetime(2001, 1, 1)
+            if await dbapi.CsGoGsiEvent.is_partitioned(conn):
+                partitions = await dbapi.CsGoGsiEventPartition.ensure(
+                    conn, old_month, months_ahead=0
+                )
+                self.assertEqual([p.start for p in partitions], [old_month])
+
+            old, new = await dbapi.CsGoGsiEvent.create_many(conn, [
+                (datetime.datetime(2001, 1, 15), streamer.id, '{}'),
+                (datetime.datetime.now(), streamer.id, '{}')
+            ])
+            await dbapi.CsGoGsiEvent.delete_older_than(
+                conn, datetime.datetime(2001, 3, 1)
+            )
+
+            async with conn.transaction():
+                events = await dbapi.CsGoGsiEvent.get_next_by_streamer_id(
+                    conn, streamer.id
+                )
+            self.assertEqual([ev.id for ev in events], [new.id])
+
+    async def test_gsi_event_delta(self):
+        async with self.pool.acquire() as conn:
+            streamer = await dbapi.CsGoStreamer.create(conn, 'streamer-uuid',
+                                                       'a streamer')
+            encoder = jsondelta.KeyframeEncoder(keyframe_interval=2)
+            docs = [{'tick': tick, 'static': 'x' * 100} for tick in range(5)]
+            ids = await dbapi.CsGoGsiEvent.reserve_ids(conn, len(docs))
+            rows = []
+            for id_, doc in zip(ids, docs):
+                text, keyframe_id = encoder.encode(id_, doc, json.dumps(doc))
+                rows.append((datetime.datetime.now(), streamer.id, text,
+                             keyframe_id))
+            await dbapi.CsGoGsiEvent.create_many(conn, rows, ids=ids)
+
+            async with conn.transaction():
+                stored = await dbapi.CsGoGsiEvent.get_by_streamer_id(
+                    conn, streamer.id
+                )
+            self.assertEqual([json.loads(ev.event) for ev in stored], docs)
+
+            # Paging past the keyframe still finds it
+            async with conn.transaction():
+                page = await dbapi.CsGoGsiEvent.get_next_by_streamer_id(
+                    conn, streamer.id, after_id=ids[0]
+                )
+            self.assertEqual([json.loads(ev.event) for ev in page], docs[1:])
+
+    async def test_gsi_event_delta_retention(self):
+        async with self.pool.acquire() as conn:
+            streamer = await dbapi.CsGoStreamer.create(conn, 'streamer-uuid',
+                                                       'a streamer')
+            january = datetime.datetime(2001, 1, 1)
+            february = datetime.datetime(2001, 2, 1)
+            if await dbapi.CsGoGsiEvent.is_partitioned(conn):
+                await dbapi.CsGoGsiEventPartition.ensure(conn, january,
+                                                         months_ahead=1)
+
+            encoder = jsondelta.KeyframeEncoder()
+            docs = [{'tick': tick, 'static': 'x' * 100} for tick in range(4)]
+            times = [january.replace(day=31), january.replace(day=31),
+                     february, february]
+            ids = await dbapi.CsGoGsiEvent.reserve_ids(conn, len(docs))
+            rows = []
+            for id_, doc, time in zip(ids, docs, times):
+                text, keyframe_id = encoder.encode(id_, doc, json.dumps(doc),
+                                                   time)
+                rows.append((time, streamer.id, text, keyframe_id))
+            await dbapi.CsGoGsiEvent.create_many(conn, rows, ids=ids)
+
+            # Dropping January leaves February's events whole
+            await dbapi.CsGoGsiEvent.delete_older_than(conn, february)
+            async with conn.transaction():
+                stored = await dbapi.CsGoGsiEvent.get_by_streamer_id(
+                    conn, streamer.id
+                )
+            self.assertEqual([json.loads(ev.event) for ev in stored],
+                             docs[2:])
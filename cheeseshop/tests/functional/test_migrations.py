@@ -0,0 +1,211 @@
+import datetime
+import json
+
+from cheeseshop import dbapi
+from cheeseshop import migrations
+from cheeseshop.tests.functional import base
+
+
+# The schema of databases created before migrations existed, which are at
+# version 1. Kept as it was rather than built with dbapi so upgrades are
+# tested from what those databases really hold.
+BASELINE_SCHEMA = [
+    '''
+    CREATE TABLE games(
+        id serial PRIMARY KEY,
+        name text UNIQUE,
+        description text
+    )
+    ''',
+    '''
+    CREATE TYPE replay_upload_state AS ENUM (
+        'error',
+        'uploading_to_swift',
+        'client_uploading_to_swift',
+        'complete'
+    )
+    ''',
+    '''
+    CREATE TABLE replays(
+        id serial PRIMARY KEY,
+        uuid text UNIQUE NOT NULL,
+        game_id integer REFERENCES games (id),
+        upload_state replay_upload_state,
+        sha1sum text UNIQUE
+    )
+    ''',
+    'CREATE UNIQUE INDEX ON replays (uuid)',
+    '''
+    CREATE TABLE cs_go_hltv_event_types(
+        id serial PRIMARY KEY,
+        name text UNIQUE NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE cs_go_hltv_events(
+        id serial PRIMARY KEY,
+        time timestamp,
+        replay_id integer REFERENCES replays (id),
+        type integer REFERENCES cs_go_hltv_event_types,
+        event json
+    )
+    ''',
+    '''
+    CREATE TABLE cs_go_steam_ids(
+        id serial PRIMARY KEY,
+        steam_id text UNIQUE NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE cs_go_death_events(
+        id serial PRIMARY KEY,
+        attacker integer REFERENCES cs_go_steam_ids (id),
+        victim integer REFERENCES cs_go_steam_ids (id),
+        weapon text
+    )
+    ''',
+    '''
+    CREATE TABLE cs_go_streamer(
+        id serial PRIMARY KEY,
+        uuid text UNIQUE NOT NULL,
+        name text UNIQUE NOT NULL
+    )
+    ''',
+    'CREATE UNIQUE INDEX ON cs_go_streamer (uuid)',
+    'CREATE UNIQUE INDEX ON cs_go_streamer (name)',
+    '''
+    CREATE TABLE cs_go_gsi_events(
+        id serial PRIMARY KEY,
+        time timestamp,
+        streamer_id integer REFERENCES cs_go_streamer (id),
+        event json
+    )
+    ''',
+    '''
+    CREATE TABLE cs_go_map(
+        id serial PRIMARY KEY,
+        uuid text UNIQUE,
+        start_time timestamp,
+        streamer_id integer REFERENCES cs_go_streamer (id),
+        map_name text,
+        team_1 text,
+        team_2 text
+    )
+    ''',
+    'CREATE UNIQUE INDEX ON cs_go_map (uuid)',
+    '''
+    CREATE TABLE cs_go_event_map_releation(
+        event_id integer REFERENCES cs_go_gsi_events (id),
+        map_id integer REFERENCES cs_go_map (id)
+    )
+    ''',
+    '''
+    INSERT INTO games(name, description)
+    VALUES ('sc2', 'StarCraft 2'),
+           ('cs:go', 'Counter Strike: Global Offensive')
+    '''
+]
+
+
+def _quiet(msg):
+    pass
+
+
+class TestMigrations(base.FunctionalTestCase):
+    async def _columns(self, conn):
+        """Return the set of (table, column, type) of the schema, leaving
+        out partitions of the GSI events table, whose names differ.
+        """
+        rows = await conn.fetch('''
+            SELECT table_name, column_name, data_type
+            FROM information_schema.columns
+            WHERE table_schema = 'public'
+                AND NOT EXISTS (
+                    SELECT 1 FROM pg_inherits
+                    INNER JOIN pg_class ON pg_class.oid = pg_inherits.inhrelid
+                    WHERE pg_class.relname = table_name
+                )
+        ''')
+        return set((row['table_name'], row['column_name'], row['data_type'])
+                   for row in rows)
+
+    async def _create_baseline(self, conn):
+        await conn.execute('DROP SCHEMA public CASCADE')
+        await conn.execute('CREATE SCHEMA public')
+        async with conn.transaction():
+            for statement in BASELINE_SCHEMA:
+                await conn.execute(statement)
+
+            streamer_id = await conn.fetchval('''
+                INSERT INTO cs_go_streamer(uuid, name)
+                VALUES ('streamer-uuid', 'a streamer') RETURNING id
+            ''')
+            map_id = await conn.fetchval('''
+                INSERT INTO cs_go_map(uuid, start_time, streamer_id)
+                VALUES ('map-uuid', $1, $2) RETURNING id
+            ''', datetime.datetime.now(), streamer_id)
+            for tick in range(3):
+                event_id = await conn.fetchval('''
+                    INSERT INTO cs_go_gsi_events(time, streamer_id, event)
+                    VALUES ($1, $2, $3) RETURNING id
+                ''', datetime.datetime.now(), streamer_id,
+                    json.dumps({'tick': tick}))
+                await conn.execute('''
+                    INSERT INTO cs_go_event_map_releation(event_id, map_id)
+                    VALUES ($1, $2)
+                ''', event_id, map_id)
+            # Made unique by migration 7
+            await conn.execute('''
+                INSERT INTO cs_go_event_map_releation(event_id, map_id)
+                VALUES ($1, $2)
+            ''', event_id, map_id)
+        return streamer_id
+
+    async def test_upgrade_unversioned(self):
+        async with self.pool.acquire() as conn:
+            await migrations.stamp(conn, migrations.latest_version())
+            latest_columns = await self._columns(conn)
+            streamer_id = await self._create_baseline(conn)
+
+            version, pending = await migrations.status(conn)
+            self.assertEqual(version, 1)
+            self.assertEqual([m.version for m in pending],
+                             [m.version for m in migrations.MIGRATIONS[1:]])
+
+            version = await migrations.upgrade(conn, log=_quiet)
+            self.assertEqual(version, migrations.latest_version())
+
+            version, pending = await migrations.status(conn)
+            self.assertEqual(version, migrations.latest_version())
+            self.assertEqual(pending, [])
+
+            # Upgrading again is a no-op
+            version = await migrations.upgrade(conn, log=_quiet)
+            self.assertEqual(version, migrations.latest_version())
+
+            # Upgraded databases have what new ones are created with
+            self.assertEqual(await self._columns(conn), latest_columns)
+            if dbapi.partitioning_supported(conn):
+                self.assertTrue(await dbapi.CsGoGsiEvent.is_partitioned(conn))
+            self.assertEqual(await conn.fetchval('''
+                SELECT count(*) FROM cs_go_event_map_releation
+            '''), 3)
+
+            # Old events are still there and new ones can be added
+            async with conn.transaction():
+                await dbapi.CsGoGsiEvent.create_many(conn, [
+                    (datetime.datetime.now(), streamer_id,
+                     json.dumps({'tick': 3}))
+                ])
+                events = await dbapi.CsGoGsiEvent.get_by_streamer_id(
+                    conn, streamer_id
+                )
+            self.assertEqual([json.loads(event.event)['tick']
+                              for event in events], [0, 1, 2, 3])
+
+    async def test_downgrade_fails(self):
+        async with self.pool.acquire() as conn:
+            # The test db has the latest schema
+            await migrations.stamp(conn, migrations.latest_version())
+            with self.assertRaises(migrations.MigrationError):
+                await migrations.upgrade(conn, target=1, log=_quiet)
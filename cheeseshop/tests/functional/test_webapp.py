@@ -1,12 +1,24 @@
+import asyncio
+import copy
+import hashlib
+import json
+import multiprocessing
 import re
+import socket
+import sys
 from urllib.parse import urlparse
 from urllib.parse import parse_qs
 
+import aiohttp
 from aiohttp import FormData
 import fixtures
 
+from cheeseshop import dbapi
+from cheeseshop.games import csgo
+from cheeseshop import main as cs_main
 from cheeseshop.tests import fakes
 from cheeseshop.tests.functional import base
+from cheeseshop.workers import results
 
 
 class TestUploads(base.FunctionalTestCase):
@@ -38,6 +50,10 @@ class TestUploads(base.FunctionalTestCase):
         uuid = re.search('UUID: (.*)</li>', resp_text).group(1)
         self.assertEqual(fakes.get_swift_object(uuid, 'replays_container'),
                          b'aaaaaaaaaaaa')
+        async with self.pool.acquire() as conn:
+            replay = await dbapi.Replay.get_by_uuid(conn, uuid)
+        self.assertEqual(replay.sha1sum,
+                         hashlib.sha1(b'aaaaaaaaaaaa').hexdigest())
 
         # test that the replay shows up in replay list
         resp = await self.client.get("/list_replays")
@@ -69,6 +85,183 @@ class TestUploads(base.FunctionalTestCase):
                 self.assertEqual(resp.status, 409)
                 self.assertTrue("already exists" in resp_text)
 
+    async def test_upload_duplicate(self):
+        uuids = []
+        for _ in range(2):
+            data = FormData()
+            data.add_field('game', 'sc2')
+            data.add_field('replay_file',
+                           b'duplicate replay',
+                           filename='test.replay',
+                           content_type='text/ascii')
+            with fixtures.MonkeyPatch('cheeseshop.swift.KeystoneSession',
+                                      fakes.FakeKeystoneSession):
+                with fixtures.MonkeyPatch('cheeseshop.swift.SwiftClient',
+                                          fakes.FakeSwiftClient):
+                    resp = await self.client.post("/upload", data=data)
+                    resp_text = await resp.text()
+                    self.assertEqual(resp.status, 200)
+            uuids.append(re.search('UUID: (.*)</li>', resp_text).group(1))
+
+        # The second upload is the first replay, and was not kept in swift
+        self.assertEqual(uuids[0], uuids[1])
+        self.assertTrue('already been uploaded' in resp_text)
+        storage = fakes.swift_storage['replays_container']
+        self.assertEqual(
+            [name for name, value in storage.items()
+             if value == b'duplicate replay'],
+            [uuids[0]]
+        )
+
+    async def test_download(self):
+        data = FormData()
+        data.add_field('game', 'sc2')
+        data.add_field('replay_file',
+                       b'0123456789',
+                       filename='test.replay',
+                       content_type='text/ascii')
+
+        with fixtures.MonkeyPatch('cheeseshop.swift.KeystoneSession',
+                                  fakes.FakeKeystoneSession):
+            with fixtures.MonkeyPatch('cheeseshop.swift.SwiftClient',
+                                      fakes.FakeSwiftClient):
+                resp = await self.client.post("/upload", data=data)
+                uuid = re.search('UUID: (.*)</li>',
+                                 await resp.text()).group(1)
+                uri = '/replays/%s/download' % uuid
+
+                resp = await self.client.get(uri)
+                self.assertEqual(resp.status, 200)
+                self.assertEqual(await resp.read(), b'0123456789')
+                self.assertEqual(resp.headers['Accept-Ranges'], 'bytes')
+
+                resp = await self.client.get(uri,
+                                             headers={'Range': 'bytes=2-4'})
+                self.assertEqual(resp.status, 206)
+                self.assertEqual(await resp.read(), b'234')
+                self.assertEqual(resp.headers['Content-Range'],
+                                 'bytes 2-4/10')
+
+                resp = await self.client.get(uri,
+                                             headers={'Range': 'bytes=20-'})
+                self.assertEqual(resp.status, 416)
+
+                resp = await self.client.get('/replays/no-such-uuid/download')
+                self.assertEqual(resp.status, 404)
+
+    async def test_replay_analyses(self):
+        data = FormData()
+        data.add_field('game', 'sc2')
+        data.add_field('replay_file',
+                       b'0123456789',
+                       filename='test.replay',
+                       content_type='text/ascii')
+
+        with fixtures.MonkeyPatch('cheeseshop.swift.KeystoneSession',
+                                  fakes.FakeKeystoneSession):
+            with fixtures.MonkeyPatch('cheeseshop.swift.SwiftClient',
+                                      fakes.FakeSwiftClient):
+                resp = await self.client.post("/upload", data=data)
+                uuid = re.search('UUID: (.*)</li>',
+                                 await resp.text()).group(1)
+        uri = '/replays/%s/' % uuid
+
+        resp = await self.client.get(uri + 'players')
+        self.assertEqual(resp.status, 404)
+
+        sha1sum = hashlib.sha1(b'0123456789').hexdigest()
+        players = [{'pid': 1, 'name': 'Neeb', 'race': 'Protoss',
+                    'pick_race': 'Protoss', 'team': 1, 'result': 'Win',
+                    'is_human': True}]
+        supply = {'map': 'Echo LE', 'players': []}
+        async with self.pool.acquire() as conn:
+            await results.store(conn, 'player_names', 1,
+                                [(sha1sum, players)])
+            await results.store(conn, 'supply_breakdown', 1,
+                                [(sha1sum, supply)])
+
+        resp = await self.client.get(uri + 'players')
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(await resp.json(), players)
+
+        resp = await self.client.get(uri + 'analyses/supply_breakdown')
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(await resp.json(), supply)
+        self.assertEqual(resp.headers['X-Analysis-Version'], '1')
+
+        resp = await self.client.get(uri + 'analyses/supply_breakdown',
+                                     params={'version': 2})
+        self.assertEqual(resp.status, 404)
+
+        resp = await self.client.get("/list_replays")
+        self.assertIn('Neeb (Protoss)', await resp.text())
+
+    async def test_upload_sha1sum_mismatch(self):
+        data = FormData()
+        data.add_field('game', 'sc2')
+        data.add_field('replay_sha1sum', 'not-the-sha1sum')
+        data.add_field('replay_file',
+                       b'aaaaaaaaaaaa',
+                       filename='test.replay',
+                       content_type='text/ascii')
+
+        with fixtures.MonkeyPatch('cheeseshop.swift.KeystoneSession',
+                                  fakes.FakeKeystoneSession):
+            with fixtures.MonkeyPatch('cheeseshop.swift.SwiftClient',
+                                      fakes.FakeSwiftClient):
+                resp = await self.client.post("/upload", data=data)
+                resp_text = await resp.text()
+                self.assertEqual(resp.status, 400)
+                self.assertTrue("does not match" in resp_text)
+
+    async def _upload(self, content, sha1sum=None):
+        data = FormData()
+        data.add_field('game', 'sc2')
+        if sha1sum is not None:
+            data.add_field('replay_sha1sum', sha1sum)
+        data.add_field('replay_file', content, filename='test.replay',
+                       content_type='text/ascii')
+        with fixtures.MonkeyPatch('cheeseshop.swift.KeystoneSession',
+                                  fakes.FakeKeystoneSession):
+            with fixtures.MonkeyPatch('cheeseshop.swift.SwiftClient',
+                                      fakes.FakeSwiftClient):
+                resp = await self.client.post("/upload", data=data)
+                return resp.status, await resp.text()
+
+    async def test_upload_after_sha1sum_mismatch(self):
+        sha1sum = hashlib.sha1(b'real replay').hexdigest()
+        status, _ = await self._upload(b'other replay', sha1sum)
+        self.assertEqual(status, 400)
+
+        # The claimed sha1sum was not kept for the rejected upload
+        status, resp_text = await self._upload(b'real replay')
+        self.assertEqual(status, 200)
+        self.assertNotIn('already been uploaded', resp_text)
+        uuid = re.search('UUID: (.*)</li>', resp_text).group(1)
+        async with self.pool.acquire() as conn:
+            replay = await dbapi.Replay.get_by_sha1sum(conn, sha1sum)
+        self.assertEqual(replay.uuid, uuid)
+        self.assertEqual(replay.upload_state,
+                         dbapi.ReplayUploadState.COMPLETE)
+
+    async def test_upload_after_failed_upload(self):
+        sha1sum = hashlib.sha1(b'real replay').hexdigest()
+        async with self.pool.acquire() as conn:
+            game = await dbapi.Game.get_by_name(conn, 'sc2')
+            failed = await dbapi.Replay.create(
+                conn, 'failed-uuid', game.id, dbapi.ReplayUploadState.ERROR,
+                sha1sum
+            )
+
+        # Neither a claim of the sha1sum nor the file are duplicates of it
+        status, _ = await self._upload(b'real replay', sha1sum)
+        self.assertEqual(status, 200)
+        async with self.pool.acquire() as conn:
+            replay = await dbapi.Replay.get_by_sha1sum(conn, sha1sum)
+            failed = await dbapi.Replay.get_by_uuid(conn, failed.uuid)
+        self.assertNotEqual(replay.uuid, failed.uuid)
+        self.assertIsNone(failed.sha1sum)
+
     async def test_swift_tempurl_gen(self):
         data = FormData()
         data.add_field('game', 'cs:go')
@@ -108,8 +301,15 @@ class TestCsGoGsi(base.FunctionalTestCase):
         ws_uri = source_base_uri + 'play'
         ws = await self.client.ws_connect(ws_uri)
 
+        resp = await self.client.get(source_base_uri + 'viewers')
+        self.assertEqual(resp.status, 200)
+        viewers = await resp.json()
+        self.assertEqual(len(viewers), 1)
+        self.assertEqual(viewers[0]['dropped'], 0)
+
         gsi_data = {'test-key': 'test-val'}
         await self.client.post(source_base_uri + 'input', json=gsi_data)
+        await self._wait_for_ingest()
 
         resp = await self.client.get(source_base_uri + 'replay')
         self.assertEqual(resp.status, 200)
@@ -138,6 +338,58 @@ class TestCsGoGsi(base.FunctionalTestCase):
 
         await ws2.close()
 
+    async def test_replay_pagination(self):
+        src_uuid = await self._create_source()
+        for tick in range(5):
+            await self._send_gsi(src_uuid, {'tick': tick})
+        replay_uri = self._get_source_base_uri(src_uuid) + 'replay'
+
+        resp = await self.client.get(replay_uri, params={'limit': 2})
+        self.assertEqual(resp.status, 200)
+        page = await resp.json()
+        self.assertEqual([ev['event']['tick'] for ev in page], [0, 1])
+
+        resp = await self.client.get(replay_uri, params={
+            'after_id': page[-1]['id'],
+            'format': 'ndjson'
+        })
+        self.assertEqual(resp.status, 200)
+        lines = (await resp.text()).splitlines()
+        self.assertEqual([json.loads(line)['event']['tick']
+                          for line in lines], [2, 3, 4])
+
+        resp = await self.client.get(replay_uri, params={'after_id': 'a'})
+        self.assertEqual(resp.status, 400)
+        for since in ('inf', '1e20', '-1e20'):
+            resp = await self.client.get(replay_uri, params={'since': since})
+            self.assertEqual(resp.status, 400)
+
+    async def test_replay_across_pages(self):
+        self.useFixture(fixtures.MonkeyPatch(
+            'cheeseshop.games.csgo.EVENT_STREAM_PAGE_SIZE', 2
+        ))
+        src_uuid = await self._create_source()
+        for tick in range(5):
+            await self._send_gsi(src_uuid, {'tick': tick})
+        replay_uri = self._get_source_base_uri(src_uuid) + 'replay'
+
+        for params, ticks in (({}, [0, 1, 2, 3, 4]),
+                              ({'limit': 4}, [0, 1, 2, 3]),
+                              ({'limit': 3}, [0, 1, 2]),
+                              ({'limit': 0}, [])):
+            resp = await self.client.get(replay_uri, params=params)
+            self.assertEqual(resp.status, 200)
+            self.assertEqual([ev['event']['tick'] for ev in await resp.json()],
+                             ticks)
+
+    async def test_unknown_streamer(self):
+        source_base_uri = self._get_source_base_uri('not-a-streamer')
+        resp = await self.client.post(source_base_uri + 'input',
+                                      json={'test-key': 'test-val'})
+        self.assertEqual(resp.status, 404)
+        resp = await self.client.get(source_base_uri + 'replay')
+        self.assertEqual(resp.status, 404)
+
     async def _get_maps(self):
         maps_resp = await self.client.get('/games/csgo/gsi/maps')
         self.assertEqual(maps_resp.status, 200)
@@ -189,6 +441,167 @@ class TestCsGoGsi(base.FunctionalTestCase):
         replay_events = await replay_req.json()
         self.assertEqual(len(replay_events), 2)
 
+    async def test_map_heatmap(self):
+        src_uuid = await self._create_source()
+        gsi_data = {
+            'map': {
+                'phase': 'live',
+                'team_t': {'name': 'team 1'},
+                'team_ct': {'name': 'team 2'},
+                'name': 'de_dust2'
+            },
+            'allplayers': {
+                '1': {'position': '-2476.0, 3239.0, 10.0'},
+                '2': {'position': '0.0, 0.0, 10.0'}
+            }
+        }
+        await self._send_gsi(src_uuid, gsi_data)
+        map_uuid = (await self._get_maps())[0]
+        heatmap_uri = '/games/csgo/gsi/maps/%s/heatmap' % map_uuid
+
+        resp = await self.client.get(heatmap_uri)
+        self.assertEqual(resp.status, 200)
+        heatmap = await resp.json()
+        self.assertEqual(heatmap['map_name'], 'de_dust2')
+        self.assertTrue(heatmap['radar'])
+        self.assertEqual(heatmap['samples'], 2)
+        self.assertFalse(heatmap['complete'])
+        self.assertIn([0, 0, 1], heatmap['cells'])
+
+        gsi_data['map']['phase'] = 'gameover'
+        await self._send_gsi(src_uuid, gsi_data)
+
+        resp = await self.client.get(heatmap_uri,
+                                     params={'format': 'binary'})
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp.headers['X-Heatmap-Samples'], '4')
+        self.assertEqual(resp.headers['X-Heatmap-Complete'], 'true')
+        grid_size = int(resp.headers['X-Heatmap-Grid-Size'])
+        self.assertEqual(len(await resp.read()), 4 * grid_size * grid_size)
+
+        async with self.pool.acquire() as conn:
+            map_ = await dbapi.CsGoMap.get_by_uuid(conn, map_uuid)
+            stored = await dbapi.CsGoMapHeatmap.get_by_map_id(conn, map_.id)
+        self.assertEqual(stored.samples, 4)
+
+        resp = await self.client.get('/games/csgo/gsi/maps/unknown/heatmap')
+        self.assertEqual(resp.status, 404)
+        resp = await self.client.get(heatmap_uri, params={'format': 'png'})
+        self.assertEqual(resp.status, 400)
+
+    async def test_extracts_deaths(self):
+        src_uuid = await self._create_source()
+        gsi_data = {
+            'map': {
+                'phase': 'live',
+                'team_t': {'name': 'team 1'},
+                'team_ct': {'name': 'team 2'},
+                'name': 'de_dust2',
+                'round': 3
+            },
+            'allplayers': {
+                '1': {'match_stats': {'kills': 0, 'deaths': 0}},
+                '2': {'match_stats': {'kills': 0, 'deaths': 0}}
+            }
+        }
+        await self._send_gsi(src_uuid, gsi_data)
+        gsi_data['allplayers']['1']['match_stats']['kills'] = 1
+        gsi_data['allplayers']['1']['weapons'] = {
+            'weapon_0': {'name': 'weapon_awp', 'state': 'active'}
+        }
+        gsi_data['allplayers']['2']['match_stats']['deaths'] = 1
+        await self._send_gsi(src_uuid, gsi_data)
+
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow('''
+                SELECT cs_go_hltv_events.round, cs_go_hltv_events.map_id,
+                       victims.steam_id AS victim,
+                       attackers.steam_id AS attacker,
+                       cs_go_death_events.weapon
+                FROM cs_go_death_events
+                INNER JOIN cs_go_hltv_events
+                    ON cs_go_hltv_events.id = cs_go_death_events.hltv_event_id
+                INNER JOIN cs_go_steam_ids victims
+                    ON victims.id = cs_go_death_events.victim
+                INNER JOIN cs_go_steam_ids attackers
+                    ON attackers.id = cs_go_death_events.attacker
+            ''')
+        self.assertEqual(row['round'], 3)
+        self.assertIsNotNone(row['map_id'])
+        self.assertEqual((row['victim'], row['attacker'], row['weapon']),
+                         ('2', '1', 'weapon_awp'))
+
+    async def test_deathlog_events(self):
+        src_uuid = await self._create_source()
+        source_base_uri = self._get_source_base_uri(src_uuid)
+        resp = await self.client.get(source_base_uri + 'deathlog/events')
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(await resp.json(), {'map_uuid': None, 'events': [],
+                                             'next_round': None,
+                                             'last_gsi_timestamp': None})
+
+        gsi_data = {
+            'map': {
+                'phase': 'live',
+                'team_t': {'name': 'team 1'},
+                'team_ct': {'name': 'team 2'},
+                'name': 'de_dust2',
+                'round': 0
+            },
+            'provider': {'timestamp': 100},
+            'allplayers': {
+                '1': {'match_stats': {'kills': 0, 'deaths': 0}},
+                '2': {'match_stats': {'kills': 0, 'deaths': 0}}
+            }
+        }
+        await self._send_gsi(src_uuid, gsi_data)
+        for round_, deaths in ((0, 1), (6, 2)):
+            gsi_data['map']['round'] = round_
+            gsi_data['provider']['timestamp'] += 1
+            gsi_data['allplayers']['2']['match_stats']['deaths'] = deaths
+            await self._send_gsi(src_uuid, gsi_data)
+
+        resp = await self.client.get(source_base_uri + 'deathlog/events')
+        self.assertEqual(resp.status, 200)
+        page = await resp.json()
+        self.assertEqual([(death['round'], death['steam_id'])
+                          for death in page['events']], [(0, '2')])
+        self.assertEqual(page['next_round'], 5)
+        # Live events up to this are already in the backfill
+        self.assertEqual(page['last_gsi_timestamp'], 101)
+        etag = resp.headers['ETag']
+
+        map_uri = '/games/csgo/gsi/maps/%s/deathlog/events' % page['map_uuid']
+        resp = await self.client.get(map_uri, params={'from_round': 5})
+        page = await resp.json()
+        self.assertEqual([death['round'] for death in page['events']], [6])
+        self.assertIsNone(page['next_round'])
+        self.assertEqual(page['last_gsi_timestamp'], 102)
+
+        resp = await self.client.get(map_uri,
+                                     headers={'If-None-Match': etag})
+        self.assertEqual(resp.status, 304)
+
+        # A new death in the page's rounds changes its ETag
+        gsi_data['map']['round'] = 1
+        gsi_data['allplayers']['2']['match_stats']['deaths'] = 3
+        await self._send_gsi(src_uuid, gsi_data)
+        resp = await self.client.get(map_uri,
+                                     headers={'If-None-Match': etag})
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(len((await resp.json())['events']), 2)
+
+        resp = await self.client.get(
+            '/games/csgo/gsi/maps/%s/moneylog/events' % page['map_uuid']
+        )
+        self.assertEqual((await resp.json())['events'], [])
+        resp = await self.client.get(map_uri, params={'rounds': 0})
+        self.assertEqual(resp.status, 400)
+        resp = await self.client.get(
+            '/games/csgo/gsi/maps/unknown/deathlog/events'
+        )
+        self.assertEqual(resp.status, 404)
+
     async def _create_source(self):
         resp = await self.client.get("/games/csgo/gsi/sources")
         self.assertEqual(resp.status, 200)
@@ -204,9 +617,139 @@ class TestCsGoGsi(base.FunctionalTestCase):
         self.assertTrue(re.search('URL for GSI config: (.*)</p>', resp_text))
         return uuid
 
+    async def test_ingest_retries_failed_batch(self):
+        uuid = await self._create_source()
+        gsi_ingest = self.cs_app._csgo_api.gsi_ingest
+        gsi_ingest.retry_interval = 0
+        write = gsi_ingest._write
+        failures = [RuntimeError('db went away')]
+
+        # Fails after the map of the batch was created
+        async def failing_write(conn, batch):
+            finished_maps = await write(conn, batch)
+            if failures:
+                raise failures.pop()
+            return finished_maps
+        gsi_ingest._write = failing_write
+
+        gsi_data = {
+            'map': {
+                'phase': 'live',
+                'team_t': {'name': 'team 1'},
+                'team_ct': {'name': 'team 2'},
+                'name': 'map name'
+            }
+        }
+        for _ in range(2):
+            resp = await self._send_gsi(uuid, gsi_data)
+            self.assertEqual(resp.status, 200)
+
+        async with self.pool.acquire() as conn:
+            map_ids = await conn.fetch('''
+                SELECT cs_go_map.id FROM cs_go_event_map_releation
+                INNER JOIN cs_go_map
+                    ON cs_go_map.id = cs_go_event_map_releation.map_id
+            ''')
+            self.assertEqual(len(map_ids), 2)
+            self.assertEqual(len(set(row['id'] for row in map_ids)), 1)
+
     def _get_source_base_uri(self, source_uuid):
         return '/games/csgo/gsi/sources/%s/' % source_uuid
 
     async def _send_gsi(self, uuid, gsi_data):
         uri = self._get_source_base_uri(uuid) + 'input'
-        return await self.client.post(uri, json=gsi_data)
+        resp = await self.client.post(uri, json=gsi_data)
+        await self._wait_for_ingest()
+        return resp
+
+    async def _wait_for_ingest(self):
+        await self.cs_app._csgo_api.gsi_ingest.join()
+
+
+def _run_workers(config):
+    sys.exit(cs_main.run_workers(config))
+
+
+class TestRunWorkers(base.FunctionalTestCase):
+    def _free_port(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    async def _wait_for_port(self, port, timeout=30):
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        while True:
+            try:
+                _, writer = await asyncio.open_connection('127.0.0.1', port)
+            except OSError:
+                if loop.time() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+            else:
+                writer.close()
+                return
+
+    def _stop(self, process):
+        if process.is_alive():
+            process.terminate()
+        process.join(30)
+
+    async def test_events_stored_once(self):
+        streamer_uuids = ['streamer-%d' % i for i in range(8)]
+        # Both workers own some of the streamers
+        self.assertEqual(set(csgo.streamer_worker(streamer_uuid, 2)
+                             for streamer_uuid in streamer_uuids), {0, 1})
+        async with self.pool.acquire() as conn:
+            for streamer_uuid in streamer_uuids:
+                await dbapi.CsGoStreamer.create(conn, streamer_uuid,
+                                                streamer_uuid)
+
+        config = copy.deepcopy(self.config)
+        config.workers = 2
+        config.host = '127.0.0.1'
+        config.port = self._free_port()
+        # In a new interpreter, as run_workers forks before it has a loop
+        process = multiprocessing.get_context('spawn').Process(
+            target=_run_workers, args=(config,)
+        )
+        process.start()
+        self.addCleanup(self._stop, process)
+        await self._wait_for_port(config.port)
+
+        gsi_data = {
+            'map': {
+                'phase': 'live',
+                'team_t': {'name': 'team 1'},
+                'team_ct': {'name': 'team 2'},
+                'name': 'map name'
+            }
+        }
+        # A connection per request, so they are accepted by both workers
+        connector = aiohttp.TCPConnector(force_close=True)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            for _ in range(10):
+                for streamer_uuid in streamer_uuids:
+                    url = 'http://127.0.0.1:%d/games/csgo/gsi/sources/%s/' \
+                          'input' % (config.port, streamer_uuid)
+                    async with session.post(url, json=gsi_data) as resp:
+                        self.assertEqual(resp.status, 200)
+
+        # Workers write what they queued before exiting
+        process.terminate()
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, process.join, 30)
+        self.assertEqual(process.exitcode, 0)
+
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch('''
+                SELECT cs_go_streamer.uuid, count(*) FROM cs_go_gsi_events
+                INNER JOIN cs_go_streamer
+                    ON cs_go_streamer.id = cs_go_gsi_events.streamer_id
+                GROUP BY cs_go_streamer.uuid
+            ''')
+        self.assertEqual(dict((row['uuid'], row['count']) for row in rows),
+                         dict((streamer_uuid, 10)
+                              for streamer_uuid in streamer_uuids))
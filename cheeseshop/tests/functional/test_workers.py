@@ -65,3 +65,157 @@ class TestCsGoMapPopulator(base.FunctionalTestCase):
         maps_re = '<li>.*UUID: (.*)</li>'
         maps_srch = re.findall(maps_re, maps_resp_txt)
         self.assertEqual(len(maps_srch), 2)
+
+    async def _create_events(self, conn, streamer, gsi_data, count):
+        for _ in range(count):
+            await dbapi.CsGoGsiEvent.create(conn, datetime.datetime.now(),
+                                            streamer.id, json.dumps(gsi_data))
+
+    async def _linked_events(self, conn, streamer):
+        ev_maps = await dbapi.CsGoEventMapRelation.get_next(
+            conn, streamer.id, limit=1000
+        )
+        return [(ev.id, map_.uuid) for ev, map_ in ev_maps]
+
+    async def test_run_incremental(self):
+        gsi_data = {
+            'map': {
+                'phase': 'live',
+                'team_t': {'name': 'team 1'},
+                'team_ct': {'name': 'team 2'},
+                'name': 'map name'
+            }
+        }
+        async with self.pool.acquire() as conn:
+            streamer = await dbapi.CsGoStreamer.create(conn, 'streamer-uuid',
+                                                       'a streamer')
+            await self._create_events(conn, streamer, gsi_data, 3)
+
+        self.assertEqual(
+            await csgo_map_populator.run(self.pool, 'streamer-uuid', 2), 3
+        )
+        async with self.pool.acquire() as conn:
+            linked = await self._linked_events(conn, streamer)
+            self.assertEqual(len(linked), 3)
+            checkpoint = await dbapi.CsGoMapPopulatorCheckpoint.get(
+                conn, streamer.id
+            )
+            self.assertEqual(checkpoint.last_event_id, linked[-1][0])
+            async with conn.transaction():
+                events = await dbapi.CsGoGsiEvent.get_by_streamer_id(
+                    conn, streamer.id
+                )
+            self.assertEqual(checkpoint.last_event_time, events[-1].time)
+
+        # Nothing new, so nothing is processed or duplicated
+        self.assertEqual(
+            await csgo_map_populator.run(self.pool, 'streamer-uuid', 2), 0
+        )
+
+        # New events of the same map carry on with the checkpointed state
+        async with self.pool.acquire() as conn:
+            await self._create_events(conn, streamer, gsi_data, 2)
+        self.assertEqual(
+            await csgo_map_populator.run(self.pool, 'streamer-uuid', 2), 2
+        )
+        async with self.pool.acquire() as conn:
+            linked = await self._linked_events(conn, streamer)
+            self.assertEqual(len(linked), 5)
+            self.assertEqual(len(set(map_uuid for _, map_uuid in linked)), 1)
+            async with conn.transaction():
+                self.assertEqual(len(await dbapi.CsGoMap.get_all(conn)), 1)
+
+        self.assertEqual(
+            await csgo_map_populator.run(self.pool, 'streamer-uuid', 2,
+                                         reset=True),
+            5
+        )
+        async with self.pool.acquire() as conn:
+            self.assertEqual(len(await self._linked_events(conn, streamer)),
+                             5)
+            async with conn.transaction():
+                self.assertEqual(len(await dbapi.CsGoMap.get_all(conn)), 1)
+
+    async def _extracted_events(self, conn):
+        rows = await conn.fetch('''
+            SELECT cs_go_hltv_event_types.name, victims.steam_id,
+                   attackers.steam_id AS attacker
+            FROM cs_go_hltv_events
+            INNER JOIN cs_go_hltv_event_types
+                ON cs_go_hltv_event_types.id = cs_go_hltv_events.type
+            LEFT JOIN cs_go_steam_ids victims
+                ON victims.id = cs_go_hltv_events.steam_id
+            LEFT JOIN cs_go_death_events
+                ON cs_go_death_events.hltv_event_id = cs_go_hltv_events.id
+            LEFT JOIN cs_go_steam_ids attackers
+                ON attackers.id = cs_go_death_events.attacker
+            ORDER BY cs_go_hltv_events.gsi_event_id, cs_go_hltv_events.id
+        ''')
+        return [(row['name'], row['steam_id'], row['attacker'])
+                for row in rows]
+
+    async def test_run_extracts_events(self):
+        def player(kills, deaths, money):
+            return {'match_stats': {'kills': kills, 'deaths': deaths},
+                    'state': {'money': money}}
+
+        gsi_data = {
+            'map': {
+                'phase': 'live',
+                'team_t': {'name': 'team 1'},
+                'team_ct': {'name': 'team 2'},
+                'name': 'map name',
+                'round': 0
+            },
+            'round': {'phase': 'live'},
+            'allplayers': {'1': player(0, 0, 800), '2': player(0, 0, 800)}
+        }
+        async with self.pool.acquire() as conn:
+            streamer = await dbapi.CsGoStreamer.create(conn, 'streamer-uuid',
+                                                       'a streamer')
+            await self._create_events(conn, streamer, gsi_data, 1)
+            gsi_data['allplayers'] = {'1': player(1, 0, 800),
+                                      '2': player(0, 1, 800)}
+            await self._create_events(conn, streamer, gsi_data, 1)
+            # In the next batch, so diffed against the checkpointed state
+            gsi_data['allplayers'] = {'1': player(1, 0, 1100),
+                                      '2': player(0, 1, 800)}
+            await self._create_events(conn, streamer, gsi_data, 1)
+
+        expected = [('round', None, None), ('death', '2', '1'),
+                    ('money', '1', None)]
+        await csgo_map_populator.run(self.pool, 'streamer-uuid', 2)
+        async with self.pool.acquire() as conn:
+            self.assertEqual(await self._extracted_events(conn), expected)
+
+        await csgo_map_populator.run(self.pool, 'streamer-uuid', 2,
+                                     reset=True)
+        async with self.pool.acquire() as conn:
+            self.assertEqual(await self._extracted_events(conn), expected)
+            self.assertEqual(await conn.fetchval('''
+                SELECT count(*) FROM cs_go_steam_ids
+            '''), 2)
+
+    async def test_run_many(self):
+        gsi_data = {
+            'map': {
+                'phase': 'live',
+                'team_t': {'name': 'team 1'},
+                'team_ct': {'name': 'team 2'},
+                'name': 'map name'
+            }
+        }
+        async with self.pool.acquire() as conn:
+            for i in range(3):
+                streamer = await dbapi.CsGoStreamer.create(
+                    conn, 'streamer-%d' % i, 'streamer %d' % i
+                )
+                await self._create_events(conn, streamer, gsi_data, i + 1)
+
+        processed = await csgo_map_populator.run_many(
+            self.pool, ['streamer-0', 'streamer-1', 'streamer-2'], 2, 2
+        )
+        self.assertEqual(processed, [1, 2, 3])
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                self.assertEqual(len(await dbapi.CsGoMap.get_all(conn)), 3)
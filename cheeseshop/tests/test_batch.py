@@ -0,0 +1,125 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import fixtures
+
+from cheeseshop import config
+from cheeseshop import util
+from cheeseshop.tests import base
+from cheeseshop.workers import batch
+
+REPLAYS = dict((hashlib.sha1(data).hexdigest(), data)
+               for data in (b'replay one', b'replay two'))
+
+
+class ListOutput(object):
+    def __init__(self):
+        self.records = []
+
+    async def write(self, record):
+        self.records.append(record)
+
+
+def square(sha1sum):
+    if sha1sum == 'bad':
+        return {'sha1sum': sha1sum, 'error': 'ValueError: bad replay'}
+    return {'sha1sum': sha1sum, 'result': int(sha1sum) ** 2}
+
+
+async def fake_download(self, sha1sum, fileobj):
+    await asyncio.sleep(0)
+    fileobj.write(REPLAYS[sha1sum])
+
+
+def get_replay_and_downloader(sha1sum, config):
+    path = util.get_replay(sha1sum, config)
+    return path, id(util.get_replay_downloader(config)), os.getpid()
+
+
+class TestBatch(base.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_read_sha1sums(self):
+        self.assertEqual(batch.read_sha1sums(['a\n', '\n', 'b', 'a\n']),
+                         ['a', 'b'])
+
+    async def test_run_batch(self):
+        output = ListOutput()
+        logs = []
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            counts = await batch.run_batch(
+                asyncio.get_event_loop(), executor, square,
+                ['1', '2', 'bad', '3', '4', '5', '6'], output, 2,
+                log=logs.append
+            )
+        self.assertEqual(counts, (6, 1))
+        self.assertEqual(
+            sorted(r['result'] for r in output.records if 'result' in r),
+            [1, 4, 9, 16, 25, 36]
+        )
+        self.assertEqual(logs, ['Failed bad: ValueError: bad replay'])
+
+    async def test_analyze_error(self):
+        os.environ['REPLAY_DIR'] = self.directory
+        self.addCleanup(os.environ.pop, 'REPLAY_DIR')
+        result = batch.analyze('player_names', None, 'missing')
+        self.assertEqual(result['sha1sum'], 'missing')
+        self.assertEqual(result['analysis'], 'player_names')
+        self.assertIn('error', result)
+
+    async def test_get_replay_in_worker(self):
+        # Replays are fetched through the cache in worker processes forked
+        # from this one while its loop is running
+        self.config.replay_cache = config.ReplayCacheConfig(self.directory)
+        loop = asyncio.get_event_loop()
+        results = []
+        with fixtures.MonkeyPatch('cheeseshop.util.ReplayDownloader.download',
+                                  fake_download):
+            # Created in this process, so not used by the worker
+            util.get_replay_downloader(self.config)
+            with concurrent.futures.ProcessPoolExecutor(1) as executor:
+                for sha1sum in REPLAYS:
+                    results.append(await loop.run_in_executor(
+                        executor, get_replay_and_downloader, sha1sum,
+                        self.config
+                    ))
+        for sha1sum, (path, _, _) in zip(REPLAYS, results):
+            with open(path, 'rb') as fh:
+                self.assertEqual(fh.read(), REPLAYS[sha1sum])
+        # One downloader for every replay the worker fetched
+        self.assertEqual(len(set(result[1:] for result in results)), 1)
+        self.assertNotEqual(results[0][2], os.getpid())
+
+    async def test_ndjson_resume(self):
+        path = os.path.join(self.directory, 'out.ndjson')
+        with open(path, 'w') as fh:
+            for record in [
+                {'sha1sum': 'a', 'analysis': 'player_names', 'version': 1,
+                 'result': []},
+                {'sha1sum': 'b', 'analysis': 'player_names', 'version': 1,
+                 'error': 'failed'},
+                {'sha1sum': 'c', 'analysis': 'player_names', 'version': 0,
+                 'result': []},
+                {'sha1sum': 'd', 'analysis': 'supply_breakdown',
+                 'version': 1, 'result': {}},
+            ]:
+                fh.write(json.dumps(record) + '\n')
+            # Cut off part way through a write
+            fh.write('{"sha1sum": "e", "anal')
+
+        output = batch.NdjsonOutput(path)
+        self.assertEqual(await output.completed('player_names', 1), {'a'})
+        await output.open()
+        await output.write({'sha1sum': 'e', 'analysis': 'player_names',
+                            'version': 1, 'result': []})
+        await output.close()
+        self.assertEqual(await output.completed('player_names', 1),
+                         {'a', 'e'})
@@ -0,0 +1,40 @@
+from cheeseshop import cache
+from cheeseshop.tests import base
+
+
+class TestLruCache(base.TestCase):
+    def test_evicts_least_recently_used(self):
+        lru = cache.LruCache(2)
+        lru.put('a', 1)
+        lru.put('b', 2)
+        self.assertEqual(lru.get('a'), 1)
+        lru.put('c', 3)
+        self.assertNotIn('b', lru)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertEqual(lru.get('c'), 3)
+        self.assertEqual(len(lru), 2)
+
+    def test_stats(self):
+        lru = cache.LruCache(2)
+        lru.put('a', 1)
+        lru.get('a')
+        lru.get('b')
+        self.assertEqual((lru.hits, lru.misses), (1, 1))
+
+
+class TestBloomFilter(base.TestCase):
+    def test_no_false_negatives(self):
+        bloom = cache.BloomFilter(1000)
+        keys = ['key-%d' % i for i in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        for key in keys:
+            self.assertIn(key, bloom)
+
+    def test_false_positive_rate(self):
+        bloom = cache.BloomFilter(1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add('key-%d' % i)
+        false_positives = sum(1 for i in range(10000)
+                              if 'other-%d' % i in bloom)
+        self.assertLess(false_positives, 300)
@@ -1,2 +1,258 @@
-# from cheeseshop.games import csgo
-# from cheeseshop.tests import base
+import asyncio
+import json
+import types
+
+from cheeseshop.games import csgo
+from cheeseshop import jsondelta
+from cheeseshop.tests import base
+
+
+def _texts(player):
+    return [frame.text for frame in player._pending]
+
+
+def _delta_player(keyframe_interval=50):
+    player = csgo.GsiPlayer(None, 'streamer',
+                            keyframe_interval=keyframe_interval)
+    player.protocol = csgo.GSI_PROTOCOL_DELTA
+    return player
+
+
+class _LocalBus(object):
+    """Relays messages between CsGoApis in this process like a broker.
+
+    Nothing is delivered while dropping is True.
+    """
+    def __init__(self, apis, api):
+        self.apis = apis
+        self.api = api
+        self.dropping = False
+
+    def publish(self, topic, body):
+        if not self.dropping:
+            for other in self.apis:
+                if other is not self.api:
+                    asyncio.get_event_loop().call_soon(
+                        other._on_bus_message, topic, body
+                    )
+        return True
+
+
+def _tick(clock, money=800):
+    return {
+        'provider': {'name': 'Counter-Strike: Global Offensive',
+                     'timestamp': clock},
+        'map': {'name': 'de_dust2', 'phase': 'live', 'round': 3},
+        'player': {'steamid': '76561197960265728', 'name': 'a player',
+                   'state': {'health': 100, 'armor': 100, 'money': money}}
+    }
+
+
+class TestGsiBroadcaster(base.TestCase):
+    def test_drop_oldest(self):
+        player = csgo.GsiPlayer(None, 'streamer', max_pending=2)
+        broadcaster = csgo.GsiBroadcaster()
+        broadcaster.add(player)
+        for i in range(5):
+            broadcaster.publish(str(i))
+        self.assertEqual(_texts(player), ['3', '4'])
+        self.assertEqual(player.dropped, 3)
+
+    def test_latest(self):
+        slow = csgo.GsiPlayer(None, 'streamer',
+                              policy=csgo.ViewerPolicy.LATEST)
+        fast = csgo.GsiPlayer(None, 'streamer')
+        broadcaster = csgo.GsiBroadcaster()
+        broadcaster.add(slow)
+        broadcaster.add(fast)
+        for i in range(3):
+            broadcaster.publish(str(i))
+        self.assertEqual(_texts(slow), ['2'])
+        self.assertEqual(slow.dropped, 2)
+        self.assertEqual(_texts(fast), ['0', '1', '2'])
+        self.assertEqual(fast.dropped, 0)
+        self.assertEqual([stats['policy'] for stats in broadcaster.stats()],
+                         ['latest', 'drop_oldest'])
+
+
+class TestGsiDeltas(base.TestCase):
+    def _publish(self, broadcaster, doc):
+        broadcaster.publish(json.dumps(doc), doc)
+
+    def _sent(self, player):
+        messages = []
+        while player._pending:
+            messages.append(json.loads(player._encode(
+                player._pending.popleft()
+            )))
+        return messages
+
+    def test_v1_gets_full_events(self):
+        player = csgo.GsiPlayer(None, 'streamer')
+        broadcaster = csgo.GsiBroadcaster()
+        broadcaster.add(player)
+        self._publish(broadcaster, _tick(1))
+        self._publish(broadcaster, _tick(2))
+        self.assertEqual(self._sent(player), [_tick(1), _tick(2)])
+
+    def test_snapshot_then_deltas(self):
+        broadcaster = csgo.GsiBroadcaster()
+        self._publish(broadcaster, _tick(1))
+        player = _delta_player()
+        broadcaster.add(player)
+        player._queue_join_frame()
+        self._publish(broadcaster, _tick(2))
+        self._publish(broadcaster, _tick(3, money=1100))
+
+        messages = self._sent(player)
+        self.assertEqual([(m['type'], m['seq']) for m in messages],
+                         [('snapshot', 0), ('delta', 1), ('delta', 2)])
+        state = messages[0]['state']
+        for message in messages[1:]:
+            state = jsondelta.apply(state, message['ops'])
+        self.assertEqual(state, _tick(3, money=1100))
+        self.assertLess(len(json.dumps(messages[1])),
+                        len(json.dumps(_tick(2))) / 2)
+
+    def test_events_before_handshake(self):
+        broadcaster = csgo.GsiBroadcaster()
+        self._publish(broadcaster, _tick(1))
+        player = _delta_player()
+        broadcaster.add(player)
+        # Events published before the handshake completed are newer
+        self._publish(broadcaster, _tick(2))
+        player._queue_join_frame()
+        self._publish(broadcaster, _tick(3))
+        self.assertEqual([(m['type'], m['seq']) for m in self._sent(player)],
+                         [('snapshot', 0), ('delta', 1), ('delta', 2)])
+
+    def test_keyframe_interval(self):
+        player = _delta_player(keyframe_interval=2)
+        broadcaster = csgo.GsiBroadcaster()
+        broadcaster.add(player)
+        for clock in range(5):
+            self._publish(broadcaster, _tick(clock))
+        self.assertEqual([m['type'] for m in self._sent(player)],
+                         ['snapshot', 'delta', 'delta', 'snapshot', 'delta'])
+
+    def test_snapshot_after_drop(self):
+        player = csgo.GsiPlayer(None, 'streamer',
+                                policy=csgo.ViewerPolicy.LATEST)
+        player.protocol = csgo.GSI_PROTOCOL_DELTA
+        broadcaster = csgo.GsiBroadcaster()
+        broadcaster.add(player)
+        self._publish(broadcaster, _tick(1))
+        self.assertEqual(self._sent(player)[0]['type'], 'snapshot')
+        self._publish(broadcaster, _tick(2))
+        self._publish(broadcaster, _tick(3))
+        self.assertEqual(self._sent(player), [
+            {'type': 'snapshot', 'seq': 2, 'state': _tick(3)}
+        ])
+
+    def test_snapshot_when_smaller(self):
+        player = _delta_player()
+        broadcaster = csgo.GsiBroadcaster()
+        broadcaster.add(player)
+        self._publish(broadcaster, {'a': 1})
+        self._publish(broadcaster, {'b': 2})
+        self.assertEqual([m['type'] for m in self._sent(player)],
+                         ['snapshot', 'snapshot'])
+
+
+class TestWorkerSharding(base.TestCase):
+    def test_streamer_worker(self):
+        owners = [csgo.streamer_worker('streamer-%d' % i, 4)
+                  for i in range(100)]
+        self.assertEqual(set(owners), set(range(4)))
+        self.assertEqual(owners, [csgo.streamer_worker('streamer-%d' % i, 4)
+                                  for i in range(100)])
+
+    def test_bus_events(self):
+        self.config.workers = 2
+        streamer_uuids = ['streamer-%d' % i for i in range(10)]
+        apis = [csgo.CsGoApi(self.config, None, worker_index=i,
+                             broker_path='broker.sock')
+                for i in range(2)]
+        for api in apis:
+            for i, streamer_uuid in enumerate(streamer_uuids):
+                api._on_bus_message('ingest %s 2 %d' % (streamer_uuid, i),
+                                    '{"a": 1}')
+                api._on_bus_message('event %s 2' % streamer_uuid, '{"a": 2}')
+                # Already sent to its viewers by the worker it came from
+                api._on_bus_message('event %s %d' % (streamer_uuid,
+                                                     api.worker_index),
+                                    '{"a": 3}')
+            self.assertEqual(set(api._gsi_sources), set(streamer_uuids))
+        queued = []
+        for api in apis:
+            queued.append([])
+            while not api._bus_events.empty():
+                queued[-1].append(api._bus_events.get_nowait()[0])
+        # Each forwarded event is stored by exactly one worker, and only
+        # sent to viewers once accepted
+        self.assertEqual(sorted(queued[0] + queued[1]), streamer_uuids)
+        for i, api in enumerate(apis):
+            self.assertTrue(all(csgo.streamer_worker(streamer_uuid, 2) == i
+                                for streamer_uuid in queued[i]))
+            self.assertEqual(
+                api._gsi_sources['streamer-0'].broadcaster.latest.doc,
+                {'a': 2}
+            )
+
+
+class TestGsiForwarding(base.TestCase):
+    async def setUp(self):
+        super().setUp()
+        self.config.workers = 2
+        self.config.gsi.ingest_queue_size = 1
+        self.config.gsi.forward_timeout = 0.1
+        self.apis = [csgo.CsGoApi(self.config, None, worker_index=i,
+                                  broker_path='broker.sock')
+                     for i in range(2)]
+        self.streamer = types.SimpleNamespace(id=1, uuid='streamer-0')
+        for api in self.apis:
+            api.bus = _LocalBus(self.apis, api)
+            api.streamers.add(self.streamer)
+            api._bus_task = asyncio.ensure_future(api._ingest_bus_events())
+            self.addCleanup(api._bus_task.cancel)
+        owner = csgo.streamer_worker(self.streamer.uuid, 2)
+        self.owner = self.apis[owner]
+        self.other = self.apis[1 - owner]
+
+    def _latest(self, api):
+        latest = api._gsi_sources[self.streamer.uuid].broadcaster.latest
+        return None if latest is None else latest.doc
+
+    async def test_forward(self):
+        reason = await self.other._forward(self.streamer.uuid, '{"a": 1}')
+        self.assertEqual(reason, 'ok')
+        self.assertEqual(self.owner.gsi_ingest.qsize(), 1)
+        self.assertEqual(self.other.gsi_ingest.qsize(), 0)
+        self.assertEqual(self.other._forwarded, {})
+        # The sender publishes it to its own viewers once it has the ack
+        self.assertEqual(self._latest(self.owner), {'a': 1})
+        self.assertIsNone(self._latest(self.other))
+
+    async def test_forward_owner_full(self):
+        self.assertEqual(
+            await self.other._forward(self.streamer.uuid, '{"a": 1}'), 'ok'
+        )
+        self.assertEqual(
+            await self.other._forward(self.streamer.uuid, '{"a": 2}'), 'full'
+        )
+        self.assertEqual(self.owner.gsi_ingest.qsize(), 1)
+        self.assertEqual(self._latest(self.owner), {'a': 1})
+
+    async def test_forward_dropped(self):
+        self.other.bus.dropping = True
+        reason = await self.other._forward(self.streamer.uuid, '{"a": 1}')
+        self.assertEqual(reason, 'unavailable')
+        self.assertEqual(self.other._forwarded, {})
+        self.assertIsNone(self._latest(self.owner))
+        # A late reply is ignored
+        self.other._on_bus_message('ack %d 0' % self.other.worker_index, 'ok')
+
+    async def test_forward_disconnected(self):
+        self.other.bus.publish = lambda topic, body: False
+        reason = await self.other._forward(self.streamer.uuid, '{"a": 1}')
+        self.assertEqual(reason, 'unavailable')
@@ -0,0 +1,138 @@
+from cheeseshop import dbapi
+from cheeseshop.games import csgo_events
+from cheeseshop.tests import base
+
+
+def _player(name, kills=0, deaths=0, money=800, weapon=None):
+    player = {
+        'name': name,
+        'team': 'CT',
+        'match_stats': {'kills': kills, 'deaths': deaths},
+        'state': {'money': money},
+        'weapons': {}
+    }
+    if weapon is not None:
+        player['weapons']['weapon_0'] = {'name': 'weapon_knife',
+                                         'state': 'holstered'}
+        player['weapons']['weapon_1'] = {'name': weapon, 'state': 'active'}
+    return player
+
+
+def _event(players, round_=0, phase='live'):
+    return {
+        'map': {'round': round_},
+        'round': {'phase': phase},
+        'allplayers': players
+    }
+
+
+class TestTickDiffer(base.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.differ = csgo_events.TickDiffer()
+        self.differ.diff(_event({'1': _player('a'), '2': _player('b')}),
+                         map_id=1)
+
+    def test_first_event_has_only_round(self):
+        differ = csgo_events.TickDiffer()
+        extracted = differ.diff(_event({'1': _player('a')}), map_id=1)
+        self.assertEqual(extracted, [csgo_events.ExtractedEvent(
+            dbapi.CsGoHltvEventType.ROUND, 0, None, {'phase': 'live'},
+            None, None
+        )])
+
+    def test_death_with_attacker(self):
+        extracted = self.differ.diff(_event({
+            '1': _player('a', kills=1, weapon='weapon_ak47'),
+            '2': _player('b', deaths=1)
+        }), map_id=1)
+        self.assertEqual(extracted, [csgo_events.ExtractedEvent(
+            dbapi.CsGoHltvEventType.DEATH, 0, '2',
+            {'name': 'b', 'team': 'CT', 'attacker_name': 'a'},
+            '1', 'weapon_ak47'
+        )])
+
+    def test_deaths_without_single_attacker(self):
+        differ = csgo_events.TickDiffer()
+        players = dict((str(i), _player(str(i))) for i in range(4))
+        differ.diff(_event(players), map_id=1)
+        players = {
+            '0': _player('0', kills=1),
+            '1': _player('1', kills=1),
+            '2': _player('2', deaths=1),
+            '3': _player('3', deaths=1)
+        }
+        extracted = differ.diff(_event(players), map_id=1)
+        self.assertEqual([(e.steam_id, e.attacker, e.weapon)
+                          for e in extracted],
+                         [('2', None, None), ('3', None, None)])
+
+    def test_money(self):
+        extracted = self.differ.diff(_event({
+            '1': _player('a', money=3050),
+            '2': _player('b')
+        }, round_=1), map_id=1)
+        self.assertEqual(extracted, [csgo_events.ExtractedEvent(
+            dbapi.CsGoHltvEventType.MONEY, 1, '1',
+            {'name': 'a', 'team': 'CT', 'money': 3050, 'change': 2250},
+            None, None
+        )])
+
+    def test_gsi_timestamp(self):
+        event = _event({'1': _player('a', money=3050), '2': _player('b')})
+        event['provider'] = {'timestamp': 1500000000}
+        self.assertEqual(
+            [e.data['gsi_timestamp'] for e in self.differ.diff(event,
+                                                               map_id=1)],
+            [1500000000]
+        )
+
+    def test_round_phases(self):
+        event = _event({}, round_=0, phase='over')
+        event['round']['win_team'] = 'T'
+        self.assertEqual(
+            [e.data for e in self.differ.diff(event, map_id=1)],
+            [{'phase': 'over', 'win_team': 'T'}]
+        )
+        self.assertEqual(self.differ.diff(event, map_id=1), [])
+        self.assertEqual(
+            [(e.round, e.data) for e in self.differ.diff(
+                _event({}, round_=1, phase='freezetime'), map_id=1
+            )],
+            [(1, {'phase': 'freezetime'})]
+        )
+
+    def test_new_map_resets_stats(self):
+        extracted = self.differ.diff(_event({
+            '1': _player('a', kills=0, money=800),
+            '2': _player('b', deaths=0)
+        }), map_id=2)
+        self.assertEqual([e.type for e in extracted],
+                         [dbapi.CsGoHltvEventType.ROUND])
+        # Stats dropping back to zero are not deaths or kills
+        self.differ.diff(_event({'1': _player('a', kills=3)}), map_id=2)
+        self.assertEqual(
+            self.differ.diff(_event({'1': _player('a', kills=0)}),
+                             map_id=2),
+            []
+        )
+
+    def test_player_view(self):
+        differ = csgo_events.TickDiffer()
+        player = _player('a')
+        player['steamid'] = '1'
+        differ.diff({'player': player}, map_id=1)
+        player = _player('a', deaths=1)
+        player['steamid'] = '1'
+        extracted = differ.diff({'player': player}, map_id=1)
+        self.assertEqual([(e.type, e.steam_id) for e in extracted],
+                         [(dbapi.CsGoHltvEventType.DEATH, '1')])
+
+    def test_dump_load(self):
+        differ = csgo_events.TickDiffer.load(self.differ.dump())
+        extracted = differ.diff(_event({
+            '1': _player('a'),
+            '2': _player('b', deaths=1)
+        }), map_id=1)
+        self.assertEqual([(e.type, e.steam_id) for e in extracted],
+                         [(dbapi.CsGoHltvEventType.DEATH, '2')])
@@ -0,0 +1,110 @@
+from cheeseshop.games import csgo_heatmap
+from cheeseshop.tests import base
+
+
+def _event(positions, phase='live'):
+    return {
+        'map': {'phase': phase},
+        'allplayers': dict(
+            ('7656119%d' % i, {'position': '%s, %s, 12.5' % position})
+            for i, position in enumerate(positions)
+        )
+    }
+
+
+class TestHeatmapBuilder(base.TestCase):
+    def test_known_map_uses_radar_bounds(self):
+        builder = csgo_heatmap.HeatmapBuilder('de_dust2', grid_size=4)
+        min_x, min_y, max_x, max_y = csgo_heatmap.overview_bounds('de_dust2')
+        builder.add(_event([(min_x, max_y), (max_x, min_y)]), 1)
+        # Off the radar
+        builder.add(_event([(max_x + 1, max_y)]), 2)
+        heatmap = builder.heatmap()
+        self.assertEqual(heatmap.bounds, (min_x, min_y, max_x, max_y))
+        self.assertEqual(heatmap.samples, 2)
+        self.assertEqual(list(heatmap.counts),
+                         [1, 0, 0, 0,
+                          0, 0, 0, 0,
+                          0, 0, 0, 0,
+                          0, 0, 0, 1])
+        self.assertEqual(builder.last_event_id, 2)
+        self.assertFalse(heatmap.complete)
+
+    def test_unknown_map_uses_position_bounds(self):
+        builder = csgo_heatmap.HeatmapBuilder('de_unknown', grid_size=2)
+        builder.add(_event([(0, 0), (100, 50)]))
+        builder.add(_event([(10, 90), (99, 1)]))
+        heatmap = builder.heatmap()
+        self.assertEqual(heatmap.bounds, (0, -10, 100, 90))
+        self.assertEqual(heatmap.samples, 4)
+        # Rows run from the top of the map down
+        self.assertEqual(list(heatmap.counts), [1, 1, 1, 1])
+
+    def test_unknown_map_bounds_grow(self):
+        builder = csgo_heatmap.HeatmapBuilder('de_unknown', grid_size=2,
+                                              max_pending=2)
+        builder.add(_event([(0, 0), (10, 10)]))
+        # The kept positions were binned and dropped
+        self.assertEqual(builder.bounds, (0, 0, 10, 10))
+        self.assertEqual(len(builder._xs), 0)
+        self.assertEqual(list(builder.counts), [0, 1, 1, 0])
+
+        builder.add(_event([(-5, 30)]))
+        heatmap = builder.heatmap()
+        # Doubled left and up, then right and up
+        self.assertEqual(heatmap.bounds, (-10, 0, 30, 40))
+        self.assertEqual(heatmap.samples, 3)
+        self.assertEqual(list(heatmap.counts), [1, 0, 2, 0])
+
+        builder.add(_event([(5, 5)]))
+        self.assertEqual(builder.bounds, (-10, 0, 30, 40))
+        self.assertEqual(list(builder.heatmap().counts), [1, 0, 3, 0])
+
+    def test_adding_after_heatmap(self):
+        builder = csgo_heatmap.HeatmapBuilder('de_unknown', grid_size=2)
+        builder.add(_event([(0, 0)]))
+        self.assertEqual(builder.heatmap().samples, 1)
+        builder.add(_event([(10, 10)]))
+        self.assertEqual(builder.heatmap().samples, 2)
+
+    def test_no_positions(self):
+        builder = csgo_heatmap.HeatmapBuilder('de_unknown', grid_size=2)
+        builder.add({'map': {'phase': 'live'}, 'player': {}})
+        builder.add({'allplayers': {'1': {'name': 'no position'},
+                                    '2': {'position': 'garbage'},
+                                    '3': {'position': 'nan, 1, 2'},
+                                    '4': {'position': '1, inf, 2'}}})
+        heatmap = builder.heatmap()
+        self.assertEqual(heatmap.samples, 0)
+        self.assertEqual(heatmap.to_dict()['cells'], [])
+
+    def test_complete_at_gameover(self):
+        builder = csgo_heatmap.HeatmapBuilder('de_dust2')
+        builder.add(_event([(0, 0)]))
+        self.assertFalse(builder.complete)
+        builder.add(_event([(0, 0)], phase='gameover'))
+        self.assertTrue(builder.heatmap().complete)
+
+
+class TestHeatmap(base.TestCase):
+    def test_to_dict(self):
+        heatmap = csgo_heatmap.Heatmap('de_dust2', 2, (0, 0, 10, 10),
+                                       [0, 3, 1, 0], 4, True)
+        self.assertEqual(heatmap.to_dict(), {
+            'map_name': 'de_dust2',
+            'grid_size': 2,
+            'bounds': [0, 0, 10, 10],
+            'samples': 4,
+            'max': 3,
+            'complete': True,
+            'radar': True,
+            'cells': [[1, 0, 3], [0, 1, 1]]
+        })
+
+    def test_counts_bytes_round_trip(self):
+        heatmap = csgo_heatmap.Heatmap('de_dust2', 2, (0, 0, 10, 10),
+                                       [0, 3, 1, 2 ** 32 - 1], 4, True)
+        data = heatmap.counts_bytes()
+        self.assertEqual(data[:8], b'\x00\x00\x00\x00\x03\x00\x00\x00')
+        self.assertEqual(list(csgo_heatmap.Heatmap.counts_from_bytes(data)),
+                         [0, 3, 1, 2 ** 32 - 1])
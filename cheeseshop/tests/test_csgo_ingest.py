@@ -0,0 +1,74 @@
+import types
+
+from cheeseshop.games import csgo
+from cheeseshop.games import csgo_ingest
+from cheeseshop.tests import base
+
+
+class _Context(object):
+    def __init__(self, value=None):
+        self.value = value
+
+    async def __aenter__(self):
+        return self.value
+
+    async def __aexit__(self, *args):
+        return False
+
+
+class _FakeConnection(object):
+    def transaction(self):
+        return _Context()
+
+
+class _FakePool(object):
+    def acquire(self):
+        return _Context(_FakeConnection())
+
+
+class _FailingIngestQueue(csgo_ingest.GsiIngestQueue):
+    """Changes the state of sources like _write, and fails failures
+    times.
+    """
+    def __init__(self, failures, **kwargs):
+        super().__init__(_FakePool(), retry_interval=0, **kwargs)
+        self.failures = failures
+        self.phases = []
+        self.written = []
+
+    async def _write(self, conn, batch):
+        for item in batch:
+            self.phases.append(item.gsi_source.map_state.phase)
+            item.gsi_source.map_state.phase = item.gsi_data['phase']
+            item.gsi_source.tick_differ.players['1'] = {'money': 800}
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError('db went away')
+        self.written.extend(item.gsi_data for item in batch)
+        return []
+
+
+class TestGsiIngestQueue(base.TestCase):
+    async def _ingest(self, queue, source):
+        streamer = types.SimpleNamespace(id=1)
+        queue.start()
+        queue.put(source, streamer, {'phase': 'live'}, '{}')
+        await queue.join()
+        await queue.close()
+
+    async def test_retries_from_saved_state(self):
+        queue = _FailingIngestQueue(1)
+        source = csgo.GsiSource()
+        await self._ingest(queue, source)
+        self.assertEqual(queue.phases, [None, None])
+        self.assertEqual(queue.written, [{'phase': 'live'}])
+        self.assertEqual(source.map_state.phase, 'live')
+
+    async def test_drops_after_retries(self):
+        queue = _FailingIngestQueue(10, retries=2)
+        source = csgo.GsiSource()
+        await self._ingest(queue, source)
+        self.assertEqual(queue.phases, [None, None, None])
+        self.assertEqual(queue.written, [])
+        self.assertIsNone(source.map_state.phase)
+        self.assertEqual(source.tick_differ.players, {})
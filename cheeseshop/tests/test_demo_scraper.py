@@ -0,0 +1,116 @@
+import contextlib
+import datetime
+import io
+import os
+import shutil
+import tempfile
+
+from cheeseshop.cmd import demo_scraper
+from cheeseshop.tests import base
+from cheeseshop.tests import fakes
+
+
+class TestScraper(base.TestCase):
+    async def setUp(self):
+        super(TestScraper, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.demos = {'1': b'demo one' * 1000, '2': None,
+                      '3': b'demo three' * 1000}
+
+    async def start_fake(self, **kwargs):
+        self.fake = fakes.FakeHltv(self.demos, **kwargs)
+        await self.fake.start()
+        self.addCleanup(self.fake.close)
+
+    async def scrape(self, **kwargs):
+        scraper = demo_scraper.Scraper(self.directory, 'team-id', 10,
+                                       base_url=self.fake.url, **kwargs)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            await scraper.run()
+        return output.getvalue()
+
+    def read_demo(self, match_id):
+        path = os.path.join(self.directory,
+                            'team-vs-team-%s.rar' % match_id)
+        with open(path, 'rb') as fh:
+            return fh.read()
+
+    async def test_list_and_download(self):
+        await self.start_fake()
+        output = await self.scrape(_list=True, _download=True)
+
+        date = datetime.datetime.fromtimestamp(1500000000).strftime(
+            '%Y-%m-%d'
+        )
+        self.assertIn("['%s', '%s/download/demo/1', 'team-vs-team-1']"
+                      % (date, self.fake.url), output)
+        self.assertIn("'No Demo File Yet', 'team-vs-team-2'", output)
+        # Each match page is fetched once for both its date and demo
+        for match_id in self.demos:
+            self.assertEqual(self.fake.requests[
+                '/matches/%s/team-vs-team-%s' % (match_id, match_id)
+            ], 1)
+        self.assertEqual(self.read_demo('1'), self.demos['1'])
+        self.assertEqual(self.read_demo('3'), self.demos['3'])
+        self.assertFalse(os.path.exists(
+            os.path.join(self.directory, 'team-vs-team-2.rar')
+        ))
+
+        # Finished downloads are not fetched again
+        await self.scrape(_download=True)
+        self.assertEqual(self.fake.requests['/download/demo/1'], 1)
+
+    async def test_resume_download(self):
+        await self.start_fake()
+        partial = os.path.join(self.directory, 'team-vs-team-1.rar.part')
+        with open(partial, 'wb') as fh:
+            fh.write(self.demos['1'][:1234])
+
+        await self.scrape(_download=True)
+        self.assertEqual(self.read_demo('1'), self.demos['1'])
+        self.assertIn('bytes=1234-', self.fake.ranges)
+        self.assertFalse(os.path.exists(partial))
+
+    async def test_resume_complete_download(self):
+        await self.start_fake()
+        partial = os.path.join(self.directory, 'team-vs-team-1.rar.part')
+        with open(partial, 'wb') as fh:
+            fh.write(self.demos['1'])
+
+        await self.scrape(_download=True)
+        self.assertEqual(self.read_demo('1'), self.demos['1'])
+
+    async def test_resume_longer_than_demo(self):
+        await self.start_fake()
+        partial = os.path.join(self.directory, 'team-vs-team-1.rar.part')
+        with open(partial, 'wb') as fh:
+            fh.write(self.demos['1'] + b'stale bytes')
+
+        await self.scrape(_download=True)
+        self.assertEqual(self.read_demo('1'), self.demos['1'])
+        # Requested again from the start without a Range
+        self.assertIn('bytes=%d-' % (len(self.demos['1']) + 11),
+                      self.fake.ranges)
+        self.assertEqual(self.fake.requests['/download/demo/1'], 2)
+
+    async def test_resume_other_range(self):
+        await self.start_fake(whole_range=True)
+        partial = os.path.join(self.directory, 'team-vs-team-1.rar.part')
+        with open(partial, 'wb') as fh:
+            fh.write(self.demos['1'][:1234])
+
+        await self.scrape(_download=True)
+        self.assertEqual(self.read_demo('1'), self.demos['1'])
+        self.assertIn('bytes=1234-', self.fake.ranges)
+        self.assertEqual(self.fake.requests['/download/demo/1'], 2)
+
+    async def test_resume_range_ignored(self):
+        await self.start_fake(ignore_range=True)
+        partial = os.path.join(self.directory, 'team-vs-team-1.rar.part')
+        with open(partial, 'wb') as fh:
+            fh.write(b'stale bytes')
+
+        await self.scrape(_download=True)
+        self.assertEqual(self.read_demo('1'), self.demos['1'])
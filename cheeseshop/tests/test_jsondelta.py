@@ -0,0 +1,77 @@
+import copy
+import datetime
+import json
+
+from cheeseshop import jsondelta
+from cheeseshop.tests import base
+
+
+class TestJsonDelta(base.TestCase):
+    def test_round_trip(self):
+        old = {
+            'map': {'phase': 'live', 'round': 3},
+            'player': {'state': {'health': 100, 'armor': 50}, 'team': 'CT'},
+            'removed': {'a': 1},
+            'flag': 1
+        }
+        new = {
+            'map': {'phase': 'live', 'round': 4},
+            'player': {'state': {'health': 80}, 'team': 'CT'},
+            'added': [1, 2],
+            'flag': True
+        }
+        old_copy = copy.deepcopy(old)
+        ops = jsondelta.diff(old, new)
+        self.assertEqual(jsondelta.apply(old, ops), new)
+        # Patches survive a trip through json and leave the base untouched
+        ops = json.loads(jsondelta.dumps(ops))
+        self.assertEqual(jsondelta.apply(old, ops), new)
+        self.assertEqual(old, old_copy)
+
+    def test_unchanged_shares_objects(self):
+        old = {'a': {'b': 1}, 'c': {'d': 2}}
+        new = {'a': {'b': 2}, 'c': {'d': 2}}
+        result = jsondelta.apply(old, jsondelta.diff(old, new))
+        self.assertEqual(result, new)
+        self.assertIs(result['c'], old['c'])
+
+    def test_replace_root(self):
+        self.assertEqual(jsondelta.diff({'a': 1}, [1]), [[[], [1]]])
+        self.assertEqual(jsondelta.apply({'a': 1}, [[[], [1]]]), [1])
+
+
+class TestKeyframeEncoder(base.TestCase):
+    def test_keyframe_interval(self):
+        encoder = jsondelta.KeyframeEncoder(keyframe_interval=2)
+        docs = [{'tick': i, 'static': 'x' * 100} for i in range(5)]
+        keyframe_ids = []
+        for doc_id, doc in enumerate(docs):
+            text, keyframe_id = encoder.encode(doc_id, doc, json.dumps(doc))
+            keyframe_ids.append(keyframe_id)
+            if keyframe_id is None:
+                keyframe = doc
+                self.assertEqual(json.loads(text), doc)
+            else:
+                self.assertEqual(
+                    jsondelta.apply(keyframe, json.loads(text)), doc
+                )
+        self.assertEqual(keyframe_ids, [None, 0, 0, None, 3])
+
+    def test_keyframe_each_month(self):
+        encoder = jsondelta.KeyframeEncoder()
+        doc = {'tick': 0, 'static': 'x' * 100}
+        times = [datetime.datetime(2018, 1, 31, 23, 59),
+                 datetime.datetime(2018, 1, 31, 23, 59, 30),
+                 datetime.datetime(2018, 2, 1),
+                 datetime.datetime(2018, 2, 1, 0, 0, 30)]
+        keyframe_ids = [encoder.encode(doc_id, doc, json.dumps(doc),
+                                       time)[1]
+                        for doc_id, time in enumerate(times)]
+        self.assertEqual(keyframe_ids, [None, 0, None, 2])
+
+    def test_large_patch_is_keyframe(self):
+        encoder = jsondelta.KeyframeEncoder()
+        encoder.encode(0, {'a': 1}, '{"a": 1}')
+        text, keyframe_id = encoder.encode(1, {'b': 2}, '{"b": 2}')
+        self.assertIsNone(keyframe_id)
+        self.assertEqual(text, '{"b": 2}')
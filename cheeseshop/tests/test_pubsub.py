@@ -0,0 +1,64 @@
+import asyncio
+import os
+import shutil
+import socket
+import tempfile
+
+from cheeseshop import pubsub
+from cheeseshop.tests import base
+
+
+class TestMessages(base.TestCase):
+    def test_round_trip(self):
+        message = pubsub.encode_message('streamer-uuid', '{"a":\n"é"}')
+        self.assertEqual(pubsub.decode_message(message[4:]),
+                         ('streamer-uuid', '{"a":\n"é"}'))
+
+    def test_too_large(self):
+        self.assertRaises(pubsub.MessageTooLargeError, pubsub.encode_message,
+                          'topic', 'a' * pubsub.MAX_MESSAGE_SIZE)
+
+
+class TestBroker(base.TestCase):
+    async def setUp(self):
+        super().setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'broker.sock')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.listen(2)
+        self.broker = pubsub.Broker()
+        await self.broker.start(sock)
+
+    async def _client(self):
+        received = asyncio.Queue()
+        client = pubsub.BrokerClient(
+            self.path, lambda topic, body: received.put_nowait((topic, body))
+        )
+        client.start()
+        await asyncio.wait_for(client.connected.wait(), 5)
+        return client, received
+
+    async def test_relays_to_other_clients(self):
+        client_1, received_1 = await self._client()
+        client_2, received_2 = await self._client()
+        try:
+            self.assertTrue(client_1.publish('streamer', 'event 1'))
+            self.assertTrue(client_2.publish('streamer', 'event 2'))
+            self.assertEqual(await asyncio.wait_for(received_2.get(), 5),
+                             ('streamer', 'event 1'))
+            self.assertEqual(await asyncio.wait_for(received_1.get(), 5),
+                             ('streamer', 'event 2'))
+            self.assertTrue(received_1.empty())
+            self.assertTrue(received_2.empty())
+        finally:
+            await client_1.close()
+            await client_2.close()
+            await self.broker.close()
+
+    async def test_publish_while_disconnected(self):
+        client = pubsub.BrokerClient(self.path, lambda topic, body: None)
+        self.assertFalse(client.publish('streamer', 'event'))
+        self.assertEqual(client.dropped, 1)
+        await self.broker.close()
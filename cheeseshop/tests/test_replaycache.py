@@ -0,0 +1,145 @@
+import hashlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+from cheeseshop import replaycache
+from cheeseshop.tests import base
+
+
+def _sha1(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def _slow_get(directory, data, fetch_log):
+    def fetch(fileobj):
+        with open(fetch_log, 'a') as fh:
+            fh.write('fetch\n')
+        time.sleep(0.2)
+        fileobj.write(data)
+
+    replay_cache = replaycache.ReplayCache(directory)
+    replay_cache.get(_sha1(data), fetch)
+
+
+class TestReplayCache(base.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.fetched = []
+
+    def fetcher(self, data):
+        def fetch(fileobj):
+            self.fetched.append(data)
+            fileobj.write(data[:3])
+            fileobj.write(data[3:])
+        return fetch
+
+    def test_miss_then_hit(self):
+        replay_cache = replaycache.ReplayCache(self.directory)
+        data = b'replay data'
+        path = replay_cache.get(_sha1(data), self.fetcher(data))
+        self.assertEqual(path, replay_cache.path_for(_sha1(data)))
+        with open(path, 'rb') as fh:
+            self.assertEqual(fh.read(), data)
+        self.assertEqual(
+            replay_cache.get(_sha1(data), self.fetcher(data)), path
+        )
+        self.assertEqual(self.fetched, [data])
+
+        stats = replay_cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['bytes_fetched'], len(data))
+        self.assertEqual(stats['entries'], 1)
+        self.assertEqual(stats['size'], len(data))
+
+    def test_stats_shared_between_instances(self):
+        data = b'replay data'
+        replaycache.ReplayCache(self.directory).get(_sha1(data),
+                                                    self.fetcher(data))
+        replaycache.ReplayCache(self.directory).get(_sha1(data),
+                                                    self.fetcher(data))
+        stats = replaycache.ReplayCache(self.directory).stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_hash_mismatch(self):
+        replay_cache = replaycache.ReplayCache(self.directory)
+        sha1sum = _sha1(b'expected')
+        with self.assertRaises(replaycache.HashMismatchError):
+            replay_cache.get(sha1sum, self.fetcher(b'something else'))
+        self.assertFalse(os.path.exists(replay_cache.path_for(sha1sum)))
+        self.assertEqual(replay_cache.stats()['entries'], 0)
+        self.assertEqual(os.listdir(os.path.dirname(
+            replay_cache.path_for(sha1sum)
+        )), [])
+
+    def test_failed_fetch_leaves_nothing(self):
+        replay_cache = replaycache.ReplayCache(self.directory)
+        sha1sum = _sha1(b'data')
+
+        def fetch(fileobj):
+            fileobj.write(b'da')
+            raise IOError('connection lost')
+
+        with self.assertRaises(IOError):
+            replay_cache.get(sha1sum, fetch)
+        self.assertEqual(os.listdir(os.path.dirname(
+            replay_cache.path_for(sha1sum)
+        )), [])
+        replay_cache.get(sha1sum, self.fetcher(b'data'))
+        self.assertEqual(self.fetched, [b'data'])
+
+    def test_invalid_sha1sum(self):
+        replay_cache = replaycache.ReplayCache(self.directory)
+        with self.assertRaises(ValueError):
+            replay_cache.get('../../etc/passwd', self.fetcher(b''))
+
+    def test_evicts_least_recently_used(self):
+        replay_cache = replaycache.ReplayCache(self.directory, max_size=25)
+        replays = [b'a' * 10, b'b' * 10, b'c' * 10]
+        a_path = replay_cache.get(_sha1(replays[0]),
+                                  self.fetcher(replays[0]))
+        b_path = replay_cache.get(_sha1(replays[1]),
+                                  self.fetcher(replays[1]))
+        os.utime(a_path, (1000, 1000))
+        os.utime(b_path, (2000, 2000))
+        # A hit makes a the most recently used
+        replay_cache.get(_sha1(replays[0]), self.fetcher(replays[0]))
+        c_path = replay_cache.get(_sha1(replays[2]),
+                                  self.fetcher(replays[2]))
+
+        self.assertTrue(os.path.exists(a_path))
+        self.assertFalse(os.path.exists(b_path))
+        self.assertTrue(os.path.exists(c_path))
+        stats = replay_cache.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['size'], 20)
+
+    def test_keeps_entry_bigger_than_max_size(self):
+        replay_cache = replaycache.ReplayCache(self.directory, max_size=5)
+        data = b'x' * 10
+        path = replay_cache.get(_sha1(data), self.fetcher(data))
+        self.assertTrue(os.path.exists(path))
+
+    def test_concurrent_processes_fetch_once(self):
+        data = b'shared replay'
+        fetch_log = os.path.join(self.directory, 'fetch.log')
+        processes = [
+            multiprocessing.Process(target=_slow_get,
+                                    args=(self.directory, data, fetch_log))
+            for _ in range(4)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+
+        with open(fetch_log) as fh:
+            self.assertEqual(fh.read(), 'fetch\n')
+        stats = replaycache.ReplayCache(self.directory).stats()
+        self.assertEqual((stats['hits'], stats['misses']), (3, 1))
@@ -0,0 +1,73 @@
+import json
+import random
+
+from cheeseshop.tests import base
+from cheeseshop.workers import supply_breakdown
+
+
+class FakeUnit(object):
+    def __init__(self, name, supply, finished_at, died_at=None):
+        self.name = name
+        self.supply = supply
+        self.finished_at = finished_at
+        self.died_at = died_at
+
+
+def sampled_supplies(units, frames):
+    """The per sample scan the interval sweep replaced."""
+    times = list(range(0, frames, 160))
+    unit_supplies = {}
+    for unit_type in supply_breakdown.ARMY_UNITS:
+        unit_supplies[unit_type] = []
+    for time in times:
+        supply_per_unit = dict((unit_type, 0)
+                               for unit_type in supply_breakdown.ARMY_UNITS)
+        for unit in units:
+            if unit.name not in supply_breakdown.army_units:
+                continue
+            died_at = frames if unit.died_at is None else unit.died_at
+            if unit.finished_at <= time <= died_at:
+                supply_per_unit[unit.name] += unit.supply
+        for unit_name, supply in supply_per_unit.items():
+            unit_supplies[unit_name].append(supply)
+    return times, dict((key, value) for key, value in unit_supplies.items()
+                       if sum(value) != 0)
+
+
+class TestArmySupplySeries(base.TestCase):
+    def test_boundaries_inclusive(self):
+        units = [FakeUnit('Marine', 1, 160, 480),
+                 FakeUnit('Marine', 1, 161, 319),
+                 FakeUnit('SCV', 1, 0),
+                 FakeUnit('SiegeTank', 3, 300)]
+        times, supplies = supply_breakdown.army_supply_series(units, 700)
+        self.assertEqual(times, [0, 160, 320, 480, 640])
+        self.assertEqual(list(supplies.items()), [
+            ('Marine', [0, 1, 1, 1, 0]),
+            ('SiegeTank', [0, 0, 3, 3, 3]),
+        ])
+
+    def test_unfinished_units_ignored(self):
+        units = [FakeUnit('Marine', 1, None, 200)]
+        times, supplies = supply_breakdown.army_supply_series(units, 700)
+        self.assertEqual(supplies, {})
+
+    def test_matches_sampled_scan(self):
+        rand = random.Random(0)
+        names = list(supply_breakdown.ARMY_UNITS[:8]) + ['Probe', 'Drone']
+        # Supply is fixed per unit type, zerglings having half
+        supplies = dict((name, rand.choice([0.5, 1, 2, 3]))
+                        for name in names)
+        frames = 20000
+        units = []
+        for _ in range(300):
+            name = rand.choice(names)
+            finished_at = rand.randrange(frames)
+            died_at = rand.choice([None, finished_at + rand.randrange(5000)])
+            units.append(FakeUnit(name, supplies[name], finished_at,
+                                  died_at))
+        expected = sampled_supplies(units, frames)
+        actual = supply_breakdown.army_supply_series(units, frames)
+        # Compare as json so an int 0 and a float 0.0 differ
+        self.assertEqual(json.dumps(actual, sort_keys=True),
+                         json.dumps(expected, sort_keys=True))
@@ -0,0 +1,238 @@
+import asyncio
+import hashlib
+import tempfile
+
+import fixtures
+
+from cheeseshop import swift
+from cheeseshop.tests import base
+from cheeseshop.tests import fakes
+
+
+class TestKeystoneSession(base.TestCase):
+    async def setUp(self):
+        super(TestKeystoneSession, self).setUp()
+        self.fake = fakes.FakeKeystoneSwift()
+        await self.fake.start()
+        self.addCleanup(self.fake.close)
+
+    def make_session(self, **kwargs):
+        session = swift.KeystoneSession(self.fake.url, 'project', 'user',
+                                        'password', **kwargs)
+        self.addCleanup(session.close)
+        return session
+
+    async def test_token_cached(self):
+        session = self.make_session()
+        tokens = await asyncio.gather(*[session.get_token()
+                                        for _ in range(5)])
+        self.assertEqual(self.fake.auth_count, 1)
+        self.assertEqual(set(t.token_id for t in tokens), {'token-1'})
+        self.assertIsNotNone(tokens[0].expires_at)
+
+        await session.get_token()
+        self.assertEqual(self.fake.auth_count, 1)
+
+    async def test_refresh_before_expiry(self):
+        self.fake.expires_in = 60
+        session = self.make_session(refresh_margin=59.95)
+        token = await session.get_token()
+        self.assertEqual(token.token_id, 'token-1')
+        await asyncio.sleep(0.2)
+        self.assertGreaterEqual(self.fake.auth_count, 2)
+        self.assertNotEqual(session.token.token_id, 'token-1')
+
+    async def test_reauth_on_401(self):
+        session = self.make_session()
+        async with swift.SwiftClient(session, 'region') as client:
+            await client.create_object('a', b'data', 'container')
+            self.fake.revoked.add(session.token.token_id)
+            await asyncio.gather(
+                client.create_object('b', b'data', 'container'),
+                client.create_object('c', b'data', 'container')
+            )
+        self.assertEqual(self.fake.auth_count, 2)
+        self.assertEqual(sorted(self.fake.objects),
+                         [('container', 'a'), ('container', 'b'),
+                          ('container', 'c')])
+
+    async def test_shared_http_session(self):
+        http_session = swift.create_http_session(self.config.swift)
+        self.addCleanup(http_session.close)
+        session = self.make_session(http_session=http_session)
+        async with swift.SwiftClient(session, 'region',
+                                     http_session=http_session) as client:
+            for name in ('a', 'b', 'c'):
+                await client.create_object(name, b'data', 'container')
+        # Sequential uploads reuse one kept-alive connection
+        self.assertEqual(len(self.fake.peers), 1)
+        self.assertFalse(http_session.closed)
+
+
+class ChunkReader(object):
+    def __init__(self, data):
+        self.data = data
+        self.reads = 0
+
+    async def read(self, size):
+        self.reads += 1
+        chunk = self.data[:size]
+        self.data = self.data[size:]
+        return chunk
+
+
+class TestUploadStream(base.TestCase):
+    async def setUp(self):
+        super(TestUploadStream, self).setUp()
+        self.fake = fakes.FakeKeystoneSwift()
+        await self.fake.start()
+        self.addCleanup(self.fake.close)
+        self.session = swift.KeystoneSession(self.fake.url, 'project',
+                                             'user', 'password')
+        self.addCleanup(self.session.close)
+
+    async def upload(self, data, size_hint, **kwargs):
+        reader = ChunkReader(data)
+        async with swift.SwiftClient(self.session, 'region',
+                                     **kwargs) as client:
+            result = await client.upload_stream('replay', reader.read,
+                                                'replays',
+                                                size_hint=size_hint)
+        self.assertEqual(result, (hashlib.sha1(data).hexdigest(),
+                                  len(data)))
+        self.assertEqual(self.fake.objects[('replays', 'replay')], data)
+        return reader
+
+    async def test_small_upload(self):
+        data = b'a' * (swift.STREAM_CHUNK_SIZE * 3 + 5)
+        reader = await self.upload(data, len(data))
+        self.assertEqual(reader.reads, 5)
+        self.assertEqual(self.fake.manifests, set())
+
+    async def test_large_object(self):
+        data = bytes(range(256)) * 1000
+        await self.upload(data, len(data), segment_size=100000,
+                          large_object_threshold=100000)
+        self.assertEqual(self.fake.manifests, {('replays', 'replay')})
+        segments = sorted(name for container, name in self.fake.objects
+                          if container == 'replays_segments')
+        self.assertEqual(segments, ['replay/00000000', 'replay/00000001',
+                                    'replay/00000002'])
+
+    async def test_unknown_size(self):
+        await self.upload(b'abc', None)
+        self.assertEqual(self.fake.manifests, {('replays', 'replay')})
+
+    async def test_delete_large_object(self):
+        data = b'a' * 250
+        await self.upload(data, None, segment_size=100)
+        async with swift.SwiftClient(self.session, 'region') as client:
+            await client.delete_object('replay', 'replays')
+        self.assertEqual(self.fake.objects, {})
+
+
+class TestLargeObject(base.TestCase):
+    async def setUp(self):
+        super(TestLargeObject, self).setUp()
+        self.fake = fakes.FakeKeystoneSwift()
+        await self.fake.start()
+        self.addCleanup(self.fake.close)
+        self.session = swift.KeystoneSession(self.fake.url, 'project',
+                                             'user', 'password')
+        self.addCleanup(self.session.close)
+        self.data = bytes(range(256)) * 40
+
+    async def upload(self, data, **kwargs):
+        async with swift.SwiftClient(self.session, 'region') as client:
+            segments = await client.create_large_object(
+                'replay', data, 'replays', segment_size=1000, **kwargs
+            )
+        self.assertEqual(self.fake.objects[('replays', 'replay')], self.data)
+        self.assertEqual(self.fake.manifests, {('replays', 'replay')})
+        return segments
+
+    async def test_slo(self):
+        segments = await self.upload(self.data, concurrency=3)
+        self.assertEqual([s['size_bytes'] for s in segments],
+                         [1000] * 10 + [240])
+        self.assertEqual(segments[0]['path'],
+                         '/replays_segments/replay/00000000')
+
+    async def test_dlo_from_file(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(self.data)
+            f.flush()
+            await self.upload(f, manifest='dlo')
+
+    async def test_retry_segment(self):
+        self.fake.fail_puts = 2
+        with fixtures.MonkeyPatch('cheeseshop.swift.SEGMENT_RETRY_DELAY', 0):
+            await self.upload(self.data, retries=1)
+
+    async def test_segment_fails(self):
+        self.fake.fail_puts = 2
+        async with swift.SwiftClient(self.session, 'region') as client:
+            with fixtures.MonkeyPatch('cheeseshop.swift.SEGMENT_RETRY_DELAY',
+                                      0):
+                with self.assertRaises(swift.SwiftError):
+                    await client.create_large_object(
+                        'replay', self.data, 'replays', segment_size=1000,
+                        concurrency=1, retries=1
+                    )
+        self.assertNotIn(('replays', 'replay'), self.fake.objects)
+
+
+class TestOpenObject(base.TestCase):
+    async def setUp(self):
+        super(TestOpenObject, self).setUp()
+        self.fake = fakes.FakeKeystoneSwift()
+        await self.fake.start()
+        self.addCleanup(self.fake.close)
+        self.session = swift.KeystoneSession(self.fake.url, 'project',
+                                             'user', 'password')
+        self.addCleanup(self.session.close)
+        self.data = bytes(range(256)) * 1000
+        self.fake.objects[('replays', 'replay')] = self.data
+
+    async def read(self, **kwargs):
+        async with swift.SwiftClient(self.session, 'region') as client:
+            async with client.open_object('replay', 'replays',
+                                          **kwargs) as reader:
+                chunks = []
+                while True:
+                    chunk = await reader.read_chunk(1000)
+                    if not chunk:
+                        break
+                    self.assertLessEqual(len(chunk), 1000)
+                    chunks.append(chunk)
+                return reader, b''.join(chunks)
+
+    async def test_stream(self):
+        reader, data = await self.read()
+        self.assertEqual(reader.status, 200)
+        self.assertEqual(data, self.data)
+
+    async def test_range(self):
+        reader, data = await self.read(
+            range_header=swift.format_range(100, 199)
+        )
+        self.assertEqual(reader.status, 206)
+        self.assertEqual(data, self.data[100:200])
+        _, data = await self.read(range_header=swift.format_range(-10))
+        self.assertEqual(data, self.data[-10:])
+
+    async def test_range_not_satisfiable(self):
+        with self.assertRaises(swift.RangeNotSatisfiableError):
+            await self.read(range_header=swift.format_range(10 ** 6))
+
+    async def test_not_found(self):
+        del self.fake.objects[('replays', 'replay')]
+        with self.assertRaises(swift.ObjectNotFoundError):
+            await self.read()
+
+    async def test_get_tempurl(self):
+        async with swift.SwiftClient(self.session, 'region',
+                                     temp_url_key=b'key') as client:
+            url = await client.create_tempurl('replay', 'replays',
+                                              method='GET')
+        self.assertIn('/v1/AUTH_test/replays/replay?temp_url_sig=', url)
@@ -1,23 +1,126 @@
 # Common utilities
+import asyncio
+import datetime
 import os
 import sys
 
+from cheeseshop import db
+from cheeseshop import dbapi
+from cheeseshop import objectstoreapi
+from cheeseshop import replaycache
+from cheeseshop import swift
 
-def get_replay(sha1sum):
+
+# The ReplayDownloader of this process, see get_replay_downloader()
+_downloader = None
+
+
+def get_replay(sha1sum, config=None):
     """ Retrieve a replay given the sha1sum unique name of the
-    replay file"""
+    replay file
 
-    # TODO: make this use swift
+    Replays are read from REPLAY_DIR if it is set, otherwise they are
+    fetched from swift through the replay cache in config"""
 
     replay_dir = os.environ.get("REPLAY_DIR")
-    if replay_dir is None:
-        print("Error: please set the environment variable: REPLAY_DIR")
+    if replay_dir is not None:
+        return os.path.join(replay_dir, sha1sum + ".SC2Replay")
+    if config is None:
+        print("Error: please set the environment variable: REPLAY_DIR "
+              "or pass a config file")
         sys.exit(1)
-    replay_path = os.path.join(replay_dir, sha1sum + ".SC2Replay")
-    return replay_path
+
+    def fetch(fileobj):
+        downloader = get_replay_downloader(config)
+        downloader.loop.run_until_complete(
+            downloader.download(sha1sum, fileobj)
+        )
+
+    return get_replay_cache(config).get(sha1sum, fetch)
+
+
+def get_replay_downloader(config):
+    """ Return the ReplayDownloader of this process, creating it with
+    config on first use
+
+    Batch workers are forked while the parent's loop is running, so a
+    forked process creates its own rather than using its parent's"""
+    global _downloader
+    if _downloader is None or _downloader.pid != os.getpid():
+        _downloader = ReplayDownloader(config)
+    return _downloader
+
+
+def get_replay_cache(config):
+    return replaycache.ReplayCache(config.replay_cache.directory,
+                                   config.replay_cache.max_size)
+
+
+class ReplayDownloader(object):
+    """ Downloads replays from swift for one process
+
+    Its event loop, db connection, HTTP session and keystone token are kept
+    for every replay the process downloads, so a batch authenticates once
+    per worker rather than once per replay"""
+    def __init__(self, config):
+        self.config = config
+        self.pid = os.getpid()
+        self.loop = asyncio.new_event_loop()
+        self._conn = None
+        self._http_session = None
+        self._keystone = None
+
+    async def _get_conn(self):
+        if self._conn is None or self._conn.is_closed():
+            self._conn = await db.connect(self.config.sql)
+        return self._conn
+
+    def _get_keystone(self):
+        if self._keystone is None:
+            swift_config = self.config.swift
+            self._http_session = swift.create_http_session(swift_config)
+            self._keystone = swift.KeystoneSession(
+                swift_config.auth_url,
+                swift_config.project_id,
+                swift_config.user_id,
+                swift_config.password,
+                http_session=self._http_session
+            )
+        return self._keystone
+
+    async def download(self, sha1sum, fileobj):
+        """ Write the replay with sha1sum from swift to fileobj"""
+        conn = await self._get_conn()
+        replay = await dbapi.Replay.get_by_sha1sum(conn, sha1sum)
+
+        swift_config = self.config.swift
+        swift_client = swift.SwiftClient(self._get_keystone(),
+                                         swift_config.region,
+                                         http_session=self._http_session)
+        replay_data = objectstoreapi.ReplayData(
+            replay.uuid, swift_config.replays_container
+        )
+        await replay_data.download(swift_client, fileobj)
 
 
 def truthy(val):
     if type(val) == str:
         return val in ('True', 'true', 't', 'yes')
     return bool(val)
+
+
+def parse_time(val):
+    """ Parse a unix timestamp or an ISO 8601 style date/time string into a
+    naive datetime in local time, matching how event times are stored"""
+    try:
+        return datetime.datetime.fromtimestamp(float(val))
+    except (ValueError, OverflowError, OSError):
+        # Not a number, or a timestamp out of the platform's range
+        pass
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S',
+                '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(val, fmt)
+        except ValueError:
+            pass
+    raise ValueError('Unable to parse time: %s' % val)
@@ -0,0 +1,298 @@
+# worker
+# Runs player_names or supply_breakdown over many replays in a pool of
+# processes, so the sc2reader import and engine setup are paid once per
+# process rather than once per replay.
+#
+# Results go to NDJSON (one {"sha1sum", "analysis", "version", "result"}
+# object per line) or into the database (see results.store). Replays which
+# already have a result for the current analysis version in the output are
+# skipped, so an interrupted run resumes when started again with the same
+# arguments.
+
+import argparse
+import asyncio
+import concurrent.futures
+import functools
+import json
+import os
+import sys
+
+import sc2reader
+from sc2reader.engine.plugins import ContextLoader, GameHeartNormalizer
+
+from cheeseshop import config as cs_config
+from cheeseshop import db
+from cheeseshop import dbapi
+from cheeseshop import util
+from cheeseshop.workers import player_names
+from cheeseshop.workers import results as worker_results
+from cheeseshop.workers import supply_breakdown
+
+
+ANALYSES = {
+    'player_names': (player_names.player_names,
+                     player_names.ANALYSIS_VERSION),
+    'supply_breakdown': (supply_breakdown.supply_breakdown,
+                         supply_breakdown.ANALYSIS_VERSION),
+}
+
+PROGRESS_INTERVAL = 100
+
+# One engine per worker process, reused for every replay it loads
+_engine = None
+
+
+def _load_replay(path):
+    global _engine
+    if _engine is None:
+        _engine = sc2reader.engine.GameEngine(plugins=[
+            ContextLoader(),
+            GameHeartNormalizer(),
+        ])
+    return sc2reader.load_replay(path, engine=_engine)
+
+
+def analyze(analysis, config, sha1sum):
+    """Run analysis on one replay, in a worker process.
+
+    Errors are returned rather than raised so one bad replay does not stop
+    the batch.
+    """
+    analyze_replay, version = ANALYSES[analysis]
+    try:
+        replay = _load_replay(util.get_replay(sha1sum, config))
+        result = analyze_replay(replay)
+    except Exception as e:
+        return {'sha1sum': sha1sum, 'analysis': analysis, 'version': version,
+                'error': '%s: %s' % (type(e).__name__, e)}
+    return {'sha1sum': sha1sum, 'analysis': analysis, 'version': version,
+            'result': result}
+
+
+class NdjsonOutput(object):
+    """Append results to an NDJSON file, or write them to stdout for -."""
+    def __init__(self, path):
+        self.path = path
+        self._fh = None
+
+    async def open(self):
+        if self.path == '-':
+            self._fh = sys.stdout
+            return
+        self._fh = open(self.path, 'a+')
+        # A run killed part way through a write leaves a partial last line
+        self._fh.seek(0, os.SEEK_END)
+        if self._fh.tell() > 0:
+            self._fh.seek(self._fh.tell() - 1)
+            if self._fh.read(1) != '\n':
+                self._fh.write('\n')
+
+    async def completed(self, analysis, version):
+        if self.path == '-' or not os.path.exists(self.path):
+            return set()
+        sha1sums = set()
+        with open(self.path) as fh:
+            for line in fh:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('analysis') == analysis and \
+                        record.get('version') == version and \
+                        'result' in record:
+                    sha1sums.add(record['sha1sum'])
+        return sha1sums
+
+    async def write(self, record):
+        # Errors are written too, and retried when the run is resumed
+        self._fh.write(json.dumps(record) + '\n')
+        self._fh.flush()
+
+    async def close(self):
+        if self._fh is not None and self._fh is not sys.stdout:
+            self._fh.close()
+
+
+class PostgresOutput(object):
+    """Store results in the database in batches."""
+    def __init__(self, sql_config, batch_size=100):
+        self._sql_config = sql_config
+        self.batch_size = batch_size
+        self._pool = None
+        self._pending = {}
+
+    async def open(self):
+        self._pool = await db.create_pool(self._sql_config)
+
+    async def completed(self, analysis, version):
+        async with self._pool.acquire() as conn:
+            return await dbapi.ReplayAnalysis.get_sha1sums(conn, analysis,
+                                                           version)
+
+    async def write(self, record):
+        if 'error' in record:
+            return
+        key = (record['analysis'], record['version'])
+        results = self._pending.setdefault(key, [])
+        results.append((record['sha1sum'], record['result']))
+        if len(results) >= self.batch_size:
+            await self._flush()
+
+    async def _flush(self):
+        pending, self._pending = self._pending, {}
+        async with self._pool.acquire() as conn:
+            for (analysis, version), results in pending.items():
+                await worker_results.store(conn, analysis, version, results)
+
+    async def close(self):
+        if self._pool is None:
+            return
+        try:
+            await self._flush()
+        finally:
+            await self._pool.close()
+
+
+async def run_batch(loop, executor, work, sha1sums, output, jobs,
+                    log=None):
+    """Run work(sha1sum) on executor for each sha1sum, writing each result
+    to output as it completes.
+
+    At most jobs * 2 replays are queued at once so a long input is not
+    all submitted up front. Returns (succeeded, failed) counts.
+    """
+    log = log or (lambda msg: print(msg, file=sys.stderr))
+    counts = {'succeeded': 0, 'failed': 0}
+    pending = set()
+
+    async def record(done):
+        for future in done:
+            result = future.result()
+            await output.write(result)
+            if 'error' in result:
+                counts['failed'] += 1
+                log('Failed %s: %s' % (result['sha1sum'], result['error']))
+            else:
+                counts['succeeded'] += 1
+            finished = counts['succeeded'] + counts['failed']
+            if finished % PROGRESS_INTERVAL == 0:
+                log('Processed %d of %d replays' % (finished, len(sha1sums)))
+
+    for sha1sum in sha1sums:
+        if len(pending) >= jobs * 2:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            await record(done)
+        pending.add(loop.run_in_executor(executor, work, sha1sum))
+    if pending:
+        done, _ = await asyncio.wait(pending)
+        await record(done)
+    return counts['succeeded'], counts['failed']
+
+
+def read_sha1sums(lines):
+    """Return the sha1sums in lines, in order and without duplicates."""
+    sha1sums = []
+    seen = set()
+    for line in lines:
+        sha1sum = line.strip()
+        if sha1sum and sha1sum not in seen:
+            seen.add(sha1sum)
+            sha1sums.append(sha1sum)
+    return sha1sums
+
+
+async def get_all_sha1sums(sql_config):
+    pool = await db.create_pool(sql_config)
+    try:
+        async with pool.acquire() as conn:
+            sha1sums = []
+            async with conn.transaction():
+                async for record in dbapi.Replay.cursor_sha1sums(conn):
+                    sha1sums.append(record['sha1sum'])
+            return sha1sums
+    finally:
+        await pool.close()
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description='Cheeseshop worker: run an analysis over many replays'
+    )
+    parser.add_argument('analysis', choices=sorted(ANALYSES))
+    parser.add_argument('sha1sums', nargs='*', help='Sha1sums of replays')
+    parser.add_argument('--input', type=str, default=None,
+                        help='File of sha1sums, one per line, or - for '
+                             'stdin')
+    parser.add_argument('--all', action='store_true',
+                        help='Analyze every replay in the database')
+    parser.add_argument('--config', type=str, default=None,
+                        help='Path to config file, to fetch replays from '
+                             'swift and for --all and --postgres')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                        help='Number of worker processes')
+    parser.add_argument('--output', type=str, default='-',
+                        help='NDJSON file to append results to, or - for '
+                             'stdout')
+    parser.add_argument('--postgres', action='store_true',
+                        help='Store results in the database instead of '
+                             'writing NDJSON')
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help='Results per database write with --postgres')
+    return parser.parse_args(args)
+
+
+async def _main(loop, args, config):
+    if args.postgres:
+        output = PostgresOutput(config.sql, args.batch_size)
+    else:
+        output = NdjsonOutput(args.output)
+
+    sha1sums = list(args.sha1sums)
+    if args.input == '-':
+        sha1sums.extend(sys.stdin)
+    elif args.input is not None:
+        with open(args.input) as fh:
+            sha1sums.extend(fh)
+    if args.all:
+        sha1sums.extend(await get_all_sha1sums(config.sql))
+    sha1sums = read_sha1sums(sha1sums)
+
+    await output.open()
+    try:
+        _, version = ANALYSES[args.analysis]
+        completed = await output.completed(args.analysis, version)
+        todo = [sha1sum for sha1sum in sha1sums if sha1sum not in completed]
+        print('Analyzing %d replays, %d already done' % (
+            len(todo), len(sha1sums) - len(todo)
+        ), file=sys.stderr)
+
+        work = functools.partial(analyze, args.analysis, config)
+        with concurrent.futures.ProcessPoolExecutor(args.jobs) as executor:
+            succeeded, failed = await run_batch(loop, executor, work, todo,
+                                                output, args.jobs)
+    finally:
+        await output.close()
+    print('Done: %d succeeded, %d failed' % (succeeded, failed),
+          file=sys.stderr)
+    return failed
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    config = None
+    if args.config is not None:
+        config = cs_config.Config.from_yaml_file(args.config)
+    if config is None and (args.all or args.postgres):
+        print('Error: --all and --postgres need --config')
+        sys.exit(1)
+    if config is None and os.environ.get('REPLAY_DIR') is None:
+        print('Error: please set the environment variable: REPLAY_DIR '
+              'or pass a config file')
+        sys.exit(1)
+
+    loop = asyncio.get_event_loop()
+    failed = loop.run_until_complete(_main(loop, args, config))
+    if failed:
+        sys.exit(1)
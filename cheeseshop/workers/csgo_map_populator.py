@@ -7,38 +7,131 @@ from cheeseshop import config as cs_config
 from cheeseshop import db
 from cheeseshop import dbapi
 from cheeseshop.games import csgo
+from cheeseshop.games import csgo_events
 
 
 def parse_args(args):
     parser = argparse.ArgumentParser(description='cheeseshop webapp.')
     parser.add_argument('config_file', type=str,
                         help='Path to config file')
-    parser.add_argument('streamer_uuid', type=str)
+    parser.add_argument('streamer_uuids', type=str, nargs='*')
+    parser.add_argument('--all', action='store_true',
+                        help='Populate maps of every streamer')
     parser.add_argument('--stride', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='Streamers to process at once')
+    parser.add_argument('--reset', action='store_true',
+                        help='Delete the streamers\' maps, extracted events '
+                             'and checkpoints and start again from their '
+                             'first event')
     return parser.parse_args(args)
 
 
-async def run(db_pool, streamer_uuid, stride):
-    stride = stride
-    offset = 0
+async def _load_checkpoint(conn, streamer):
+    try:
+        checkpoint = await dbapi.CsGoMapPopulatorCheckpoint.get(conn,
+                                                                streamer.id)
+    except dbapi.NotFoundError:
+        return 0, None, csgo.MapState(), csgo_events.TickDiffer()
+    map_state = await csgo.MapState.load(conn, checkpoint.map_state)
+    tick_differ = csgo_events.TickDiffer()
+    if checkpoint.tick_differ is not None:
+        tick_differ = csgo_events.TickDiffer.load(checkpoint.tick_differ)
+    return (checkpoint.last_event_id, checkpoint.last_event_time, map_state,
+            tick_differ)
+
+
+async def run(db_pool, streamer_uuid, stride, reset=False):
+    """Link a streamer's events to maps, creating the maps as they start,
+    and extract death, money and round events from them.
+
+    Carries on from the streamer's checkpoint, which is saved in the same
+    transaction as each batch of stride events so a crash loses nothing.
+    Events already extracted from a batch, by the webapp or an earlier
+    run, are replaced. Returns the number of events processed.
+    """
+    # Not shared between streamers, as steam ids it creates are only
+    # visible to others once the batch commits
+    event_store = csgo_events.EventStore()
+    processed = 0
     async with db_pool.acquire() as conn:
         streamer = await dbapi.CsGoStreamer.get_by_uuid(conn, streamer_uuid)
-        map_state = csgo.MapState()
+        if reset:
+            async with conn.transaction():
+                await dbapi.CsGoMapPopulatorCheckpoint.delete(conn,
+                                                              streamer.id)
+                await dbapi.CsGoHltvEvent.delete_by_streamer_id(conn,
+                                                                streamer.id)
+                await dbapi.CsGoMap.delete_by_streamer_id(conn, streamer.id)
+        last_id, last_time, map_state, tick_differ = await _load_checkpoint(
+            conn, streamer
+        )
         while True:
             async with conn.transaction():
-                ret = await dbapi.CsGoGsiEvent.get_oldest_by_streamer_id(
+                ret = await dbapi.CsGoGsiEvent.get_next_by_streamer_id(
                     conn,
                     streamer.id,
+                    after_id=last_id,
                     limit=stride,
-                    offset=offset
+                    since=last_time
                 )
-                offset += stride
-                print('Processing %d events' % len(ret))
+                print('Processing %d events of %s' % (len(ret),
+                                                      streamer.name))
+                relations = []
+                extracted_rows = []
                 for event in ret:
-                    await map_state.update(json.loads(event.event), conn,
-                                           streamer, event.id)
-                if len(ret) < stride:
-                    return
+                    gsi_data = json.loads(event.event)
+                    map_ = await map_state.advance(gsi_data, conn, streamer,
+                                                   event.time)
+                    map_id = None
+                    if map_ is not None:
+                        map_id = map_.id
+                        relations.append((event.id, map_.id))
+                    for extracted in tick_differ.diff(gsi_data, map_id):
+                        extracted_rows.append((event.time, streamer.id,
+                                               map_id, event.id, extracted))
+                await dbapi.CsGoEventMapRelation.create_many_missing(
+                    conn, relations
+                )
+                if ret:
+                    await dbapi.CsGoHltvEvent.delete_by_streamer_id(
+                        conn, streamer.id, last_id, ret[-1].id
+                    )
+                    await event_store.write(conn, extracted_rows)
+                    last_id = ret[-1].id
+                    last_time = ret[-1].time
+                    await dbapi.CsGoMapPopulatorCheckpoint.save(
+                        conn, streamer.id, last_id, map_state.dump(),
+                        tick_differ.dump(), last_time
+                    )
+            processed += len(ret)
+            if len(ret) < stride:
+                return processed
+
+
+async def run_many(db_pool, streamer_uuids, stride, concurrency, reset=False):
+    """Run each streamer on its own pooled connection, up to concurrency at
+    a time.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(streamer_uuid):
+        async with semaphore:
+            return await run(db_pool, streamer_uuid, stride, reset)
+
+    return await asyncio.gather(*[run_one(streamer_uuid)
+                                  for streamer_uuid in streamer_uuids])
+
+
+async def _get_streamer_uuids(db_pool, args):
+    streamer_uuids = list(args.streamer_uuids)
+    if args.all:
+        async with db_pool.acquire() as conn:
+            async with conn.transaction():
+                streamers = await dbapi.CsGoStreamer.get_all(conn)
+        streamer_uuids.extend(streamer.uuid for streamer in streamers
+                              if streamer.uuid not in streamer_uuids)
+    return streamer_uuids
 
 
 def main():
@@ -47,5 +140,9 @@ def main():
 
     loop = asyncio.get_event_loop()
     pool = loop.run_until_complete(db.create_pool(config.sql))
-    loop.run_until_complete(run(pool, args.streamer_uuid,
-                                args.stride))
+    streamer_uuids = loop.run_until_complete(_get_streamer_uuids(pool, args))
+    if not streamer_uuids:
+        print('Error: pass streamer uuids or --all')
+        sys.exit(1)
+    loop.run_until_complete(run_many(pool, streamer_uuids, args.stride,
+                                     args.concurrency, args.reset))
@@ -1,15 +1,37 @@
 # worker
-# Takes one sc2 replay file and produces some text (later thrown in a db)
+# Takes one sc2 replay file and produces some text, or stores it in the db
 # produces the names and races of the players
 
 # This mostly exists as a template that new workers can be cargo'd from
 
 import argparse
+import asyncio
 import sys
 import sc2reader
 from sc2reader.engine.plugins import ContextLoader, GameHeartNormalizer
 
+from cheeseshop import config as cs_config
 from cheeseshop.util import get_replay
+from cheeseshop.workers import results
+
+
+# Bump whenever the output of player_names changes
+ANALYSIS_VERSION = 1
+
+
+def player_names(replay):
+    players = []
+    for p in replay.players:
+        players.append({
+            'pid': p.pid,
+            'name': p.name,
+            'race': p.play_race,
+            'pick_race': p.pick_race,
+            'team': p.team.number if p.team is not None else None,
+            'result': p.result,
+            'is_human': p.is_human,
+        })
+    return players
 
 
 def parse_args(args):
@@ -17,13 +39,25 @@ def parse_args(args):
         description='Cheeseshop worker: player_names'
     )
     parser.add_argument('--sha1sum', type=str, help='Sha1sum of replay')
+    parser.add_argument('--config', type=str, default=None,
+                        help='Path to config file, to fetch the replay from '
+                             'swift through the replay cache')
+    parser.add_argument('--postgres', action='store_true',
+                        help='Store the result in the database instead of '
+                             'printing it, needs --config')
     return parser.parse_args(args)
 
 
 def main():
     args = parse_args(sys.argv[1:])
     print("Accessing replay, id: {0}".format(args.sha1sum))
-    r = get_replay(args.sha1sum)
+    config = None
+    if args.config is not None:
+        config = cs_config.Config.from_yaml_file(args.config)
+    elif args.postgres:
+        print("Error: --postgres needs --config")
+        sys.exit(1)
+    r = get_replay(args.sha1sum, config)
     replay = sc2reader.load_replay(
         r,
         engine=sc2reader.engine.GameEngine(plugins=[
@@ -31,5 +65,12 @@ def main():
             GameHeartNormalizer(),
         ])
     )
+    if args.postgres:
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(results.store_one(
+            config.sql, 'player_names', ANALYSIS_VERSION, args.sha1sum,
+            player_names(replay)
+        ))
+        return
     for p in replay.players:
         print(p)
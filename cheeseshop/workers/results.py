@@ -0,0 +1,27 @@
+# Storing worker output in the database, where the webapp serves it from
+# rather than parsing the replay again.
+
+from cheeseshop import db
+from cheeseshop import dbapi
+
+
+async def store(conn, analysis, version, results):
+    """Upsert (sha1sum, result) pairs of analysis version.
+
+    Every result is kept whole in replay_analyses, and player_names results
+    are also split into replay_players so they can be queried.
+    """
+    async with conn.transaction():
+        await dbapi.ReplayAnalysis.upsert_many(conn, analysis, version,
+                                               results)
+        if analysis == 'player_names':
+            await dbapi.ReplayPlayer.upsert_many(conn, version, results)
+
+
+async def store_one(sql_config, analysis, version, sha1sum, result):
+    pool = await db.create_pool(sql_config)
+    try:
+        async with pool.acquire() as conn:
+            await store(conn, analysis, version, [(sha1sum, result)])
+    finally:
+        await pool.close()
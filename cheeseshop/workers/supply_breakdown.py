@@ -1,5 +1,6 @@
 # worker
-# Takes one sc2 replay file and produces a json object
+# Takes one sc2 replay file and produces a json object, printed or stored in
+# the db
 # produces two sets of time series, one set for each player, one time series
 # for each unit type
 
@@ -33,6 +34,8 @@
 # }
 
 import argparse
+import asyncio
+import collections
 import hashlib
 import json
 import sys
@@ -40,21 +43,21 @@ import sys
 import sc2reader
 from sc2reader.engine.plugins import ContextLoader, GameHeartNormalizer
 
+from cheeseshop import config as cs_config
 from cheeseshop.util import get_replay
+from cheeseshop.workers import results
 
 
-def alive_at_this_time(unit, time, frames):
-    if unit.died_at is None:
-        unit.died_at = frames
-    if time >= unit.finished_at and time <= unit.died_at:
-        return True
-    else:
-        return False
+# Army supply is sampled every this many frames
+SAMPLE_INTERVAL = 160
+
+# Bump whenever the output of supply_breakdown changes
+ANALYSIS_VERSION = 1
 
 
 # hand built
 # duplicated in many places
-army_units = ['Nuke',  # I guess
+ARMY_UNITS = ('Nuke',  # I guess
               'Marine',
               'Marauder',
               'Reaper',
@@ -74,7 +77,6 @@ army_units = ['Nuke',  # I guess
               'Raven',
               'Banshee',
               'Battlecruiser',
-              'Nuke',  # I guess
               'Zealot',
               'Stalker',
               'Sentry',
@@ -104,28 +106,58 @@ army_units = ['Nuke',  # I guess
               'Viper',
               'Baneling',
               'BroodLord',
-              'Overseer', ]
-
-
-def parse_args(args):
-    parser = argparse.ArgumentParser(
-        description='Cheeseshop worker: supply_breakdown'
-    )
-    parser.add_argument('--sha1sum', type=str, help='Sha1sum of replay')
-    return parser.parse_args(args)
-
-
-def main():     # noqa: C901
-    args = parse_args(sys.argv[1:])
-    r = get_replay(args.sha1sum)
-    replay = sc2reader.load_replay(
-        r,
-        engine=sc2reader.engine.GameEngine(plugins=[
-            ContextLoader(),
-            GameHeartNormalizer(),
-        ])
-    )
-
+              'Overseer', )
+
+army_units = frozenset(ARMY_UNITS)
+
+
+def army_supply_series(units, frames, interval=SAMPLE_INTERVAL):
+    """Return the sampled frames and the army supply alive at each of them
+    for every unit type with any.
+
+    A unit is alive from its finished_at frame to its died_at frame, or
+    the end of the game, inclusive. Each unit adds its supply at the first
+    sample it is alive for and takes it away after the last one, so a
+    running sum gives the supply at every sample without checking every
+    unit at every sample.
+    """
+    times = list(range(0, frames, interval))
+    samples = len(times)
+    deltas = {}
+    for unit in units:
+        if unit.name not in army_units or unit.finished_at is None:
+            continue
+        died_at = frames if unit.died_at is None else unit.died_at
+        first = max(-(-unit.finished_at // interval), 0)
+        last = min(died_at // interval, samples - 1)
+        if first > last:
+            continue
+        if unit.name not in deltas:
+            deltas[unit.name] = ([0] * (samples + 1), [0] * (samples + 1))
+        supply_deltas, alive_deltas = deltas[unit.name]
+        supply_deltas[first] += unit.supply
+        supply_deltas[last + 1] -= unit.supply
+        alive_deltas[first] += 1
+        alive_deltas[last + 1] -= 1
+
+    unit_supplies = collections.OrderedDict()
+    for unit_type in ARMY_UNITS:
+        if unit_type not in deltas:
+            continue
+        supply_deltas, alive_deltas = deltas[unit_type]
+        supplies = []
+        supply = alive = 0
+        for index in range(samples):
+            supply += supply_deltas[index]
+            alive += alive_deltas[index]
+            # Keep an exact 0 rather than what is left of float supplies
+            supplies.append(supply if alive else 0)
+        if sum(supplies) != 0:
+            unit_supplies[unit_type] = supplies
+    return times, unit_supplies
+
+
+def supply_breakdown(replay):
     data = {}
     data['map'] = replay.map_name
     data['players'] = []
@@ -139,36 +171,9 @@ def main():     # noqa: C901
         player_data = {}
         player_data['name'] = player.name
 
-        unit_supplies = {}
-        for unit_type in army_units:
-            unit_supplies[unit_type] = []
-
         # All done in frames
-        times = []
-        game_end = replay.frames
-        game_start = 0
-
-        for current_frame in range(game_start, game_end, 160):
-            times.append(current_frame)
-            supply_per_unit = {}
-            for unit_type in army_units:
-                supply_per_unit[unit_type] = 0
-            # Scan all units owned by player
-            for unit in player.units:
-                if unit.name not in army_units:
-                    continue
-                if alive_at_this_time(unit, current_frame, replay.frames):
-                    supply_per_unit[unit.name] += unit.supply
-            for unit_name, supply in supply_per_unit.items():
-                unit_supplies[unit_name].append(supply)
-
-        to_pop = []
-        for key, value in unit_supplies.items():
-            if sum(value) == 0:
-                to_pop.append(key)
-
-        for key in to_pop:
-            unit_supplies.pop(key, None)
+        times, unit_supplies = army_supply_series(player.units,
+                                                  replay.frames)
 
         # Create visualization-ready json object
         constructed_data = []
@@ -188,5 +193,44 @@ def main():     # noqa: C901
 
         player_data['army_supply'] = constructed_data
         data['players'].append(player_data)
+    return data
+
 
-    print(json.dumps(data))
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description='Cheeseshop worker: supply_breakdown'
+    )
+    parser.add_argument('--sha1sum', type=str, help='Sha1sum of replay')
+    parser.add_argument('--config', type=str, default=None,
+                        help='Path to config file, to fetch the replay from '
+                             'swift through the replay cache')
+    parser.add_argument('--postgres', action='store_true',
+                        help='Store the result in the database instead of '
+                             'printing it, needs --config')
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    config = None
+    if args.config is not None:
+        config = cs_config.Config.from_yaml_file(args.config)
+    elif args.postgres:
+        print("Error: --postgres needs --config")
+        sys.exit(1)
+    r = get_replay(args.sha1sum, config)
+    replay = sc2reader.load_replay(
+        r,
+        engine=sc2reader.engine.GameEngine(plugins=[
+            ContextLoader(),
+            GameHeartNormalizer(),
+        ])
+    )
+    if args.postgres:
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(results.store_one(
+            config.sql, 'supply_breakdown', ANALYSIS_VERSION, args.sha1sum,
+            supply_breakdown(replay)
+        ))
+        return
+    print(json.dumps(supply_breakdown(replay)))